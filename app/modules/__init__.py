@@ -1,2 +1 @@
-from modules.addons import *
-from modules.util import registered_modules
+from modules.util import registered_modules, module_manifest, load_module
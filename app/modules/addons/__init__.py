@@ -1,3 +1 @@
-from modules.addons.terminal import ShellManager
-from modules.addons.sync import SystemSync
-from modules.addons.script import ScriptManager
+# addons are imported by the core through module_manifest in modules.util
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+import base64
+import gc
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+import tracemalloc
+import zlib
+from collections import Counter
+from threading import Thread, Lock
+from modules.util import register_module, Module, read_text, parse_key_values, command_executor
+
+
+logger = logging.getLogger(__name__)
+
+
+class SamplingProfiler:
+
+    """
+    Sample the stacks of every thread at an interval for a bounded duration
+    Nothing is hooked into the interpreter, so there is no cost outside of a profile run
+    """
+
+    max_duration = 60.0
+    min_interval = 0.001
+
+    def __init__(self, duration=10.0, interval=0.01):
+        self.duration = min(float(duration), self.max_duration)
+        self.interval = max(float(interval), self.min_interval)
+        self.stacks = Counter()
+        self.samples = 0
+
+    @staticmethod
+    def _frame_label(frame):
+        code = frame.f_code
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+
+    def run(self):
+        own_id = threading.get_ident()
+        names = {}
+        deadline = time.monotonic() + self.duration
+
+        while time.monotonic() < deadline:
+            frames = sys._current_frames()
+            if len(names) != len(frames):
+                names = {t.ident: t.name for t in threading.enumerate()}
+
+            for thread_id, frame in frames.items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(self._frame_label(frame))
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                # collapsed stack format, root first
+                self.stacks[";".join(reversed(stack))] += 1
+
+            self.samples += 1
+            time.sleep(self.interval)
+        return self
+
+    def to_dict(self, limit=200):
+        return {
+            "duration": self.duration,
+            "interval": self.interval,
+            "samples": self.samples,
+            "stacks": dict(self.stacks.most_common(limit)),
+        }
+
+
+@register_module()
+class Diagnostics(Module):
+
+    """
+    Look inside a running client on request: cpu profiles, memory snapshots, thread stacks and internal stats
+    Results are zlib compressed and sent in chunks
+    """
+
+    name = "diag"
+    event_keys = ["diag"]
+
+    # size of each base64 chunk sent to the server
+    chunk_size = 32_000
+
+    def __init__(self, core, queue):
+        super().__init__(core, queue)
+        self._profile_thread = None
+        self._snapshot = None
+        self._tracemalloc_lock = Lock()
+
+    def shutdown(self):
+        super().shutdown()
+        if self._profile_thread is not None:
+            self._profile_thread.join()
+            self._profile_thread = None
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def event(self, ev):
+        if not isinstance(ev, dict):
+            return
+
+        _type = ev.get("type")
+        _data = ev.get("data") or {}
+        request_id = _data.get("id")
+
+        if _type == "profile":
+            self.profile(request_id, _data.get("duration", 10), _data.get("interval", 0.01))
+
+        elif _type == "tracemalloc":
+            action, limit = _data.get("action", "snapshot"), int(_data.get("limit", 25))
+            self._collect(request_id, "tracemalloc", lambda: self.tracemalloc(action, limit))
+
+        elif _type == "threads":
+            self._collect(request_id, "threads", self.thread_stacks)
+
+        elif _type == "stats":
+            self._collect(request_id, "stats", self.stats)
+
+    def _collect(self, request_id, kind, collect):
+        """
+        Collect and send a result from a worker thread, snapshots can take seconds on a busy process
+        """
+        def run():
+            try:
+                self._send(request_id, kind, collect())
+            except Exception:
+                logger.exception(f"Error collecting {kind} diagnostics")
+
+        Thread(target=run, daemon=True).start()
+
+    def _send(self, request_id, kind, result):
+        payload = base64.b64encode(zlib.compress(json.dumps(result).encode(), 6)).decode()
+        chunks = [payload[i:i + self.chunk_size] for i in range(0, len(payload), self.chunk_size)] or [""]
+        for index, chunk in enumerate(chunks):
+            self.bulk_queue.put({
+                "type": "diag",
+                "data": {
+                    "type": "result",
+                    "data": {
+                        "id": request_id,
+                        "kind": kind,
+                        "encoding": "zlib+base64",
+                        "chunk": index,
+                        "chunks": len(chunks),
+                        "data": chunk
+                    }
+                }
+            })
+
+    def profile(self, request_id, duration, interval):
+        if self._profile_thread is not None and self._profile_thread.is_alive():
+            logger.warning("A profile is already running, ignoring request")
+            return False
+
+        def run():
+            logger.info(f"Profiling for {duration} seconds")
+            profiler = SamplingProfiler(duration, interval).run()
+            self._send(request_id, "profile", profiler.to_dict())
+
+        self._profile_thread = Thread(target=run, daemon=True)
+        self._profile_thread.start()
+        return True
+
+    def tracemalloc(self, action, limit=25):
+        # requests run on their own threads, the previous snapshot is shared between them
+        with self._tracemalloc_lock:
+            return self._tracemalloc(action, limit)
+
+    def _tracemalloc(self, action, limit):
+        if action == "start":
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(10)
+            self._snapshot = tracemalloc.take_snapshot()
+            return {"tracing": True}
+
+        if action == "stop":
+            tracemalloc.stop()
+            self._snapshot = None
+            return {"tracing": False}
+
+        if not tracemalloc.is_tracing():
+            return {"tracing": False, "error": "tracemalloc is not running"}
+
+        # snapshot, compared with the previous snapshot
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+        ])
+        current, peak = tracemalloc.get_traced_memory()
+        result = {
+            "tracing": True,
+            "current": current,
+            "peak": peak,
+            "top": [
+                {"trace": str(stat.traceback), "size": stat.size, "count": stat.count}
+                for stat in snapshot.statistics("lineno")[:limit]
+            ],
+        }
+        if self._snapshot is not None:
+            result["diff"] = [
+                {"trace": str(stat.traceback), "size_diff": stat.size_diff, "count_diff": stat.count_diff}
+                for stat in snapshot.compare_to(self._snapshot, "lineno")[:limit]
+            ]
+        self._snapshot = snapshot
+        return result
+
+    @staticmethod
+    def thread_stacks():
+        names = {t.ident: t.name for t in threading.enumerate()}
+        return {
+            names.get(thread_id, str(thread_id)): traceback.format_stack(frame)
+            for thread_id, frame in sys._current_frames().items()
+        }
+
+    def stats(self):
+        status = parse_key_values(read_text("/proc/self/status"))
+        try:
+            queue_size = self.queue.qsize()
+        except (NotImplementedError, OSError):
+            queue_size = None
+
+        compressor = getattr(self.core, "compressor", None)
+        bulk_compressor = getattr(getattr(self.core, "bulk", None), "compressor", None)
+        spool = getattr(self.core, "spool", None)
+        return {
+            "gc": {
+                "counts": gc.get_count(),
+                "thresholds": gc.get_threshold(),
+                "generations": gc.get_stats(),
+                "garbage": len(gc.garbage),
+            },
+            "queue_size": queue_size,
+            "threads": threading.active_count(),
+            "rss": status.get("VmRSS"),
+            "modules": list(getattr(self.core, "modules", {}).keys()),
+            "compression": compressor.report() if compressor else None,
+            "bulk_compression": bulk_compressor.report() if bulk_compressor else None,
+            "commands": command_executor.report(),
+            "spool": spool.report() if spool else None,
+        }
+
+
+if __name__ == "__main__":
+    pass
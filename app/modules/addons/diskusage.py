@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+import hashlib
+import heapq
+import json
+import logging
+import os
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from threading import Thread, Lock
+from modules.util import register_module, Module
+from modules.addons.sync import Storage, Volume
+
+
+logger = logging.getLogger(__name__)
+
+
+class DirectoryEntry:
+
+    """
+    What one directory holds directly, this is also what the index stores for it
+    Sizes are allocated bytes (st_blocks) like du, not apparent sizes
+    """
+
+    __slots__ = ("mtime", "own_bytes", "files", "subdirs")
+
+    def __init__(self, mtime, own_bytes, files, subdirs):
+        self.mtime = mtime
+        # the directory's own blocks
+        self.own_bytes = own_bytes
+        # name -> bytes of every file counted in this directory
+        self.files = files
+        self.subdirs = subdirs
+
+    @property
+    def file_bytes(self):
+        return self.own_bytes + sum(self.files.values())
+
+    def to_list(self):
+        return [self.mtime, self.own_bytes, self.files, self.subdirs]
+
+    @classmethod
+    def from_list(cls, data):
+        return cls(*data)
+
+
+class ScanIndex:
+
+    """
+    Per directory file names and sizes from the last complete scan of a path, stored as zlib compressed json
+    A directory's mtime only changes when entries are added, removed or renamed, not when a file in it
+    grows, so an unchanged directory isn't listed again but every file in it is stat'ed again
+    """
+
+    # bumped when the stored format changes, older indexes are ignored
+    version = 2
+
+    def __init__(self, directory, root):
+        self.root = root
+        self.path = os.path.join(directory, f"{hashlib.sha1(root.encode()).hexdigest()[:16]}.idx")
+        self.entries = {}
+
+    def load(self):
+        try:
+            with open(self.path, "rb") as infile:
+                data = json.loads(zlib.decompress(infile.read()))
+        except FileNotFoundError:
+            return self
+        except (OSError, ValueError, zlib.error) as e:
+            logger.warning(f"Ignoring unreadable disk usage index {self.path} ({e})")
+            return self
+        if data.get("root") == self.root and data.get("version") == self.version:
+            self.entries = {path: DirectoryEntry.from_list(entry) for path, entry in data.get("entries", {}).items()}
+        return self
+
+    def save(self, entries):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        data = zlib.compress(json.dumps({
+            "version": self.version,
+            "root": self.root,
+            "entries": {path: entry.to_list() for path, entry in entries.items()},
+        }, separators=(",", ":")).encode(), 6)
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "wb") as outfile:
+            outfile.write(data)
+        os.replace(temp_path, self.path)
+        return len(data)
+
+
+class DiskScanner:
+
+    """
+    Walk a directory tree with a thread pool, one task per directory, without crossing into other filesystems
+    Totals are added up the tree as each directory finishes, so a partial top list is available during the scan
+    """
+
+    # files at least this big are tracked by name for the top list
+    large_file_size = 1024 * 1024
+
+    def __init__(self, root, workers=4, index=None):
+        self.root = os.path.abspath(root)
+        self.workers = max(1, workers)
+        self.index = index or {}
+        self.device = os.lstat(self.root).st_dev
+        self.entries = {}
+        self.totals = {}
+        self.files = {}
+        self.scanned = 0
+        self.reused = 0
+        self.errors = 0
+        self.cancelled = False
+        self._inodes = set()
+        self._inodes_lock = Lock()
+
+    def _seen(self, st):
+        # hard linked files are only counted once, like du
+        if st.st_nlink < 2:
+            return False
+        key = (st.st_dev, st.st_ino)
+        with self._inodes_lock:
+            if key in self._inodes:
+                return True
+            self._inodes.add(key)
+        return False
+
+    def _scan_directory(self, path):
+        """
+        Return (path, DirectoryEntry, reused), the entry is None if the directory can't be read
+        """
+        try:
+            st = os.lstat(path)
+        except OSError:
+            return path, None, False
+        own_bytes = st.st_blocks * 512
+
+        cached = self.index.get(path)
+        if cached is not None and cached.mtime == st.st_mtime_ns:
+            # same entries as last time, but any of the files may have grown or shrunk
+            files = {}
+            for name in cached.files:
+                try:
+                    file_st = os.lstat(os.path.join(path, name))
+                except OSError:
+                    continue
+                if not self._seen(file_st):
+                    files[name] = file_st.st_blocks * 512
+            return path, DirectoryEntry(st.st_mtime_ns, own_bytes, files, cached.subdirs), True
+
+        files = {}
+        subdirs = []
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if entry.stat(follow_symlinks=False).st_dev == self.device:
+                                subdirs.append(entry.name)
+                            continue
+                        entry_st = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    if not self._seen(entry_st):
+                        files[entry.name] = entry_st.st_blocks * 512
+        except OSError as e:
+            logger.debug(f"Could not list {path} ({e})")
+            return path, None, False
+
+        return path, DirectoryEntry(st.st_mtime_ns, own_bytes, files, subdirs), False
+
+    def _add(self, path, entry):
+        self.entries[path] = entry
+        for name, size in entry.files.items():
+            if size >= self.large_file_size:
+                self.files[os.path.join(path, name)] = size
+        # add the directory's own bytes to it and every directory above it
+        file_bytes = entry.file_bytes
+        current = path
+        while True:
+            self.totals[current] = self.totals.get(current, 0) + file_bytes
+            if current == self.root:
+                break
+            current = os.path.dirname(current)
+
+    def run(self, progress=None, progress_interval=1.0):
+        """
+        Scan the tree, progress is called with the scanner every progress_interval seconds
+        """
+        reported_at = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            pending = {pool.submit(self._scan_directory, self.root)}
+            while pending and not self.cancelled:
+                done, pending = wait(pending, timeout=progress_interval, return_when=FIRST_COMPLETED)
+                for future in done:
+                    path, entry, reused = future.result()
+                    if entry is None:
+                        self.errors += 1
+                        continue
+                    self.scanned += 1
+                    self.reused += reused
+                    self._add(path, entry)
+                    for name in entry.subdirs:
+                        pending.add(pool.submit(self._scan_directory, os.path.join(path, name)))
+
+                if progress and time.monotonic() - reported_at >= progress_interval:
+                    progress(self)
+                    reported_at = time.monotonic()
+
+            for future in pending:
+                future.cancel()
+        return self
+
+    def tree(self, count=20):
+        """
+        The largest count directories and count files with the directories above them, as a nested tree
+        """
+        top_dirs = heapq.nlargest(count, ((p, s) for p, s in self.totals.items() if p != self.root), key=lambda i: i[1])
+        top_files = heapq.nlargest(count, self.files.items(), key=lambda i: i[1])
+
+        nodes = {self.root: {"name": self.root, "type": "dir", "size": self.totals.get(self.root, 0), "children": []}}
+
+        def node(path, _type, size):
+            if path in nodes:
+                return nodes[path]
+            nodes[path] = {"name": os.path.basename(path), "type": _type, "size": size}
+            if _type == "dir":
+                nodes[path]["children"] = []
+            parent = node(os.path.dirname(path), "dir", self.totals.get(os.path.dirname(path), 0))
+            parent["children"].append(nodes[path])
+            return nodes[path]
+
+        for path, size in top_dirs:
+            node(path, "dir", size)
+        for path, size in top_files:
+            node(path, "file", size)
+
+        for value in nodes.values():
+            if "children" in value:
+                value["children"].sort(key=lambda n: n["size"], reverse=True)
+        return nodes[self.root]
+
+    def stats(self):
+        return {
+            "directories": self.scanned,
+            "reused": self.reused,
+            "errors": self.errors,
+            "bytes": self.totals.get(self.root, 0),
+        }
+
+
+@register_module()
+class DiskUsage(Module):
+
+    """
+    Find what is filling up a disk, results are streamed back as the scan goes
+    Rescans of the same path use the index from the last scan to avoid listing unchanged directories again
+    """
+
+    name = "diskusage"
+    event_keys = ["diskusage"]
+
+    max_scans = 2
+    default_workers = 4
+    max_workers = 16
+
+    def __init__(self, core, queue):
+        super().__init__(core, queue)
+        self.scans = {}
+        self._threads = {}
+
+    @property
+    def index_dir(self):
+        return os.path.join(self.core.config.base_dir, "diskusage")
+
+    def shutdown(self):
+        super().shutdown()
+        for scanner in list(self.scans.values()):
+            scanner.cancelled = True
+        for thread in list(self._threads.values()):
+            thread.join()
+
+    def send(self, _type, data):
+        self.bulk_queue.put({
+            "type": "diskusage",
+            "data": {
+                "type": _type,
+                "data": data
+            }
+        })
+
+    def event(self, ev):
+        if not isinstance(ev, dict):
+            return
+
+        _type = ev.get("type")
+        _data = ev.get("data") or {}
+        request_id = _data.get("id")
+
+        if _type == "scan":
+            self.scan(request_id, _data)
+
+        elif _type == "cancel":
+            scanner = self.scans.get(request_id)
+            if scanner:
+                scanner.cancelled = True
+
+    @staticmethod
+    def volume(path):
+        """
+        The volume the path is on, from the same mount table the storage sync uses
+        """
+        dev = os.stat(path).st_dev
+        mount = Storage.read_mounts().get(f"{os.major(dev)}:{os.minor(dev)}")
+        if mount is None:
+            return None
+        return Volume.from_mount(*mount).to_dict()
+
+    def scan(self, request_id, data):
+        path = data.get("path", "/")
+        if not os.path.isabs(path) or not os.path.isdir(path):
+            self.send("scanerror", {"id": request_id, "error": "An absolute path to a directory is required"})
+            return
+        if request_id in self.scans:
+            self.send("scanerror", {"id": request_id, "error": "A scan with this id is already running"})
+            return
+        if len(self.scans) >= self.max_scans:
+            self.send("scanerror", {"id": request_id, "error": "Too many scans are running"})
+            return
+
+        count = int(data.get("count", 20))
+        workers = min(int(data.get("workers", self.default_workers)), self.max_workers)
+        index = ScanIndex(self.index_dir, os.path.abspath(path))
+        if data.get("incremental", True):
+            index.load()
+        scanner = DiskScanner(path, workers=workers, index=index.entries)
+        self.scans[request_id] = scanner
+
+        def progress(s):
+            self.send("progress", {"id": request_id, **s.stats(), "tree": s.tree(count)})
+
+        def run():
+            started = time.monotonic()
+            try:
+                logger.info(f"Scanning disk usage of {path}")
+                scanner.run(progress=progress)
+                if scanner.cancelled:
+                    self.send("scancancelled", {"id": request_id, **scanner.stats()})
+                    return
+                index_bytes = index.save(scanner.entries)
+                self.send("result", {
+                    "id": request_id,
+                    **scanner.stats(),
+                    "elapsed": round(time.monotonic() - started, 3),
+                    "index_bytes": index_bytes,
+                    "volume": self.volume(path),
+                    "tree": scanner.tree(count),
+                })
+            except OSError as e:
+                logger.error(f"Error scanning {path} ({e})")
+                self.send("scanerror", {"id": request_id, "error": str(e)})
+            finally:
+                self.scans.pop(request_id, None)
+                self._threads.pop(request_id, None)
+
+        thread = Thread(target=run, daemon=True)
+        self._threads[request_id] = thread
+        thread.start()
+
+
+if __name__ == "__main__":
+    import sys
+    result = DiskScanner(sys.argv[1] if len(sys.argv) > 1 else "/").run()
+    print(json.dumps({**result.stats(), "tree": result.tree(10)}, indent=True))
@@ -0,0 +1,440 @@
+#!/usr/bin/env python3
+import hashlib
+import json
+import logging
+import os
+import struct
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Condition, Lock
+from modules.util import register_module, Module
+
+
+logger = logging.getLogger(__name__)
+
+
+"""
+Chunk frames are binary websocket frames in both directions
+
+    \x00 f | transfer id (16 byte uuid) | offset (uint64) | sha256 of the chunk (32 bytes) | chunk
+"""
+
+
+class Chunk:
+
+    header = struct.Struct(">cc16sQ32s")
+    prefix = (b"\x00", b"f")
+
+    @classmethod
+    def pack(cls, transfer_id, offset, data):
+        return b"".join([
+            cls.header.pack(*cls.prefix, transfer_id.bytes, offset, hashlib.sha256(data).digest()),
+            data
+        ])
+
+    @classmethod
+    def unpack(cls, frame):
+        """
+        Return (transfer_id, offset, chunk) or raise ValueError if the frame is malformed or corrupt
+        """
+        if len(frame) < cls.header.size:
+            raise ValueError("Chunk frame is too short")
+        magic, key, transfer_id, offset, digest = cls.header.unpack_from(frame)
+        data = memoryview(frame)[cls.header.size:]
+        if hashlib.sha256(data).digest() != digest:
+            raise ValueError(f"Chunk at offset {offset} failed the hash check")
+        return uuid.UUID(bytes=transfer_id), offset, data
+
+
+class Download:
+
+    """
+    Send a file to the server in chunks, with at most window chunks waiting for an acknowledgement
+    Chunks are read with pread into a single reusable buffer
+    Resuming is done by the server requesting the download again from the last acknowledged offset
+    Download events go on the bulk queue with the chunks so they stay in order
+    """
+
+    def __init__(self, manager, transfer_id, path, offset=0, chunk_size=256 * 1024, window=8):
+        self.manager = manager
+        self.id = transfer_id
+        self.path = path
+        self.offset = offset
+        self.chunk_size = chunk_size
+        self.window = window
+        self.acked = offset
+        self.cancelled = False
+        self._condition = Condition()
+
+    def acknowledge(self, offset):
+        with self._condition:
+            self.acked = max(self.acked, offset)
+            self._condition.notify()
+
+    def cancel(self):
+        with self._condition:
+            self.cancelled = True
+            self._condition.notify()
+
+    def _wait_for_window(self, sent):
+        with self._condition:
+            while not self.cancelled and self.manager.running and sent - self.acked >= self.window * self.chunk_size:
+                self._condition.wait(1)
+        return not self.cancelled and self.manager.running
+
+    def run(self):
+        try:
+            fd = os.open(self.path, os.O_RDONLY)
+        except OSError as e:
+            self.manager.send("downloaderror", {"id": str(self.id), "error": str(e)}, bulk=True)
+            return
+
+        try:
+            size = os.fstat(fd).st_size
+            self.manager.send("downloadstart", {"id": str(self.id), "size": size, "offset": self.offset}, bulk=True)
+
+            buffer = bytearray(self.chunk_size)
+            view = memoryview(buffer)
+            file_hash = hashlib.sha256()
+
+            # when resuming, the whole file hash still has to include the part that was already sent
+            position = 0
+            while position < self.offset:
+                read = os.preadv(fd, [view[:min(self.chunk_size, self.offset - position)]], position)
+                if not read:
+                    break
+                file_hash.update(view[:read])
+                position += read
+
+            sent = self.offset
+            while sent < size:
+                if not self._wait_for_window(sent):
+                    logger.info(f"Download {self.id} stopped at offset {sent}")
+                    return
+                read = os.preadv(fd, [view], sent)
+                if not read:
+                    break
+                file_hash.update(view[:read])
+                self.manager.bulk_queue.put(Chunk.pack(self.id, sent, view[:read].tobytes()))
+                sent += read
+
+            self.manager.send("downloadend", {"id": str(self.id), "size": sent, "sha256": file_hash.hexdigest()}, bulk=True)
+        except OSError as e:
+            logger.error(f"Error reading {self.path} ({e})")
+            self.manager.send("downloaderror", {"id": str(self.id), "error": str(e)}, bulk=True)
+        finally:
+            os.close(fd)
+
+
+class Upload:
+
+    """
+    Receive a file from the server into a preallocated .part file
+    Progress is saved next to the file so the upload can resume after a reconnect or restart
+    Chunks have to arrive in order, anything else is dropped and the expected offset is acknowledged again
+    Flushing to disk (checkpoint and finish) is slow, the module runs those off the websocket thread
+    """
+
+    # chunks between saving progress
+    save_every = 16
+
+    def __init__(self, transfer_id, path, size, sha256):
+        self.id = transfer_id
+        self.path = path
+        self.size = size
+        self.sha256 = sha256
+        self.part_path = f"{path}.part"
+        self.state_path = f"{path}.part.json"
+        self.offset = 0
+        self._chunks = 0
+        self._fd = None
+        # writes happen on the websocket thread, checkpoints and finishing on the io thread
+        self._lock = Lock()
+
+    def open(self):
+        state = {}
+        try:
+            with open(self.state_path, "r") as infile:
+                state = json.load(infile)
+        except (OSError, ValueError):
+            pass
+
+        resume = state.get("id") == str(self.id) and state.get("size") == self.size and os.path.exists(self.part_path)
+        self.offset = state.get("offset", 0) if resume else 0
+
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self._fd = os.open(self.part_path, os.O_WRONLY | os.O_CREAT, 0o600)
+        if not resume:
+            os.ftruncate(self._fd, 0)
+            if self.size:
+                # reserve the space up front so the upload can't fail half way on a full disk
+                os.posix_fallocate(self._fd, 0, self.size)
+            self._save()
+        return self.offset
+
+    def _save(self, offset=None):
+        offset = self.offset if offset is None else offset
+        with open(self.state_path, "w") as outfile:
+            json.dump({"id": str(self.id), "size": self.size, "sha256": self.sha256, "offset": offset}, outfile)
+
+    def write(self, offset, data):
+        """
+        Write a chunk, returns False if it isn't the chunk that was expected
+        """
+        if offset != self.offset or offset + len(data) > self.size:
+            return False
+        written = 0
+        while written < len(data):
+            written += os.pwrite(self._fd, data[written:], offset + written)
+        self.offset += len(data)
+        self._chunks += 1
+        return True
+
+    @property
+    def checkpoint_due(self):
+        return self._chunks % self.save_every == 0
+
+    def checkpoint(self, offset):
+        """
+        Flush what was written to disk and save progress up to offset, so a restart resumes from there
+        """
+        with self._lock:
+            if self._fd is None:
+                return
+            os.fsync(self._fd)
+            self._save(offset)
+
+    @property
+    def complete(self):
+        return self.offset >= self.size
+
+    def finish(self):
+        """
+        Verify the whole file hash and move the file into place
+        """
+        with self._lock:
+            os.fsync(self._fd)
+            os.close(self._fd)
+            self._fd = None
+
+        file_hash = hashlib.sha256()
+        with open(self.part_path, "rb") as infile:
+            for block in iter(lambda: infile.read(1024 * 1024), b""):
+                file_hash.update(block)
+
+        ok = self.sha256 is None or file_hash.hexdigest() == self.sha256
+        if ok:
+            os.replace(self.part_path, self.path)
+        else:
+            os.remove(self.part_path)
+        os.remove(self.state_path)
+        return ok, file_hash.hexdigest()
+
+    def close(self):
+        with self._lock:
+            if self._fd is not None:
+                self._save()
+                os.close(self._fd)
+                self._fd = None
+
+    def discard(self):
+        """
+        Stop the upload and remove the part file and its progress, the part file is as big as the whole upload
+        """
+        with self._lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+        for path in (self.part_path, self.state_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+@register_module()
+class FileTransfer(Module):
+
+    """
+    Upload and download files over the websocket
+    """
+
+    name = "files"
+    event_keys = ["files"]
+    binary_keys = ["f"]
+
+    max_chunk_size = 1024 * 1024
+
+    def __init__(self, core, queue):
+        super().__init__(core, queue)
+        self.downloads = {}
+        self.uploads = {}
+        self.threads = {}
+        # fsync and hashing of uploads, one thread keeps them in order
+        self._io = ThreadPoolExecutor(max_workers=1)
+
+    def shutdown(self):
+        super().shutdown()
+        for download in self.downloads.values():
+            download.cancel()
+        for thread in list(self.threads.values()):
+            thread.join()
+        self._io.shutdown(wait=True)
+        for upload in self.uploads.values():
+            upload.close()
+
+    def send(self, _type, data, bulk=False):
+        queue = self.bulk_queue if bulk else self.queue
+        queue.put({
+            "type": "files",
+            "data": {
+                "type": _type,
+                "data": data
+            }
+        })
+
+    def event(self, ev):
+        if not isinstance(ev, dict):
+            return
+
+        _type = ev.get("type")
+        _data = ev.get("data") or {}
+
+        try:
+            transfer_id = uuid.UUID(_data.get("id"))
+        except (TypeError, ValueError):
+            logger.warning(f"File transfer event {_type} has an invalid id")
+            return
+
+        if _type == "download":
+            self.download(transfer_id, _data)
+
+        elif _type == "ack":
+            download = self.downloads.get(transfer_id)
+            if download:
+                download.acknowledge(int(_data.get("offset", 0)))
+
+        elif _type == "cancel":
+            download = self.downloads.get(transfer_id)
+            if download:
+                download.cancel()
+            upload = self.uploads.pop(transfer_id, None)
+            if upload:
+                # after any checkpoint that is still queued for it
+                self._io.submit(self._discard_upload, upload)
+
+        elif _type == "upload":
+            self.upload(transfer_id, _data)
+
+    def download(self, transfer_id, data):
+        path = data.get("path")
+        if not path or not os.path.isabs(path):
+            self.send("downloaderror", {"id": str(transfer_id), "error": "An absolute path is required"})
+            return
+
+        existing = self.downloads.get(transfer_id)
+        if existing:
+            # resuming, stop the old sender first
+            existing.cancel()
+            # the thread may have finished and removed itself already
+            thread = self.threads.get(transfer_id)
+            if thread is not None:
+                thread.join()
+
+        download = Download(
+            self,
+            transfer_id,
+            path,
+            offset=int(data.get("offset", 0)),
+            chunk_size=min(int(data.get("chunk_size", 256 * 1024)), self.max_chunk_size),
+            window=max(1, int(data.get("window", 8)))
+        )
+        self.downloads[transfer_id] = download
+
+        def run():
+            try:
+                download.run()
+            finally:
+                if self.downloads.get(transfer_id) is download:
+                    del self.downloads[transfer_id]
+                    self.threads.pop(transfer_id, None)
+
+        thread = Thread(target=run, daemon=True)
+        self.threads[transfer_id] = thread
+        thread.start()
+
+    def upload(self, transfer_id, data):
+        path = data.get("path")
+        if not path or not os.path.isabs(path):
+            self.send("uploaderror", {"id": str(transfer_id), "error": "An absolute path is required"})
+            return
+
+        upload = self.uploads.get(transfer_id)
+        try:
+            if upload is None:
+                upload = Upload(transfer_id, path, int(data.get("size", 0)), data.get("sha256"))
+                upload.open()
+                self.uploads[transfer_id] = upload
+        except OSError as e:
+            self.send("uploaderror", {"id": str(transfer_id), "error": str(e)})
+            return
+
+        # tell the server where to (re)start sending from
+        self.send("uploadready", {"id": str(transfer_id), "offset": upload.offset})
+        if upload.complete:
+            self.uploads.pop(transfer_id, None)
+            self._io.submit(self._finish_upload, upload)
+
+    def binary_event(self, data):
+        try:
+            transfer_id, offset, chunk = Chunk.unpack(data)
+        except ValueError as e:
+            logger.warning(f"Dropping file chunk ({e})")
+            return
+
+        upload = self.uploads.get(transfer_id)
+        if upload is None:
+            logger.warning(f"Received a chunk for unknown upload {transfer_id}")
+            return
+
+        try:
+            written = upload.write(offset, chunk)
+        except OSError as e:
+            self.uploads.pop(transfer_id, None)
+            upload.close()
+            self.send("uploaderror", {"id": str(transfer_id), "error": str(e)})
+            return
+
+        self.send("ack", {"id": str(transfer_id), "offset": upload.offset})
+        if upload.complete:
+            self.uploads.pop(transfer_id, None)
+            self._io.submit(self._finish_upload, upload)
+        elif written and upload.checkpoint_due:
+            self._io.submit(self._checkpoint, upload, upload.offset)
+
+    def _checkpoint(self, upload, offset):
+        try:
+            upload.checkpoint(offset)
+        except OSError as e:
+            logger.error(f"Error saving progress of upload {upload.id} ({e})")
+
+    def _discard_upload(self, upload):
+        try:
+            upload.discard()
+        except OSError as e:
+            logger.error(f"Error removing cancelled upload {upload.id} ({e})")
+
+    def _finish_upload(self, upload):
+        try:
+            ok, digest = upload.finish()
+        except OSError as e:
+            self.send("uploaderror", {"id": str(upload.id), "error": str(e)})
+            return
+        if ok:
+            self.send("uploadend", {"id": str(upload.id), "size": upload.size, "sha256": digest})
+        else:
+            self.send("uploaderror", {"id": str(upload.id), "error": f"File hash mismatch ({digest})"})
+
+
+if __name__ == "__main__":
+    pass
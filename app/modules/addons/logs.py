@@ -0,0 +1,669 @@
+#!/usr/bin/env python3
+import abc
+import ctypes
+import ctypes.util
+import json
+import logging
+import mmap
+import os
+import re
+import select
+import struct
+import subprocess
+import time
+from datetime import datetime
+from threading import Thread, Event
+from modules.util import register_module, Module
+
+
+logger = logging.getLogger(__name__)
+
+
+class Inotify:
+
+    """
+    Minimal inotify binding through libc, raises OSError if inotify isn't available
+    """
+
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+
+    event_header = struct.Struct("iIII")
+
+    _libc = None
+
+    def __init__(self):
+        if Inotify._libc is None:
+            Inotify._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+    def add_watch(self, path, mask):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        return wd
+
+    def read(self, timeout):
+        """
+        Wait up to timeout seconds and return a list of (mask, name) events
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset + self.event_header.size <= len(data):
+            _wd, mask, _cookie, length = self.event_header.unpack_from(data, offset)
+            offset += self.event_header.size
+            name = data[offset:offset + length].rstrip(b"\x00").decode(errors="replace")
+            offset += length
+            events.append((mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class LogFilter:
+
+    """
+    Match log lines by regex, severity and time range on the device
+    Severity uses the syslog levels, 0 (emergency) to 7 (debug), a line matches if it is at least as severe
+    Plain text lines don't carry a level, it is guessed from the first level keyword in the line
+    and lines without one count as info
+    Timestamps are read from the start of the line (ISO 8601 or the traditional syslog format),
+    a line without a timestamp has the timestamp of the line before it
+    """
+
+    severities = {
+        "emerg": 0, "emergency": 0, "panic": 0, "alert": 1, "crit": 2, "critical": 2, "fatal": 2,
+        "err": 3, "error": 3, "warn": 4, "warning": 4, "notice": 5, "info": 6, "debug": 7,
+    }
+    default_severity = 6
+
+    severity_pattern = re.compile(rb"\b(" + b"|".join(k.encode() for k in severities) + rb")\b", re.IGNORECASE)
+    iso_pattern = re.compile(rb"^(\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}(?:[.,]\d+)?(?:Z|[+-]\d{2}:?\d{2})?)")
+    syslog_pattern = re.compile(rb"^([A-Z][a-z]{2} [ \d]\d \d{2}:\d{2}:\d{2})")
+
+    def __init__(self, regex=None, severity=None, since=None, until=None, ignore_case=False):
+        # multiline so ^ and $ anchor to lines when a whole block is searched at once
+        flags = re.MULTILINE | (re.IGNORECASE if ignore_case else 0)
+        self.regex = re.compile(regex.encode(), flags) if regex else None
+        self.severity = self.parse_severity(severity)
+        self.since = float(since) if since is not None else None
+        self.until = float(until) if until is not None else None
+        self._last_time = None
+
+    @classmethod
+    def from_dict(cls, data):
+        data = data or {}
+        return cls(data.get("regex"), data.get("severity"), data.get("since"), data.get("until"), data.get("ignore_case", False))
+
+    @classmethod
+    def parse_severity(cls, severity):
+        if severity is None:
+            return None
+        if isinstance(severity, str) and not severity.isdigit():
+            return cls.severities.get(severity.lower())
+        return int(severity)
+
+    @property
+    def timed(self):
+        return self.since is not None or self.until is not None
+
+    @classmethod
+    def line_severity(cls, line):
+        found = cls.severity_pattern.search(line)
+        return cls.severities[found.group(1).lower().decode()] if found else cls.default_severity
+
+    @classmethod
+    def line_time(cls, line):
+        found = cls.iso_pattern.match(line)
+        if found:
+            try:
+                value = datetime.fromisoformat(found.group(1).decode().replace(",", "."))
+                return value.timestamp()
+            except ValueError:
+                return None
+        found = cls.syslog_pattern.match(line)
+        if found:
+            now = datetime.now()
+            try:
+                value = datetime.strptime(f"{now.year} {found.group(1).decode()}", "%Y %b %d %H:%M:%S")
+            except ValueError:
+                return None
+            if value.timestamp() > now.timestamp() + 86400:
+                # the format has no year, this line is from last year
+                value = value.replace(year=now.year - 1)
+            return value.timestamp()
+        return None
+
+    def match(self, line, severity=None, timestamp=None):
+        """
+        Return True if a line (bytes) passes the filter, severity and timestamp are
+        worked out from the line unless they are given
+        """
+        if self.timed:
+            timestamp = timestamp if timestamp is not None else self.line_time(line)
+            if timestamp is None:
+                timestamp = self._last_time
+            else:
+                self._last_time = timestamp
+            if timestamp is not None:
+                if self.since is not None and timestamp < self.since:
+                    return False
+                if self.until is not None and timestamp > self.until:
+                    return False
+        if self.regex is not None and not self.regex.search(line):
+            return False
+        if self.severity is not None:
+            severity = severity if severity is not None else self.line_severity(line)
+            if severity > self.severity:
+                return False
+        return True
+
+
+class RateLimiter:
+
+    """
+    Token bucket, lines over the rate are dropped and counted
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.dropped = 0
+
+    def allow(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        self.dropped += 1
+        return False
+
+
+class Follower(abc.ABC):
+
+    """
+    Base for following a log source, matching lines are collected and sent in batches
+    every batch_interval, at most max_rate lines per second are sent
+    """
+
+    max_line_length = 4096
+    max_batch_lines = 500
+
+    def __init__(self, manager, follow_id, log_filter, batch_interval=0.5, max_rate=200):
+        self.manager = manager
+        self.id = follow_id
+        self.filter = log_filter
+        self.batch_interval = max(0.1, float(batch_interval))
+        self.limiter = RateLimiter(max_rate)
+        self.batch = []
+        self.sent_at = time.monotonic()
+        self.stopped = Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    @property
+    def alive(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def add(self, line, **kwargs):
+        if not self.filter.match(line, **kwargs):
+            return
+        if self.limiter.allow():
+            self.batch.append(line[:self.max_line_length].decode(errors="replace"))
+        if len(self.batch) >= self.max_batch_lines:
+            self.flush()
+
+    def flush(self, force=False):
+        if not self.batch and not (force and self.limiter.dropped):
+            return
+        self.manager.send("lines", {"id": self.id, "lines": self.batch, "dropped": self.limiter.dropped})
+        self.batch = []
+        self.limiter.dropped = 0
+        self.sent_at = time.monotonic()
+
+    def flush_due(self):
+        if time.monotonic() - self.sent_at >= self.batch_interval:
+            self.flush(force=True)
+
+    def _run(self):
+        try:
+            self.follow()
+        except Exception as e:
+            logger.exception(f"Error following logs for {self.id}")
+            self.manager.send("followerror", {"id": self.id, "error": str(e)})
+        finally:
+            self.flush(force=True)
+            self.manager.send("followend", {"id": self.id})
+
+    @abc.abstractmethod
+    def follow(self):
+        """
+        Read the source until stopped is set, passing each line to add and calling flush_due regularly
+        """
+
+
+class FileFollower(Follower):
+
+    """
+    Follow a file from its end like tail -F
+    The parent directory is watched with inotify so a rotated file (renamed or recreated)
+    is followed by name, and a truncated file is read again from the start
+    Without inotify the file is polled every second
+    """
+
+    watch_mask = Inotify.IN_MODIFY | Inotify.IN_ATTRIB | Inotify.IN_CREATE | Inotify.IN_MOVED_TO | \
+        Inotify.IN_MOVED_FROM | Inotify.IN_DELETE
+
+    def __init__(self, manager, follow_id, path, log_filter, **kwargs):
+        super().__init__(manager, follow_id, log_filter, **kwargs)
+        self.path = path
+        self.file = None
+        self.inode = None
+        self.partial = b""
+
+    def _open(self, from_end):
+        try:
+            self.file = open(self.path, "rb")
+        except OSError:
+            self.file = None
+            return False
+        st = os.fstat(self.file.fileno())
+        self.inode = (st.st_dev, st.st_ino)
+        if from_end:
+            self.file.seek(0, os.SEEK_END)
+        self.partial = b""
+        return True
+
+    def _read(self):
+        if self.file is None:
+            return
+        while True:
+            data = self.file.read(256 * 1024)
+            if not data:
+                break
+            lines = (self.partial + data).split(b"\n")
+            self.partial = lines.pop()
+            for line in lines:
+                self.add(line)
+            if len(self.partial) > self.max_line_length * 4:
+                # a runaway line without a newline, send what we have
+                self.add(self.partial)
+                self.partial = b""
+
+    def _check_rotation(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            # moved away and not recreated yet
+            return
+        if self.file is None or (st.st_dev, st.st_ino) != self.inode:
+            # rotated, finish the old file and read the new one from the start
+            self._read()
+            if self.file is not None:
+                self.file.close()
+            if self._open(from_end=False):
+                logger.debug(f"Following rotated log {self.path}")
+                self._read()
+        elif st.st_size < self.file.tell():
+            logger.debug(f"Log {self.path} was truncated")
+            self.file.seek(0)
+            self.partial = b""
+
+    def follow(self):
+        if not self._open(from_end=True):
+            raise OSError(f"Could not open {self.path}")
+
+        name = os.path.basename(self.path)
+        inotify = None
+        try:
+            inotify = Inotify()
+            inotify.add_watch(os.path.dirname(self.path) or ".", self.watch_mask)
+        except OSError as e:
+            logger.info(f"Polling {self.path}, inotify is unavailable ({e})")
+            if inotify is not None:
+                inotify.close()
+            inotify = None
+
+        try:
+            while not self.stopped.is_set():
+                if inotify is not None:
+                    events = inotify.read(self.batch_interval)
+                    if any(event_name == name for _mask, event_name in events):
+                        self._check_rotation()
+                        self._read()
+                else:
+                    self.stopped.wait(min(1.0, self.batch_interval))
+                    self._check_rotation()
+                    self._read()
+                self.flush_due()
+        finally:
+            if inotify is not None:
+                inotify.close()
+            if self.file is not None:
+                self.file.close()
+
+
+class JournalFollower(Follower):
+
+    """
+    Follow the systemd journal through journalctl, severity and start time are handed to journalctl
+    so it skips entries before they are formatted, the regex is matched here
+    """
+
+    def __init__(self, manager, follow_id, log_filter, units=None, lines=0, **kwargs):
+        super().__init__(manager, follow_id, log_filter, **kwargs)
+        self.units = units or []
+        self.lines = int(lines)
+        self.process = None
+
+    @staticmethod
+    def journal_args(log_filter, units):
+        args = ["journalctl", "-o", "json", "--no-pager"]
+        for unit in units:
+            args += ["-u", unit]
+        if log_filter.severity is not None:
+            args += ["-p", str(log_filter.severity)]
+        if log_filter.since is not None:
+            args += ["--since", f"@{int(log_filter.since)}"]
+        if log_filter.until is not None:
+            args += ["--until", f"@{int(log_filter.until) + 1}"]
+        return args
+
+    @staticmethod
+    def format_entry(entry):
+        """
+        Return (line, severity, timestamp) for a journal json entry
+        """
+        message = entry.get("MESSAGE") or ""
+        if isinstance(message, list):
+            # messages that aren't valid utf-8 are exported as a list of bytes
+            message = bytes(message).decode(errors="replace")
+        timestamp = int(entry.get("__REALTIME_TIMESTAMP", 0)) / 1e6
+        identifier = entry.get("SYSLOG_IDENTIFIER") or entry.get("_COMM") or "-"
+        pid = entry.get("_PID")
+        when = datetime.fromtimestamp(timestamp).isoformat(timespec="microseconds")
+        line = f"{when} {entry.get('_HOSTNAME', '')} {identifier}{f'[{pid}]' if pid else ''}: {message}"
+        return line.encode(), int(entry.get("PRIORITY", LogFilter.default_severity)), timestamp
+
+    def follow(self):
+        args = self.journal_args(self.filter, self.units) + ["-f", "-n", str(self.lines)]
+        self.process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, start_new_session=True)
+        stdout = self.process.stdout
+        partial = b""
+        try:
+            while not self.stopped.is_set() and self.process.poll() is None:
+                readable, _, _ = select.select([stdout], [], [], self.batch_interval)
+                if readable:
+                    data = os.read(stdout.fileno(), 256 * 1024)
+                    if not data:
+                        break
+                    lines = (partial + data).split(b"\n")
+                    partial = lines.pop()
+                    for raw in lines:
+                        try:
+                            line, severity, timestamp = self.format_entry(json.loads(raw))
+                        except ValueError:
+                            continue
+                        self.add(line, severity=severity, timestamp=timestamp)
+                self.flush_due()
+        finally:
+            if self.process.poll() is None:
+                self.process.terminate()
+            self.process.wait()
+
+
+class LogSearch:
+
+    """
+    Search a log backwards from its end for the most recent matching lines
+    The file is memory mapped and scanned in blocks from the end, the regex runs over a whole block
+    at once so only the lines it hits are looked at individually
+    With a start time the search stops at the first block that is older than it
+    """
+
+    block_size = 4 * 1024 * 1024
+
+    def __init__(self, path, log_filter, limit=500, max_bytes=None):
+        self.path = path
+        self.filter = log_filter
+        self.limit = limit
+        self.max_bytes = max_bytes
+        self.scanned = 0
+
+    def _block_lines(self, data, start, end):
+        """
+        Yield (line start, line end) of the candidate lines in data[start:end], newest first
+        """
+        if self.filter.regex is not None and not self.filter.timed:
+            starts = []
+            last = None
+            for found in self.filter.regex.finditer(data, start, end):
+                line_start = data.rfind(b"\n", start, found.start()) + 1 or start
+                if line_start != last:
+                    starts.append(line_start)
+                    last = line_start
+            for line_start in reversed(starts):
+                line_end = data.find(b"\n", line_start, end)
+                yield line_start, line_end if line_end >= 0 else end
+            return
+
+        # every line has to be looked at for time ranges, lines are attributed their timestamp in order
+        position = end
+        while position > start:
+            line_start = data.rfind(b"\n", start, position - 1) + 1
+            line_start = max(line_start, start)
+            yield line_start, position if data[position - 1:position] != b"\n" else position - 1
+            position = line_start
+
+    def run(self):
+        results = []
+        with open(self.path, "rb") as infile:
+            size = os.fstat(infile.fileno()).st_size
+            if not size:
+                return results, False
+            with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                end = size
+                while end > 0 and len(results) < self.limit:
+                    if self.max_bytes is not None and self.scanned >= self.max_bytes:
+                        return results, True
+                    start = max(0, end - self.block_size)
+                    if start > 0:
+                        # start the block on a line boundary, the partial line goes in the next block
+                        start = data.find(b"\n", start, end) + 1 or end
+
+                    if start == end:
+                        # a single line longer than the block
+                        start = data.rfind(b"\n", 0, end - 1) + 1
+
+                    for line_start, line_end in self._block_lines(data, start, end):
+                        line = data[line_start:line_end]
+                        if self.filter.timed:
+                            # going backwards a continuation line gets the time of the line after it,
+                            # close enough for a time range
+                            timestamp = self.filter.line_time(line)
+                            if timestamp is not None and self.filter.since is not None and timestamp < self.filter.since:
+                                return results, False
+                        if self.filter.match(line):
+                            results.append(line[:Follower.max_line_length].decode(errors="replace"))
+                            if len(results) >= self.limit:
+                                break
+
+                    self.scanned += end - start
+                    end = start
+        return results, False
+
+
+class JournalSearch:
+
+    """
+    Search the journal newest first, journalctl applies severity and time and stops reading when we have enough
+    """
+
+    def __init__(self, log_filter, units=None, limit=500):
+        self.filter = log_filter
+        self.units = units or []
+        self.limit = limit
+        self.scanned = 0
+
+    def run(self):
+        results = []
+        args = JournalFollower.journal_args(self.filter, self.units) + ["-r"]
+        process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, start_new_session=True)
+        try:
+            for raw in process.stdout:
+                self.scanned += len(raw)
+                try:
+                    line, severity, timestamp = JournalFollower.format_entry(json.loads(raw))
+                except ValueError:
+                    continue
+                if self.filter.match(line, severity=severity, timestamp=timestamp):
+                    results.append(line[:Follower.max_line_length].decode(errors="replace"))
+                    if len(results) >= self.limit:
+                        break
+        finally:
+            if process.poll() is None:
+                process.terminate()
+            process.wait()
+        return results, False
+
+
+@register_module()
+class Logs(Module):
+
+    """
+    Follow and search log files and the systemd journal with the filtering done on the device
+    """
+
+    name = "logs"
+    event_keys = ["logs"]
+
+    max_follows = 8
+    max_search_lines = 5000
+
+    def __init__(self, core, queue):
+        super().__init__(core, queue)
+        self.followers = {}
+
+    def shutdown(self):
+        super().shutdown()
+        for follower in list(self.followers.values()):
+            follower.stop()
+        self.followers = {}
+
+    def send(self, _type, data, bulk=False):
+        queue = self.bulk_queue if bulk else self.queue
+        queue.put({
+            "type": "logs",
+            "data": {
+                "type": _type,
+                "data": data
+            }
+        })
+
+    def event(self, ev):
+        if not isinstance(ev, dict):
+            return
+
+        _type = ev.get("type")
+        _data = ev.get("data") or {}
+        request_id = _data.get("id")
+
+        try:
+            if _type == "follow":
+                self.follow(request_id, _data)
+            elif _type == "stop":
+                self.stop(request_id)
+            elif _type == "search":
+                Thread(target=self.search, args=(request_id, _data), daemon=True).start()
+        except (ValueError, re.error) as e:
+            logger.warning(f"Invalid logs request {_type} ({e})")
+            self.send("error", {"id": request_id, "error": str(e)})
+
+    def follow(self, follow_id, data):
+        self.stop(follow_id)
+        # followers that ended on their own (an error, journalctl missing) don't count against the limit
+        self.followers = {k: f for k, f in self.followers.items() if f.alive}
+        if len(self.followers) >= self.max_follows:
+            raise ValueError("Too many logs are being followed")
+
+        log_filter = LogFilter.from_dict(data.get("filter"))
+        options = {
+            "batch_interval": float(data.get("batch_interval", 0.5)),
+            "max_rate": float(data.get("max_rate", 200)),
+        }
+        if data.get("journal"):
+            follower = JournalFollower(self, follow_id, log_filter, units=data.get("units"), lines=data.get("lines", 0), **options)
+        else:
+            path = data.get("path")
+            if not path or not os.path.isabs(path):
+                raise ValueError("An absolute path is required")
+            follower = FileFollower(self, follow_id, path, log_filter, **options)
+
+        logger.info(f"Following {data.get('path') or 'the journal'} for {follow_id}")
+        self.followers[follow_id] = follower
+        follower.start()
+
+    def stop(self, follow_id):
+        follower = self.followers.pop(follow_id, None)
+        if follower:
+            follower.stop()
+
+    def search(self, request_id, data):
+        started = time.perf_counter()
+        try:
+            log_filter = LogFilter.from_dict(data.get("filter"))
+            limit = min(int(data.get("limit", 500)), self.max_search_lines)
+            if data.get("journal"):
+                search = JournalSearch(log_filter, units=data.get("units"), limit=limit)
+            else:
+                path = data.get("path")
+                if not path or not os.path.isabs(path):
+                    raise ValueError("An absolute path is required")
+                max_bytes = data.get("max_bytes")
+                search = LogSearch(path, log_filter, limit=limit, max_bytes=int(max_bytes) if max_bytes else None)
+            lines, truncated = search.run()
+        except (OSError, ValueError, re.error) as e:
+            self.send("searcherror", {"id": request_id, "error": str(e)}, bulk=True)
+            return
+
+        self.send("searchresult", {
+            "id": request_id,
+            # oldest first, like the file
+            "lines": lines[::-1],
+            "scanned_bytes": search.scanned,
+            "truncated": truncated,
+            "elapsed_ms": round((time.perf_counter() - started) * 1000, 3),
+        }, bulk=True)
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+import heapq
+import logging
+import os
+import time
+from threading import Thread, Event, Lock
+from modules.util import register_module, Module
+
+
+logger = logging.getLogger(__name__)
+
+
+class ProcessSample:
+
+    """
+    Counters for a single process from one scan
+    """
+
+    __slots__ = ("pid", "name", "state", "ppid", "ticks", "rss", "starttime", "io")
+
+    def __init__(self, pid, name, state, ppid, ticks, rss, starttime, io=None):
+        self.pid = pid
+        self.name = name
+        self.state = state
+        self.ppid = ppid
+        self.ticks = ticks
+        self.rss = rss
+        self.starttime = starttime
+        self.io = io
+
+
+class ProcessScanner:
+
+    """
+    Scan /proc directly without running ps
+    Only /proc/<pid>/stat is read for every process (and io when sorting by io),
+    the command line is only read for the processes that are returned
+    Rates are calculated against the previous scan, only the previous scan's counters are kept
+    """
+
+    proc_dir = "/proc"
+    sort_keys = ["cpu", "rss", "io"]
+
+    # seconds a previous scan stays a baseline for rates, an older one would average over too long
+    max_baseline_age = 5.0
+
+    def __init__(self):
+        self.clock_ticks = os.sysconf("SC_CLK_TCK")
+        self.page_size = os.sysconf("SC_PAGE_SIZE")
+        # pid -> (starttime, ticks, io) from the previous scan
+        self._previous = {}
+        self._previous_time = None
+
+    def _read(self, pid, name):
+        try:
+            with open(f"{self.proc_dir}/{pid}/{name}", "rb") as infile:
+                return infile.read()
+        except OSError:
+            # the process exited or we don't have permission
+            return None
+
+    def _sample(self, pid, with_io=False):
+        data = self._read(pid, "stat")
+        if not data:
+            return None
+
+        # the process name can contain spaces and parentheses, it ends at the last ")"
+        open_paren = data.find(b"(")
+        close_paren = data.rfind(b")")
+        fields = data[close_paren + 2:].split()
+        if len(fields) < 22:
+            return None
+
+        io = None
+        if with_io:
+            io_data = self._read(pid, "io")
+            if io_data:
+                io = 0
+                for line in io_data.splitlines():
+                    if line.startswith(b"read_bytes:") or line.startswith(b"write_bytes:"):
+                        io += int(line.split()[1])
+
+        return ProcessSample(
+            pid=pid,
+            name=data[open_paren + 1:close_paren].decode(errors="replace"),
+            state=fields[0].decode(),
+            ppid=int(fields[1]),
+            ticks=int(fields[11]) + int(fields[12]),
+            rss=int(fields[21]) * self.page_size,
+            starttime=int(fields[19]),
+            io=io
+        )
+
+    def cmdline(self, pid):
+        data = self._read(pid, "cmdline")
+        if not data:
+            return None
+        return data.rstrip(b"\x00").replace(b"\x00", b" ").decode(errors="replace")
+
+    def scan(self, with_io=False):
+        """
+        Return a list of (sample, cpu_percent, io_rate) for every process
+        """
+        now = time.monotonic()
+        elapsed = now - self._previous_time if self._previous_time is not None else None
+        previous = self._previous
+        current = {}
+        results = []
+
+        with os.scandir(self.proc_dir) as entries:
+            for entry in entries:
+                if not entry.name.isdigit():
+                    continue
+                sample = self._sample(int(entry.name), with_io=with_io)
+                if sample is None:
+                    continue
+                current[sample.pid] = (sample.starttime, sample.ticks, sample.io)
+
+                cpu_percent = io_rate = None
+                last = previous.get(sample.pid)
+                # a different start time means the pid was reused by a new process
+                if elapsed and last is not None and last[0] == sample.starttime:
+                    cpu_percent = 100.0 * (sample.ticks - last[1]) / self.clock_ticks / elapsed
+                    if sample.io is not None and last[2] is not None:
+                        io_rate = (sample.io - last[2]) / elapsed
+                results.append((sample, cpu_percent, io_rate))
+
+        self._previous = current
+        self._previous_time = now
+        return results
+
+    def top(self, count=10, sort="cpu", max_age=None):
+        """
+        The top count processes, max_age overrides how old the previous scan may be to be used as the baseline
+        """
+        if sort not in self.sort_keys:
+            raise ValueError(f"Unknown sort key {sort}")
+
+        with_io = sort == "io"
+        max_age = self.max_baseline_age if max_age is None else max_age
+        if (self._previous_time is None or time.monotonic() - self._previous_time > max_age
+                or (with_io and not any(v[2] is not None for v in self._previous.values()))):
+            # rates need a recent baseline scan
+            self.scan(with_io=with_io)
+            time.sleep(0.5)
+        results = self.scan(with_io=with_io)
+
+        key = {
+            "cpu": lambda r: r[1] or 0.0,
+            "rss": lambda r: r[0].rss,
+            "io": lambda r: r[2] or 0.0,
+        }[sort]
+
+        return [
+            {
+                "pid": sample.pid,
+                "name": sample.name,
+                "cmdline": self.cmdline(sample.pid),
+                "state": sample.state,
+                "ppid": sample.ppid,
+                "cpu_percent": round(cpu_percent, 2) if cpu_percent is not None else None,
+                "rss": sample.rss,
+                "io_rate": round(io_rate, 2) if io_rate is not None else None,
+            }
+            for sample, cpu_percent, io_rate in heapq.nlargest(count, results, key=key)
+        ]
+
+
+@register_module()
+class ProcessManager(Module):
+
+    """
+    Report the top processes by cpu, memory or io on request
+    Streaming sends only the changes to the top list every interval until it's stopped or the lease runs out
+    """
+
+    name = "processes"
+    event_keys = ["processes"]
+
+    # seconds a streaming request lasts unless the server renews it
+    stream_lease = 60.0
+
+    def __init__(self, core, queue):
+        super().__init__(core, queue)
+        self.scanner = ProcessScanner()
+        # the scanner keeps the previous scan, so requests and the stream take turns
+        self._scan_lock = Lock()
+        self._thread = None
+        self._wake = Event()
+        self.stream_options = {}
+        self.streaming_until = 0.0
+
+    def shutdown(self):
+        super().shutdown()
+        self.streaming_until = 0.0
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def event(self, ev):
+        if not isinstance(ev, dict):
+            return
+
+        _type = ev.get("type")
+        _data = ev.get("data") or {}
+
+        if _type == "top":
+            # a first request waits for a baseline scan, don't hold up the websocket
+            Thread(target=self._top, args=(_data,), daemon=True).start()
+
+        elif _type == "stream":
+            if _data.get("enabled", True):
+                self.stream_options = {
+                    "count": int(_data.get("count", 10)),
+                    "sort": _data.get("sort", "cpu") if _data.get("sort") in ProcessScanner.sort_keys else "cpu",
+                    "interval": max(1.0, float(_data.get("interval", 2))),
+                }
+                self.streaming_until = time.monotonic() + float(_data.get("lease", self.stream_lease))
+                self._start_stream()
+            else:
+                self.streaming_until = 0.0
+                self._wake.set()
+
+    def _top(self, data):
+        sort = data.get("sort", "cpu")
+        try:
+            with self._scan_lock:
+                processes = self.scanner.top(int(data.get("count", 10)), sort)
+        except ValueError as e:
+            logger.warning(f"Invalid process request ({e})")
+            return
+        except Exception:
+            logger.exception("Error listing processes")
+            return
+        self._send("top", {"sort": sort, "processes": processes})
+
+    def _send(self, _type, data):
+        self.queue.put({
+            "type": "processes",
+            "data": {
+                "type": _type,
+                "data": data
+            }
+        })
+
+    def _start_stream(self):
+        if self._thread is not None and self._thread.is_alive():
+            # the running stream picks up the new options
+            self._wake.set()
+            return
+        self._thread = Thread(target=self._stream, daemon=True)
+        self._thread.start()
+
+    def _stream(self):
+        logger.debug("Streaming processes")
+        sent = {}
+        while self.running and time.monotonic() < self.streaming_until:
+            self._wake.clear()
+            options = self.stream_options
+            try:
+                with self._scan_lock:
+                    # the previous stream scan is the baseline, however long the interval
+                    top = self.scanner.top(options["count"], options["sort"],
+                                           max_age=options["interval"] + self.scanner.max_baseline_age)
+                current = {p["pid"]: p for p in top}
+                changed = [p for pid, p in current.items() if sent.get(pid) != p]
+                removed = [pid for pid in sent if pid not in current]
+                if changed or removed:
+                    self._send("topdelta", {"sort": options["sort"], "changed": changed, "removed": removed})
+                sent = current
+            except Exception:
+                logger.exception("Error streaming processes")
+
+            self._wake.wait(options["interval"])
+        logger.debug("Stopped streaming processes")
+
+
+if __name__ == "__main__":
+    import json
+    print(json.dumps(ProcessScanner().top(10), indent=True))
@@ -97,7 +97,8 @@ class Script:
         """
         if not language:
             return None
-        _, which = run_shell(f"which {language}")
+        # the path of an interpreter rarely changes, cache the lookup for a few minutes
+        _, which = run_shell(f"which {language}", timeout=10, ttl=300)
 
         if language.lower() == "bash":
             return self._first_file(which, "/bin/bash", default="/bin/sh")
@@ -198,7 +199,7 @@ class ScriptManager(Module):
             script_uuid = self.script_queue.pop(0)
             script = self.scripts.pop(script_uuid)
 
-            self.queue.put({
+            self.durable_queue.put({
                 "type": "script",
                 "data": {
                     "type": "scriptstart",
@@ -210,7 +211,7 @@ class ScriptManager(Module):
 
             result = script.execute()
 
-            self.queue.put({
+            self.durable_queue.put({
                 "type": "script",
                 "data": {
                     "type": "scriptend",
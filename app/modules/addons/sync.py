@@ -1,18 +1,22 @@
 #!/usr/bin/env python3
 import logging
+import ipaddress
 import os
+import select
+import socket
+import struct
 import sys
-import netifaces
+import time
 import re
-from threading import Thread
-from modules.util import register_module, Module, dict_getter, run_shell, CommandParser
+from concurrent.futures import ThreadPoolExecutor, Future
+from threading import Thread, Event, Lock
+from modules.util import register_module, Module, dict_getter, CommandParser, json_hash, json_diff, read_text
 
 
 """
-df command
- df --total -T -x tmpfs -x devtmpfs -x squashfs -x overlay
+Storage is read from sysfs, mountinfo and statvfs
 
-hdparm command
+hdparm command (only used when sysfs doesn't have the disk model / serial / rotation rate)
  hdparm -I /dev/sda
 """
 
@@ -25,22 +29,135 @@ logger = logging.getLogger(__name__)
 
 class Storage:
 
-    def __init__(self):
+    sys_block = "/sys/block"
+    sys_class_block = "/sys/class/block"
+    mountinfo_file = "/proc/self/mountinfo"
+
+    # filesystems that aren't interesting to report usage for
+    ignored_fs_types = {"tmpfs", "devtmpfs", "squashfs", "overlay", "debugfs"}
+
+    # number of disks to probe at the same time
+    max_workers = 8
+
+    def __init__(self, cache=None):
+        self.cache = cache
+        self.mounts = self.read_mounts()
+        self.source_mounts = self.mounts_by_source(self.mounts)
         self.disks = self._search_disks()
+        if self.cache is not None:
+            self.cache.flush()
+
+    @staticmethod
+    def _unescape(path):
+        # mountinfo escapes spaces, tabs, newlines and backslashes as octal
+        return re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), path)
+
+    @staticmethod
+    def _subvolume(super_options):
+        for option in super_options.split(","):
+            if option.startswith("subvol="):
+                return option[len("subvol="):]
+        return None
+
+    @classmethod
+    def read_mounts(cls):
+        """
+        Map each device number (major:minor) to its first mount
+        """
+        mounts = {}
+        for line in (read_text(cls.mountinfo_file) or "").splitlines():
+            fields = line.split()
+            try:
+                separator = fields.index("-")
+            except ValueError:
+                continue
+            if separator < 5 or len(fields) < separator + 3:
+                continue
+
+            dev, root, mount_point = fields[2], cls._unescape(fields[3]), cls._unescape(fields[4])
+            fs_type, source = fields[separator + 1], cls._unescape(fields[separator + 2])
+            super_options = fields[separator + 3] if len(fields) > separator + 3 else ""
+
+            # skip bind mounts of subdirectories, df reports the mount of the filesystem root,
+            # btrfs subvolumes are mounted with the subvolume as their root (subvol=/root on Fedora)
+            if root != "/" and root != cls._subvolume(super_options):
+                continue
+            if fs_type in cls.ignored_fs_types:
+                continue
+            mounts.setdefault(dev, (source, fs_type, mount_point))
+        return mounts
+
+    @staticmethod
+    def mounts_by_source(mounts):
+        """
+        Map block device names (sda2, dm-0) to mounts by their source device path
+        btrfs reports anonymous device numbers in mountinfo that don't match any block device
+        """
+        by_source = {}
+        for mount in mounts.values():
+            source = mount[0]
+            if source.startswith("/dev/"):
+                # /dev/mapper names are symlinks to the dm-N device
+                by_source.setdefault(os.path.basename(os.path.realpath(source)), mount)
+        return by_source
 
     def _search_disks(self):
-        regex = r'^Device.+?Sectors.+?Size.+?Type$'
-        regex_name_size = r'(?:^|\n)Disk (?P<disk>(?:\/[._\-A-Za-z0-9]+)+):.+?(?P<total_size>\d+) bytes'
-
-        parser = CommandParser.execute("fdisk -l --bytes")
-        parsers = parser.split("\n\n\n")
-        disks = []
-        for p in parsers:
-            if p.contains(regex):
-                d = p.dict(regex_name_size, "disk", "total_size").first()
-                if d:
-                    disks.append(Disk(d.get("disk"), d.get("total_size")))
-        return disks
+        try:
+            names = sorted(os.listdir(self.sys_block))
+        except OSError as e:
+            logger.error(f"Could not list block devices ({e})")
+            return []
+
+        # physical disks have a backing device, loop / ram / zram / device mapper devices don't
+        names = [n for n in names if os.path.exists(os.path.join(self.sys_block, n, "device"))]
+
+        holders = self._holders()
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            disks = list(executor.map(lambda n: Disk(n, self, holders=holders.get(n, [])), names))
+        return [d for d in disks if d.total_size]
+
+    def _holders(self):
+        """
+        Map each physical disk to the virtual devices (lvm / dm-crypt / md) stacked on top of it,
+        including devices stacked on other virtual devices like lvm on dm-crypt
+        """
+        holders = {}
+        try:
+            names = sorted(os.listdir(self.sys_block))
+        except OSError:
+            return holders
+
+        for name in names:
+            for disk in self._disks_of(name):
+                if disk != name:
+                    holders.setdefault(disk, []).append(name)
+        return holders
+
+    def _disks_of(self, name, seen=None):
+        """
+        Return the physical disks a block device is stored on, following slaves down the stack
+        """
+        seen = seen if seen is not None else set()
+        if name in seen:
+            return set()
+        seen.add(name)
+
+        try:
+            slaves = os.listdir(os.path.join(self.sys_block, name, "slaves"))
+        except OSError:
+            slaves = []
+        if slaves:
+            disks = set()
+            for slave in slaves:
+                disks |= self._disks_of(slave, seen)
+            return disks
+
+        # /sys/class/block/sda1 resolves to .../block/sda/sda1
+        path = os.path.realpath(os.path.join(self.sys_class_block, name))
+        if os.path.exists(os.path.join(path, "partition")):
+            return {os.path.basename(os.path.dirname(path))}
+        return {name}
 
     def to_dict(self):
         return {
@@ -50,43 +167,30 @@ class Storage:
 
 class Volume:
 
-    def __init__(self, name, type, total_blocks, used_blocks, available_blocks, mount_point, block_size=512):
+    def __init__(self, name, type, total_size, used_space, available_space, mount_point):
         self.name = name
-        self._data = dict(
-            name=name,
-            type=type,
-            total_blocks=total_blocks,
-            used_blocks=used_blocks,
-            available_blocks=available_blocks,
-            mount_point=mount_point
-        )
-        self.block_size = block_size
+        self.type = type
+        self.total_size = total_size
+        self.used_space = used_space
+        self.available_space = available_space
+        self.mount_point = mount_point
 
-    def _to_bytes(self, key):
+    @classmethod
+    def from_mount(cls, name, fs_type, mount_point):
         try:
-            return int(self._data.get(key)) * self.block_size
-        except (ValueError, TypeError):
-            return None
-
-    @property
-    def total_size(self):
-        return self._to_bytes("total_blocks")
-
-    @property
-    def used_space(self):
-        return self._to_bytes("used_blocks")
+            st = os.statvfs(mount_point)
+        except OSError as e:
+            logger.debug(f"Could not stat {mount_point} ({e})")
+            return cls(name, fs_type, None, None, None, mount_point)
 
-    @property
-    def available_space(self):
-        return self._to_bytes("available_blocks")
-
-    @property
-    def type(self):
-        return self._data.get("type")
-
-    @property
-    def mount_point(self):
-        return self._data.get("mount_point")
+        return cls(
+            name,
+            fs_type,
+            total_size=st.f_blocks * st.f_frsize,
+            used_space=(st.f_blocks - st.f_bfree) * st.f_frsize,
+            available_space=st.f_bavail * st.f_frsize,
+            mount_point=mount_point
+        )
 
     def to_dict(self):
         fields = ["name", "type", "total_size", "used_space", "available_space", "mount_point"]
@@ -95,50 +199,102 @@ class Volume:
 
 class Disk:
 
-    def __init__(self, name, total_size):
-        self.name = name
+    def __init__(self, block_name, storage, holders=None):
+        self.block_name = block_name
+        self.name = f"/dev/{block_name}"
+        self.path = os.path.join(storage.sys_block, block_name)
+        self.total_size = self._sectors(self.path)
+        self.rotational = read_text(os.path.join(self.path, "queue", "rotational")) == "1"
+        self.volumes = self._search_volumes(storage, holders or [])
+
+        # hdparm fields only change when the disk is swapped, so cache them for the boot
+        if storage.cache is not None:
+            self.info = storage.cache.get(f"disk:{self.name}", self._probe_info) or {}
+        else:
+            self.info = self._probe_info() or {}
+
+    @staticmethod
+    def _sectors(path):
+        # sysfs always reports sizes in 512 byte sectors
         try:
-            self.total_size = int(total_size)
+            return int(read_text(os.path.join(path, "size"))) * 512
         except (TypeError, ValueError):
-            self.total_size = None
-        self.volumes = self._search_volumes(self.name)
-        self.info_parser = CommandParser.execute(f"hdparm -I {self.name}")
-
-    def _search_volumes(self, name):
-        regex = r'^(?P<name>(?:\/[._\-A-Za-z0-9]+)+)\s+(?P<type>[^ ]+)\s+(?P<total_blocks>[^ ]+)\s+(?P<used_blocks>[^ ]+)\s+(?P<available_blocks>[^ ]+)\s+(?P<mount_point>.+?)$'
-        df_command = f"df -x tmpfs -x devtmpfs -x squashfs -x overlay -x debugfs -B 512 --output=source,fstype,size,used,avail,target {self.name}*"
+            return None
 
-        parser = CommandParser.execute(df_command)
+    def _search_volumes(self, storage, holders):
+        devices = [self.path]
+        try:
+            devices += [
+                os.path.join(self.path, entry) for entry in sorted(os.listdir(self.path))
+                if os.path.exists(os.path.join(self.path, entry, "partition"))
+            ]
+        except OSError:
+            pass
+        devices += [os.path.join(storage.sys_block, h) for h in holders]
 
         volumes = []
-        for volume in parser.list(regex, "name", "type", "total_blocks", "used_blocks", "available_blocks", "mount_point").all():
-            volumes.append(Volume(**volume))
+        for device in devices:
+            mount = storage.mounts.get(read_text(os.path.join(device, "dev")))
+            if mount is None:
+                mount = storage.source_mounts.get(os.path.basename(device))
+            if mount is None:
+                continue
+            source, fs_type, mount_point = mount
+            name = source if source.startswith("/dev/") else f"/dev/{os.path.basename(device)}"
+            volumes.append(Volume.from_mount(name, fs_type, mount_point))
         return volumes
 
-    def search(self, regex, group):
-        return self.info_parser.get(regex, key=group)
+    def _sysfs_info(self):
+        device = os.path.join(self.path, "device")
+        return {
+            "model": read_text(os.path.join(device, "model")) or None,
+            "serial_number": read_text(os.path.join(device, "serial")) or read_text(os.path.join(self.path, "serial")) or None,
+            "form_factor": None,
+            "rotation_rate": None,
+        }
+
+    def _probe_info(self):
+        info = self._sysfs_info()
+
+        # hdparm is only needed for what sysfs doesn't expose, the rpm of spinning disks and missing identifiers
+        if info["model"] and info["serial_number"] and not self.rotational:
+            return info
+
+        # hdparm can hang on a failing disk
+        parser = CommandParser.execute(f"hdparm -I {self.name}", timeout=15)
+
+        try:
+            rotation_rate = int(parser.get(r'Nominal Media Rotation Rate:\s+(?P<rotation_rate>.*)\n', key="rotation_rate"))
+        except (TypeError, ValueError):
+            rotation_rate = None
+
+        info.update({
+            "model": info["model"] or parser.get(r'Model Number:\s+(?P<model>.*)\n', key="model"),
+            "serial_number": info["serial_number"] or parser.get(r'Serial Number:\s+(?P<serial>.*)\n', key="serial"),
+            "form_factor": parser.get(r'Form Factor:\s+(?P<form_factor>.*)\n', key="form_factor"),
+            "rotation_rate": rotation_rate,
+        })
+        # return None when nothing was found so the probe is retried next time
+        return info if any(v is not None for v in info.values()) else None
 
     @property
     def model(self):
-        return self.search(r'Model Number:\s+(?P<model>.*)\n', "model")
+        return self.info.get("model")
 
     @property
     def serial_number(self):
-        return self.search(r'Serial Number:\s+(?P<serial>.*)\n', "serial")
+        return self.info.get("serial_number")
 
     @property
     def form_factor(self):
-        return self.search(r'Form Factor:\s+(?P<form_factor>.*)\n', "form_factor")
+        return self.info.get("form_factor")
 
     @property
     def rotation_rate(self):
-        try:
-            return int(self.search(r'Nominal Media Rotation Rate:\s+(?P<rotation_rate>.*)\n', "rotation_rate"))
-        except (TypeError, ValueError):
-            return None
+        return self.info.get("rotation_rate")
 
     def to_dict(self):
-        fields = ["name", "model", "serial_number", "form_factor", "rotation_rate", "total_size"]
+        fields = ["name", "model", "serial_number", "form_factor", "rotation_rate", "rotational", "total_size"]
         output = {
             attr: getattr(self, attr, None) for attr in fields
         }
@@ -148,8 +304,12 @@ class Disk:
 class Network:
 
     def __init__(self):
-        self.gateways = {i[1]: i[0] for i in netifaces.gateways().get(netifaces.AF_INET)}
-        default_gateway = netifaces.gateways().get("default").get(netifaces.AF_INET)
+        # netifaces is only needed when the netlink listener isn't available, don't import it at startup
+        import netifaces
+
+        gateways = netifaces.gateways()
+        self.gateways = {i[1]: i[0] for i in gateways.get(netifaces.AF_INET, [])}
+        default_gateway = gateways.get("default", {}).get(netifaces.AF_INET)
         self.default_interface = default_gateway[1] if default_gateway else None
         self.default_gateway = default_gateway[0] if default_gateway else None
         self.interfaces = [Interface(i) for i in netifaces.interfaces()]
@@ -167,8 +327,13 @@ class Network:
 class Interface:
 
     def __init__(self, name):
+        import netifaces
+
         self.name = name
-        self.obj = netifaces.ifaddresses(name)
+        addresses = netifaces.ifaddresses(name)
+        self.inet = addresses.get(netifaces.AF_INET, [])
+        self.inet6 = addresses.get(netifaces.AF_INET6, [])
+        self.link = addresses.get(netifaces.AF_LINK, [])
 
     @property
     def ipv4_addresses(self):
@@ -179,45 +344,550 @@ class Interface:
                 'netmask',
                 addr='address'
             ),
-            self.obj.get(netifaces.AF_INET, [])
+            self.inet
         ))
 
+    @property
+    def ipv6_addresses(self):
+        return [
+            {
+                # link local addresses are reported with the %<interface> scope
+                "address": (addr.get("addr") or "").split("%", 1)[0],
+                "prefixlen": self._prefixlen(addr.get("netmask")),
+            }
+            for addr in self.inet6
+        ]
+
+    @staticmethod
+    def _prefixlen(netmask):
+        # netifaces formats ipv6 netmasks as ffff:ffff:ffff:ffff::/64
+        try:
+            return int((netmask or "").rsplit("/", 1)[1])
+        except (IndexError, ValueError):
+            return None
+
     @property
     def mac_address(self):
-        macs = self.obj.get(netifaces.AF_LINK, [])
-        if macs:
-            return macs[0].get('addr')
+        if self.link:
+            return self.link[0].get('addr')
         return None
 
     def to_dict(self, **extra):
         return {
             "name": self.name,
             "ipv4_addresses": self.ipv4_addresses,
+            "ipv6_addresses": self.ipv6_addresses,
             "mac_address": self.mac_address,
             **extra
         }
 
 
+class NetlinkMonitor:
+
+    """
+    Keep an in-memory model of interfaces, addresses and routes up to date from rtnetlink events
+    The model is seeded with a dump of the current state, after that only kernel notifications are applied
+    on_change is called once changes have settled for the debounce period
+    """
+
+    RTMGRP_LINK = 0x1
+    RTMGRP_IPV4_IFADDR = 0x10
+    RTMGRP_IPV4_ROUTE = 0x40
+    RTMGRP_IPV6_IFADDR = 0x100
+
+    NLMSG_ERROR = 2
+    NLMSG_DONE = 3
+    NLM_F_REQUEST = 0x1
+    NLM_F_DUMP = 0x300
+
+    RTM_NEWLINK, RTM_DELLINK, RTM_GETLINK = 16, 17, 18
+    RTM_NEWADDR, RTM_DELADDR, RTM_GETADDR = 20, 21, 22
+    RTM_NEWROUTE, RTM_DELROUTE, RTM_GETROUTE = 24, 25, 26
+
+    IFLA_ADDRESS, IFLA_IFNAME = 1, 3
+    IFA_ADDRESS, IFA_LOCAL, IFA_BROADCAST = 1, 2, 4
+    RTA_DST, RTA_OIF, RTA_GATEWAY, RTA_PRIORITY, RTA_TABLE = 1, 4, 5, 6, 15
+    RT_TABLE_MAIN = 254
+
+    nlmsghdr = struct.Struct("=LHHLL")
+    rtattr = struct.Struct("=HH")
+    ifinfomsg = struct.Struct("=BxHiII")
+    ifaddrmsg = struct.Struct("=BBBBI")
+    rtmsg = struct.Struct("=BBBBBBBBI")
+
+    def __init__(self, on_change, debounce=2.0):
+        self.on_change = on_change
+        self.debounce = debounce
+        self.running = False
+        self._sock = None
+        self._thread = None
+        self._lock = Lock()
+        self._seq = 0
+        self._changed_at = None
+
+        # ifindex -> {"name", "mac", "ipv4": {addr: info}, "ipv6": {addr: info}}
+        self.links = {}
+        # (family, dst, dst_len, oif, metric) -> gateway
+        self.routes = {}
+
+    def start(self):
+        """
+        Open the netlink socket and load the current state
+        Returns False when netlink isn't available so the caller can fall back to netifaces
+        """
+        groups = self.RTMGRP_LINK | self.RTMGRP_IPV4_IFADDR | self.RTMGRP_IPV6_IFADDR | self.RTMGRP_IPV4_ROUTE
+        try:
+            # subscribe before dumping so no change between the dump and the subscription is missed
+            self._sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+            self._sock.bind((0, groups))
+            for request in (self.RTM_GETLINK, self.RTM_GETADDR, self.RTM_GETROUTE):
+                self._dump(request)
+            # the initial state is sent with the full sync, it isn't a change
+            self._changed_at = None
+        except (AttributeError, OSError) as e:
+            logger.warning(f"Netlink monitoring is unavailable ({e})")
+            self.close()
+            return False
+
+        self.running = True
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self):
+        self.running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.close()
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def _dump(self, msg_type):
+        self._seq += 1
+        # rtgenmsg is a single family byte, padded to 4 bytes
+        body = struct.pack("=Bxxx", socket.AF_UNSPEC)
+        header = self.nlmsghdr.pack(self.nlmsghdr.size + len(body), msg_type, self.NLM_F_REQUEST | self.NLM_F_DUMP, self._seq, 0)
+
+        with socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE) as sock:
+            sock.bind((0, 0))
+            sock.send(header + body)
+            done = False
+            while not done:
+                done = self._handle(sock.recv(65536))
+
+    def _run(self):
+        while self.running:
+            try:
+                r, _, _ = select.select([self._sock], [], [], 0.5)
+                if r:
+                    self._handle(self._sock.recv(65536))
+            except OSError as e:
+                logger.error(f"Error reading netlink socket ({e})")
+                break
+
+            if self._changed_at is not None and time.monotonic() - self._changed_at >= self.debounce:
+                self._changed_at = None
+                try:
+                    self.on_change()
+                except Exception:
+                    logger.exception("Error handling network change")
+
+        self.running = False
+
+    def _attributes(self, data, offset):
+        attrs = {}
+        while offset + self.rtattr.size <= len(data):
+            length, attr_type = self.rtattr.unpack_from(data, offset)
+            if length < self.rtattr.size:
+                break
+            attrs[attr_type] = data[offset + self.rtattr.size:offset + length]
+            offset += (length + 3) & ~3
+        return attrs
+
+    def _handle(self, data):
+        """
+        Apply every message in a netlink datagram to the model, returns True at the end of a dump
+        """
+        offset = 0
+        while offset + self.nlmsghdr.size <= len(data):
+            length, msg_type, _flags, _seq, _pid = self.nlmsghdr.unpack_from(data, offset)
+            if length < self.nlmsghdr.size:
+                break
+            message = data[offset + self.nlmsghdr.size:offset + length]
+            offset += (length + 3) & ~3
+
+            if msg_type == self.NLMSG_DONE:
+                return True
+            if msg_type == self.NLMSG_ERROR:
+                return True
+
+            with self._lock:
+                if msg_type in (self.RTM_NEWLINK, self.RTM_DELLINK):
+                    self._link(msg_type, message)
+                elif msg_type in (self.RTM_NEWADDR, self.RTM_DELADDR):
+                    self._address(msg_type, message)
+                elif msg_type in (self.RTM_NEWROUTE, self.RTM_DELROUTE):
+                    self._route(msg_type, message)
+                else:
+                    continue
+            self._changed_at = time.monotonic()
+        return False
+
+    def _link(self, msg_type, message):
+        _family, _type, index, _flags, _change = self.ifinfomsg.unpack_from(message)
+        if msg_type == self.RTM_DELLINK:
+            self.links.pop(index, None)
+            return
+
+        attrs = self._attributes(message, self.ifinfomsg.size)
+        link = self.links.setdefault(index, {"name": None, "mac": None, "ipv4": {}, "ipv6": {}})
+        if self.IFLA_IFNAME in attrs:
+            link["name"] = attrs[self.IFLA_IFNAME].rstrip(b"\x00").decode()
+        if self.IFLA_ADDRESS in attrs:
+            link["mac"] = ":".join(f"{b:02x}" for b in attrs[self.IFLA_ADDRESS])
+
+    def _address(self, msg_type, message):
+        family, prefixlen, _flags, _scope, index = self.ifaddrmsg.unpack_from(message)
+        attrs = self._attributes(message, self.ifaddrmsg.size)
+
+        # IFA_LOCAL is the interface address, IFA_ADDRESS is the peer on point to point links
+        raw = attrs.get(self.IFA_LOCAL) or attrs.get(self.IFA_ADDRESS)
+        if raw is None or family not in (socket.AF_INET, socket.AF_INET6):
+            return
+        address = socket.inet_ntop(family, raw)
+        key = "ipv4" if family == socket.AF_INET else "ipv6"
+        link = self.links.setdefault(index, {"name": None, "mac": None, "ipv4": {}, "ipv6": {}})
+
+        if msg_type == self.RTM_DELADDR:
+            link[key].pop(address, None)
+            return
+
+        if family == socket.AF_INET:
+            broadcast = attrs.get(self.IFA_BROADCAST)
+            link[key][address] = {
+                "broadcast": socket.inet_ntop(family, broadcast) if broadcast else None,
+                "netmask": str(ipaddress.IPv4Network(f"0.0.0.0/{prefixlen}").netmask),
+                "address": address,
+            }
+        else:
+            link[key][address] = {"address": address, "prefixlen": prefixlen}
+
+    def _route(self, msg_type, message):
+        family, dst_len, _src_len, _tos, table, _protocol, _scope, _type, _flags = self.rtmsg.unpack_from(message)
+        attrs = self._attributes(message, self.rtmsg.size)
+        if self.RTA_TABLE in attrs:
+            table = struct.unpack("=I", attrs[self.RTA_TABLE][:4])[0]
+        if table != self.RT_TABLE_MAIN or self.RTA_GATEWAY not in attrs:
+            return
+
+        dst = socket.inet_ntop(family, attrs[self.RTA_DST]) if self.RTA_DST in attrs else None
+        oif = struct.unpack("=i", attrs[self.RTA_OIF][:4])[0] if self.RTA_OIF in attrs else None
+        # routes that only differ by metric are separate routes
+        metric = struct.unpack("=I", attrs[self.RTA_PRIORITY][:4])[0] if self.RTA_PRIORITY in attrs else 0
+        key = (family, dst, dst_len, oif, metric)
+
+        if msg_type == self.RTM_DELROUTE:
+            self.routes.pop(key, None)
+        else:
+            self.routes[key] = socket.inet_ntop(family, attrs[self.RTA_GATEWAY])
+
+    def to_dict(self):
+        """
+        Same shape as Network.to_dict
+        The default route is the one with the lowest metric, like the kernel picks it
+        """
+        with self._lock:
+            gateways = {}
+            default_interface = default_gateway = None
+            # default routes first, then by metric
+            routes = sorted(self.routes.items(), key=lambda i: (i[0][2], i[0][4], str(i[0])))
+            for (family, _dst, dst_len, oif, _metric), gateway in routes:
+                if family != socket.AF_INET:
+                    continue
+                gateways.setdefault(oif, gateway)
+                if dst_len == 0 and default_gateway is None:
+                    default_interface, default_gateway = oif, gateway
+
+            return {
+                "interfaces": [
+                    {
+                        "name": link["name"],
+                        "ipv4_addresses": list(link["ipv4"].values()),
+                        "ipv6_addresses": list(link["ipv6"].values()),
+                        "mac_address": link["mac"],
+                        "default": index == default_interface,
+                        "gateway": gateways.get(index),
+                    }
+                    for index, link in sorted(self.links.items()) if link["name"]
+                ],
+                "default_gateway": default_gateway
+            }
+
+
+class Packages:
+
+    """
+    Installed package inventory
+    The dpkg status file is parsed one paragraph at a time, rpm systems are queried with the rpm command
+    Results are kept until the package database file's mtime or size changes
+    """
+
+    dpkg_status_file = "/var/lib/dpkg/status"
+    rpm_db_dir = "/var/lib/rpm"
+
+    # the database is rewritten in place so the directory's mtime doesn't change, the files are checked instead
+    # newer rpm uses sqlite (with a write ahead log), older rpm a berkeley db
+    rpm_db_files = [("rpmdb.sqlite", "rpmdb.sqlite-wal"), ("Packages",)]
+
+    def __init__(self):
+        self._cache = {}
+
+    @staticmethod
+    def _stat(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def _signature(self, paths):
+        """
+        The mtime and size of each file, None if the first (the database itself) doesn't exist
+        """
+        signature = tuple(self._stat(path) for path in paths)
+        return signature if signature[0] is not None else None
+
+    def _rpm_db_paths(self):
+        for names in self.rpm_db_files:
+            paths = [os.path.join(self.rpm_db_dir, name) for name in names]
+            if os.path.exists(paths[0]):
+                return paths
+        return [os.path.join(self.rpm_db_dir, self.rpm_db_files[0][0])]
+
+    def _cached(self, name, paths, collect):
+        signature = self._signature(paths)
+        if signature is None:
+            return None
+        cached = self._cache.get(name)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        packages = collect()
+        self._cache[name] = (signature, packages)
+        return packages
+
+    def _parse_dpkg(self):
+        packages = {}
+        fields = {}
+
+        def add(fields):
+            # only count packages that are fully installed, not removed packages with config left behind
+            if fields.get("Status", "").endswith(" installed") and "Package" in fields:
+                packages[f"{fields['Package']}:{fields.get('Architecture', 'all')}"] = fields.get("Version")
+
+        try:
+            with open(self.dpkg_status_file, "r", errors="replace") as infile:
+                for line in infile:
+                    if line == "\n":
+                        add(fields)
+                        fields = {}
+                    elif not line[0].isspace():
+                        key, _, value = line.partition(":")
+                        if key in ("Package", "Status", "Version", "Architecture"):
+                            fields[key] = value.strip()
+            add(fields)
+        except OSError as e:
+            logger.error(f"Error reading {self.dpkg_status_file} ({e})")
+        return packages
+
+    def _query_rpm(self):
+        # thousands of packages, parsed as rpm prints them instead of buffering the whole output
+        parser = CommandParser.stream(
+            "rpm -qa --queryformat '%{NAME}:%{ARCH}\\t%{EPOCHNUM}:%{VERSION}-%{RELEASE}\\n'",
+            timeout=120
+        ).list(r"^([^\t]+)\t(.+)$", "name", "version")
+        return {package["name"]: package["version"] for package in parser.all()}
+
+    def to_dict(self):
+        output = {}
+        dpkg = self._cached("dpkg", [self.dpkg_status_file], self._parse_dpkg)
+        if dpkg is not None:
+            output["dpkg"] = dpkg
+        rpm = self._cached("rpm", self._rpm_db_paths(), self._query_rpm)
+        if rpm is not None:
+            output["rpm"] = rpm
+        return output
+
+
+class SectionCache:
+
+    """
+    Keep collected inventory sections for a short time
+    A section that is requested while it's already being collected waits for that collection
+    instead of starting another one
+    Values are returned with the monotonic time their collection started, so callers can tell
+    which of two collections saw the newer state
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._values = {}
+        self._inflight = {}
+
+    def get(self, key, collect, max_age=0):
+        with self._lock:
+            cached = self._values.get(key)
+            if cached is not None and time.monotonic() - cached[0] <= max_age:
+                return cached
+
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self._inflight[key] = Future()
+
+        if not owner:
+            return future.result()
+
+        try:
+            started = time.monotonic()
+            result = (started, collect())
+            with self._lock:
+                self._values[key] = result
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+
 @register_module()
 class SystemSync(Module):
 
+    """
+    Sync system inventory with the server
+    A full snapshot is sent at startup, after that the inventory is re-collected every interval
+    and only the changes against the last snapshot acknowledged by the server are sent
+    The server can ask for a refresh of some sections (or single system fields like system.hostname),
+    sections collected within max_age seconds are served from the cache
+    """
+
     name = "sync"
     event_keys = ["sync"]
 
+    # seconds between inventory collections, overridden with the sync_interval config key
+    default_interval = 300
+
+    # number of unacknowledged snapshots to keep as potential diff bases
+    max_pending = 5
+
+    sections = ["system", "network", "storage", "packages"]
+
+    # seconds a collected section is fresh enough for a refresh requested by the server
+    default_max_age = 15
+
     def __init__(self, core, queue):
         super().__init__(core, queue)
         self._thread = Thread(target=self._run)
+        self._wake = Event()
+        self._version = 0
+        self._pending = {}
+        self._acked = None
+        self._acked_version = None
+        self._last_sent_hash = None
+        self._full_resync = False
+        self._sync_lock = Lock()
+        self._netlink = NetlinkMonitor(on_change=self._network_changed)
+        self._packages = Packages()
+        self._cache = SectionCache()
+        # when the collection of each merged section or system field started
+        self._collected_at = {}
+
+    @property
+    def interval(self):
+        try:
+            return int(self.core.config.get("sync_interval", self.default_interval))
+        except (AttributeError, TypeError, ValueError):
+            return self.default_interval
 
     def startup(self):
         super().startup()
+        self._netlink.start()
         self._thread.start()
 
     def shutdown(self):
         super().shutdown()
+        self._netlink.stop()
+        self._wake.set()
         self._thread.join()
 
     def event(self, ev):
-        pass
+        if not isinstance(ev, dict):
+            return
+
+        _type = ev.get("type")
+        _data = ev.get("data") or {}
+
+        if _type == "syncack":
+            self.acknowledge(_data.get("version"))
+
+        elif _type == "resync":
+            # the server lost track of our state, send everything on the next run
+            self._full_resync = True
+            self._wake.set()
+
+        elif _type == "sync":
+            # collecting can take a while, don't hold up the websocket
+            Thread(target=self._requested_sync, args=(_data,), daemon=True).start()
+
+    def _requested_sync(self, data):
+        keys = data.get("sections")
+        if isinstance(keys, str):
+            keys = [keys]
+        elif keys is not None and not isinstance(keys, list):
+            logger.warning(f"Ignoring sync request with invalid sections {keys!r}")
+            return
+        if keys is not None:
+            unknown = [key for key in keys if not isinstance(key, str) or key.split(".", 1)[0] not in self.sections]
+            if unknown:
+                logger.warning(f"Ignoring unknown sync sections {unknown}")
+            keys = [key for key in keys if key not in unknown]
+
+        try:
+            max_age = float(data.get("max_age", self.default_max_age))
+            self.sync(sections=keys, max_age=max_age)
+        except Exception:
+            logger.exception("Error syncing requested sections")
+            return
+
+        self.bulk_queue.put({
+            "type": "sync",
+            "data": {
+                "type": "syncdone",
+                "data": {
+                    "id": data.get("id"),
+                    "sections": keys,
+                    "version": self._version,
+                }
+            }
+        })
+
+    def acknowledge(self, version):
+        # acks arrive on the websocket thread, the diff base mustn't change while a delta is being built
+        with self._sync_lock:
+            snapshot = self._pending.get(version)
+            if snapshot is None:
+                logger.debug(f"Ignoring acknowledgement for unknown sync version {version}")
+                return
+            self._acked = snapshot
+            self._acked_version = version
+            # anything older than the acknowledged version can't be a diff base anymore
+            self._pending = {v: s for v, s in self._pending.items() if v > version}
 
     def _system_info(self):
         if self.core and self.core.info:
@@ -225,21 +895,158 @@ class SystemSync(Module):
         return None
 
     def _network(self):
+        if self._netlink.running:
+            return self._netlink.to_dict()
         return Network().to_dict()
 
+    def _network_changed(self):
+        logger.debug("Network changed, syncing network section")
+        self.sync(sections=["network"])
+
     def _storage(self):
-        return Storage().to_dict()
+        return Storage(cache=getattr(self.core, "inventory_cache", None)).to_dict()
+
+    def _installed_packages(self):
+        return self._packages.to_dict()
+
+    def _system_field(self, field):
+        if self.core and self.core.info:
+            return self.core.info.get(field)
+        return None
+
+    def _latest(self):
+        return self._pending.get(self._version) or self._acked
+
+    def _collect(self, keys=None, max_age=0):
+        """
+        Collect the requested sections and system fields through the cache
+        Returns {section: (collected_at, value)} and {(section, field): (collected_at, value)}
+        """
+        collectors = {
+            "system": self._system_info,
+            "network": self._network,
+            "storage": self._storage,
+            "packages": self._installed_packages,
+        }
+        if keys is None or self._latest() is None:
+            keys = self.sections
+
+        sections, fields = {}, {}
+        for key in keys:
+            section, _, field = key.partition(".")
+            if field and section == "system" and field in getattr(getattr(self.core, "info", None), "fields", []):
+                fields[(section, field)] = self._cache.get(key, lambda: self._system_field(field), max_age)
+            elif section not in sections:
+                # other sections are collected whole
+                sections[section] = self._cache.get(section, collectors[section], max_age)
+        return sections, fields
+
+    def _merge(self, sections, fields):
+        """
+        Build a snapshot from the collected values, reusing the last snapshot for everything else
+        Collections run outside of the sync lock, a value whose collection started before the one
+        already merged is older and is dropped, called with the sync lock held
+        """
+        never = float("-inf")
+        latest = self._latest() or {}
+        snapshot = dict(latest)
+        for section, (collected_at, value) in sections.items():
+            if collected_at < self._collected_at.get(section, never):
+                logger.debug(f"Dropping stale {section} section")
+                continue
+            self._collected_at[section] = collected_at
+            # system fields refreshed after this collection started keep their newer value
+            newer = [key.partition(".")[2] for key, at in self._collected_at.items()
+                     if key.startswith(f"{section}.") and at > collected_at]
+            current = latest.get(section) or {}
+            if isinstance(value, dict) and newer:
+                value = {**value, **{field: current[field] for field in newer if field in current}}
+            snapshot[section] = value
+
+        for (section, field), (collected_at, value) in fields.items():
+            if section in sections:
+                continue
+            key = f"{section}.{field}"
+            if collected_at < max(self._collected_at.get(section, never), self._collected_at.get(key, never)):
+                logger.debug(f"Dropping stale {key} field")
+                continue
+            self._collected_at[key] = collected_at
+            snapshot[section] = {**(snapshot.get(section) or {}), field: value}
+        return {section: snapshot.get(section) for section in self.sections}
+
+    @staticmethod
+    def _delta(base, snapshot):
+        """
+        Build the patch against the base snapshot, skipping sections whose hash is unchanged
+        """
+        patch = []
+        for section, value in snapshot.items():
+            previous = base.get(section)
+            if json_hash(previous) != json_hash(value):
+                patch.extend(json_diff(previous, value, f"/{section}"))
+        return patch
+
+    def sync(self, sections=None, max_age=0):
+        # collect outside of the lock so requests for different sections don't wait for each other
+        collected = self._collect(sections, max_age)
+        with self._sync_lock:
+            self._sync(self._merge(*collected))
+
+    def _sync(self, snapshot):
+        """
+        Send a snapshot as a full inventory or a delta, called with the sync lock held
+        """
+        snapshot_hash = json_hash(snapshot)
+
+        if snapshot_hash == self._last_sent_hash and not self._full_resync:
+            logger.debug("Inventory unchanged since last sync")
+            return
+
+        self._version += 1
+        self._pending[self._version] = snapshot
+        if len(self._pending) > self.max_pending:
+            self._pending.pop(min(self._pending))
+
+        # the patch and its base label have to come from the same acknowledged snapshot
+        base, base_version = self._acked, self._acked_version
+
+        if base is None or self._full_resync:
+            self.bulk_queue.put({
+                "type": "sync",
+                "data": {
+                    **snapshot,
+                    "version": self._version,
+                }
+            })
+            self._full_resync = False
+            logger.debug(f"Sent full inventory version {self._version}")
+        else:
+            patch = self._delta(base, snapshot)
+            self.bulk_queue.put({
+                "type": "sync",
+                "data": {
+                    "type": "syncdelta",
+                    "data": {
+                        "base": base_version,
+                        "version": self._version,
+                        "patch": patch,
+                    }
+                }
+            })
+            logger.debug(f"Sent inventory delta {base_version} -> {self._version} ({len(patch)} changes)")
+
+        self._last_sent_hash = snapshot_hash
 
     def _run(self):
         logger.debug("Starting system info sync")
-        self.queue.put({
-            "type": "sync",
-            "data": {
-                "system": self._system_info(),
-                "network": self._network(),
-                "storage": self._storage(),
-            }
-        })
+        while self.running:
+            try:
+                self.sync()
+            except Exception:
+                logger.exception("Error syncing system info")
+
+            self._wake.wait(self.interval)
+            self._wake.clear()
         logger.debug("Finished with system info sync")
 
 
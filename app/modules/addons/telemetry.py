@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+import logging
+import os
+import time
+from array import array
+from threading import Thread, Event
+from modules.util import register_module, Module, read_text
+
+
+logger = logging.getLogger(__name__)
+
+
+class RingBuffer:
+
+    """
+    Fixed size buffer of float samples, once full the oldest samples are overwritten
+    """
+
+    def __init__(self, capacity):
+        self.capacity = max(1, capacity)
+        self._values = array("d", bytes(8 * self.capacity))
+        self._index = 0
+        self.count = 0
+
+    def push(self, value):
+        self._values[self._index] = value
+        self._index = (self._index + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def clear(self):
+        self._index = 0
+        self.count = 0
+
+    def rollup(self):
+        """
+        Return [min, avg, max] of the buffered samples
+        """
+        if not self.count:
+            return None
+        values = self._values[:self.count] if self.count < self.capacity else self._values
+        return [round(min(values), 3), round(sum(values) / self.count, 3), round(max(values), 3)]
+
+
+class HostSampler:
+
+    """
+    Sample host counters from /proc, counters are turned into rates against the previous sample
+    """
+
+    proc_dir = "/proc"
+    sys_block = "/sys/block"
+
+    def __init__(self):
+        self._previous = {}
+        self._previous_time = None
+        # block device name -> whether it is a whole physical disk, for the devices in the last sample
+        self._disks = {}
+
+    def _is_disk(self, name, disks):
+        # only report whole physical disks, not partitions or loop / ram devices
+        if name not in disks:
+            known = self._disks.get(name)
+            disks[name] = os.path.exists(os.path.join(self.sys_block, name, "device")) if known is None else known
+        return disks[name]
+
+    def _read(self, name):
+        return read_text(os.path.join(self.proc_dir, name)) or ""
+
+    def _counters(self):
+        counters = {}
+
+        # aggregate cpu jiffies: user nice system idle iowait irq softirq steal
+        for line in self._read("stat").splitlines():
+            if line.startswith("cpu "):
+                values = [int(v) for v in line.split()[1:9]]
+                counters["cpu.busy"] = sum(values) - values[3] - values[4]
+                counters["cpu.total"] = sum(values)
+                break
+
+        # devices come and go, only the ones still listed are remembered
+        disks = {}
+        for line in self._read("diskstats").splitlines():
+            fields = line.split()
+            if len(fields) >= 10 and self._is_disk(fields[2], disks):
+                # sectors are always 512 bytes in diskstats
+                counters[f"disk.{fields[2]}.read"] = int(fields[5]) * 512
+                counters[f"disk.{fields[2]}.write"] = int(fields[9]) * 512
+        self._disks = disks
+
+        for line in self._read("net/dev").splitlines()[2:]:
+            name, _, values = line.partition(":")
+            name = name.strip()
+            fields = values.split()
+            if name != "lo" and len(fields) >= 9:
+                counters[f"net.{name}.rx"] = int(fields[0])
+                counters[f"net.{name}.tx"] = int(fields[8])
+
+        return counters
+
+    def _gauges(self):
+        gauges = {}
+
+        meminfo = {}
+        for line in self._read("meminfo").splitlines():
+            key, _, value = line.partition(":")
+            if key in ("MemTotal", "MemAvailable"):
+                meminfo[key] = int(value.split()[0]) * 1024
+        if meminfo.get("MemTotal"):
+            used = meminfo["MemTotal"] - meminfo.get("MemAvailable", 0)
+            gauges["mem.used"] = used
+            gauges["mem.percent"] = 100.0 * used / meminfo["MemTotal"]
+
+        loadavg = self._read("loadavg").split()
+        if loadavg:
+            gauges["load.1"] = float(loadavg[0])
+
+        return gauges
+
+    def sample(self):
+        """
+        Return a dict of metric name -> value, rates need two samples so the first call only has gauges
+        """
+        now = time.monotonic()
+        counters = self._counters()
+        metrics = self._gauges()
+
+        if self._previous_time is not None:
+            elapsed = now - self._previous_time
+            previous = self._previous
+
+            cpu_total = counters.get("cpu.total", 0) - previous.get("cpu.total", 0)
+            if cpu_total > 0:
+                metrics["cpu.percent"] = 100.0 * (counters["cpu.busy"] - previous.get("cpu.busy", 0)) / cpu_total
+
+            for key, value in counters.items():
+                if key.startswith("cpu.") or key not in previous or elapsed <= 0:
+                    continue
+                # counters are converted to bytes per second
+                metrics[key] = max(0, value - previous[key]) / elapsed
+
+        self._previous = counters
+        self._previous_time = now
+        return metrics
+
+
+@register_module()
+class Telemetry(Module):
+
+    """
+    Sample live host metrics and upload them as min / avg / max rollups
+    The server can switch to streaming every sample while someone is watching the device,
+    streaming stops when the server turns it off or the lease runs out
+    """
+
+    name = "telemetry"
+    event_keys = ["telemetry"]
+
+    # seconds between samples and between rollup uploads, overridden with config keys
+    default_sample_interval = 1.0
+    default_rollup_interval = 30.0
+
+    # seconds a streaming request lasts unless the server renews it
+    stream_lease = 60.0
+
+    def __init__(self, core, queue):
+        super().__init__(core, queue)
+        self._thread = None
+        self._wake = Event()
+        self.sampler = HostSampler()
+        self.buffers = {}
+        self.streaming_until = 0.0
+
+    def _config(self, key, default):
+        try:
+            return float(self.core.config.get(key, default))
+        except (AttributeError, TypeError, ValueError):
+            return default
+
+    @property
+    def sample_interval(self):
+        return self._config("telemetry_sample_interval", self.default_sample_interval)
+
+    @property
+    def rollup_interval(self):
+        return self._config("telemetry_rollup_interval", self.default_rollup_interval)
+
+    @property
+    def streaming(self):
+        return time.monotonic() < self.streaming_until
+
+    def startup(self):
+        super().startup()
+        self._thread = Thread(target=self._run)
+        self._thread.start()
+
+    def shutdown(self):
+        super().shutdown()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def event(self, ev):
+        if not isinstance(ev, dict):
+            return
+
+        _type = ev.get("type")
+        _data = ev.get("data") or {}
+
+        if _type == "stream":
+            if _data.get("enabled", True):
+                lease = float(_data.get("lease", self.stream_lease))
+                logger.info(f"Streaming telemetry for {lease} seconds")
+                self.streaming_until = time.monotonic() + lease
+            else:
+                logger.info("Stopped streaming telemetry")
+                self.streaming_until = 0.0
+
+    def _buffer(self, key):
+        buffer = self.buffers.get(key)
+        if buffer is None:
+            capacity = int(self.rollup_interval / self.sample_interval) + 1
+            buffer = self.buffers[key] = RingBuffer(capacity)
+        return buffer
+
+    def _send_rollup(self, started, ended):
+        metrics = {}
+        samples = 0
+        for key, buffer in list(self.buffers.items()):
+            rollup = buffer.rollup()
+            if rollup is None:
+                # interfaces and disks that are gone (veth, tun) don't keep their buffer
+                del self.buffers[key]
+                continue
+            metrics[key] = rollup
+            samples = max(samples, buffer.count)
+            buffer.clear()
+
+        if not metrics:
+            return
+
+        # rollups are small, on the bulk queue they would keep the bulk connection from going idle
+        self.queue.put({
+            "type": "telemetry",
+            "data": {
+                "type": "rollup",
+                "data": {
+                    "start": started,
+                    "end": ended,
+                    "samples": samples,
+                    "metrics": metrics
+                }
+            }
+        })
+
+    def _run(self):
+        logger.debug("Running telemetry loop")
+        rollup_started = time.time()
+        next_rollup = time.monotonic() + self.rollup_interval
+
+        while self.running:
+            try:
+                metrics = self.sampler.sample()
+                for key, value in metrics.items():
+                    self._buffer(key).push(value)
+
+                if self.streaming and metrics:
+                    self.queue.put({
+                        "type": "telemetry",
+                        "data": {
+                            "type": "sample",
+                            "data": {
+                                "time": time.time(),
+                                "metrics": {k: round(v, 3) for k, v in metrics.items()}
+                            }
+                        }
+                    })
+
+                if time.monotonic() >= next_rollup:
+                    now = time.time()
+                    self._send_rollup(rollup_started, now)
+                    rollup_started = now
+                    next_rollup = time.monotonic() + self.rollup_interval
+
+            except Exception:
+                logger.exception("Error sampling telemetry")
+
+            self._wake.wait(self.sample_interval)
+
+        logger.debug("Exit telemetry loop")
+
+
+if __name__ == "__main__":
+    pass
@@ -1,23 +1,155 @@
 #!/usr/bin/env python3
+import base64
+import codecs
+import gzip
+import json
 import logging
 import os
 import pty
+import queue
 import select
 import subprocess
 import sys
+import time
 from threading import Thread
 from modules.util import register_module, Module
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 
 logger = logging.getLogger(__name__)
 
 
+class SessionRecorder:
+
+    """
+    Record a shell session to disk in asciicast v2 format
+    PTY data is handed to a background writer through a bounded buffer,
+    if the writer falls behind the data is dropped and counted instead of blocking the shell
+    """
+
+    # maximum number of pending events before new events are dropped
+    buffer_size = 4096
+
+    # compressed bytes written to a recording file before rotating to a new file
+    max_file_size = 5_000_000
+
+    width = 80
+    height = 24
+
+    _stop = object()
+
+    def __init__(self, directory, session_id, record_input=False):
+        self.directory = directory
+        self.session_id = session_id
+        self.record_input = record_input
+        self.extension = ".cast.zst" if zstandard is not None else ".cast.gz"
+        self.dropped = 0
+        self.part = 0
+        self._buffer = queue.Queue(maxsize=self.buffer_size)
+        self._thread = None
+        self._raw = None
+        self._stream = None
+        self._started = None
+        # PTY reads can split a multibyte character, so each stream keeps its own decoder state
+        self._decoders = {
+            "o": codecs.getincrementaldecoder("utf-8")(errors="replace"),
+            "i": codecs.getincrementaldecoder("utf-8")(errors="replace"),
+        }
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._started = time.monotonic()
+        self._thread = Thread(target=self._write_loop, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        if self._thread is None:
+            return
+        try:
+            self._buffer.put(self._stop, timeout=5)
+        except queue.Full:
+            logger.warning(f"Recording buffer for session {self.session_id} is full, closing anyway")
+        self._thread.join(timeout=5)
+        self._thread = None
+        if self.dropped:
+            logger.warning(f"Recording for session {self.session_id} dropped {self.dropped} events")
+
+    def output(self, data):
+        self._put("o", data)
+
+    def input(self, data):
+        if self.record_input:
+            self._put("i", data)
+
+    def _put(self, code, data):
+        try:
+            self._buffer.put_nowait((time.monotonic() - self._started, code, data))
+        except queue.Full:
+            self.dropped += 1
+
+    def _path(self, part):
+        return os.path.join(self.directory, f"{self.session_id}.{part}{self.extension}")
+
+    def _open(self):
+        self._raw = open(self._path(self.part), "wb")
+        if zstandard is not None:
+            self._stream = zstandard.ZstdCompressor().stream_writer(self._raw)
+        else:
+            self._stream = gzip.GzipFile(fileobj=self._raw, mode="wb")
+
+        header = {
+            "version": 2,
+            "width": self.width,
+            "height": self.height,
+            "timestamp": int(time.time()),
+            "env": {"TERM": os.environ.get("TERM", "xterm"), "SHELL": "/bin/bash"},
+        }
+        self._stream.write(json.dumps(header).encode() + b"\n")
+
+    def _close_file(self):
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+        if self._raw is not None and not self._raw.closed:
+            self._raw.close()
+        self._raw = None
+
+    def _write_loop(self):
+        try:
+            self._open()
+            while True:
+                item = self._buffer.get()
+                if item is self._stop:
+                    break
+                offset, code, data = item
+                text = self._decoders[code].decode(data)
+                if not text:
+                    continue
+                line = json.dumps([round(offset, 6), code, text])
+                self._stream.write(line.encode() + b"\n")
+
+                if self._raw.tell() >= self.max_file_size:
+                    # rotate to the next part of the recording
+                    self._close_file()
+                    self.part += 1
+                    self._open()
+        except Exception:
+            logger.exception(f"Error writing recording for session {self.session_id}")
+        finally:
+            self._close_file()
+
+
 class Shell:
 
-    def __init__(self):
+    def __init__(self, recorder=None):
         self.i_r, self.i_w = os.pipe()
         self.o_r, self.o_w = os.pipe()
         self.running = False
+        self.recorder = recorder
 
     def close(self):
         # close the pipes
@@ -57,10 +189,14 @@ class Shell:
                     if len(x) == 0:
                         break
                     os.write(master_fd, x)
+                    if self.recorder:
+                        self.recorder.input(x)
                 if master_fd in r:
                     o = os.read(master_fd, 10240)
                     if o:
                         os.write(self.o_w, o)
+                        if self.recorder:
+                            self.recorder.output(o)
 
         except Exception as e:
             logger.exception(f"Exception raised in terminal ({e})")
@@ -82,6 +218,9 @@ class ShellManager(Module):
     name = "terminal"
     event_keys = ["td", "terminal"]
 
+    # bytes of a recording file per message
+    recording_chunk_size = 256 * 1024
+
     def __init__(self, core, queue):
         super().__init__(core, queue)
         self.shells = {}
@@ -128,6 +267,72 @@ class ShellManager(Module):
             _id = _data.get("id")
             self.close(_id)
 
+        elif _type == "listrecordings":
+            self.list_recordings()
+
+        elif _type == "getrecording":
+            # reading and encoding a large recording takes a while, don't hold up the websocket
+            Thread(target=self.get_recording, args=(_data.get("name"),), daemon=True).start()
+
+    @property
+    def recording_enabled(self):
+        return bool(self.core and self.core.config.get("terminal_recording", False))
+
+    @property
+    def recording_dir(self):
+        return os.path.join(self.core.config.base_dir, "recordings")
+
+    def list_recordings(self):
+        recordings = []
+        if os.path.isdir(self.recording_dir):
+            for name in sorted(os.listdir(self.recording_dir)):
+                path = os.path.join(self.recording_dir, name)
+                recordings.append({"name": name, "size": os.path.getsize(path), "modified": os.path.getmtime(path)})
+
+        self.queue.put({
+            "type": "terminal",
+            "data": {
+                "type": "recordings",
+                "data": recordings
+            }
+        })
+
+    def get_recording(self, name):
+        """
+        Send a recording file in base64 encoded chunks, the last chunk has last set
+        """
+        # only allow files directly inside of the recordings directory
+        path = os.path.join(self.recording_dir, os.path.basename(name or ""))
+        if not name or not os.path.isfile(path):
+            logger.warning(f"Requested recording {name} does not exist")
+            return
+
+        try:
+            size = os.path.getsize(path)
+            offset = 0
+            with open(path, "rb") as infile:
+                while True:
+                    chunk = infile.read(self.recording_chunk_size)
+                    last = offset + len(chunk) >= size or not chunk
+                    self.bulk_queue.put({
+                        "type": "terminal",
+                        "data": {
+                            "type": "recording",
+                            "data": {
+                                "name": os.path.basename(path),
+                                "size": size,
+                                "offset": offset,
+                                "content": base64.b64encode(chunk).decode(),
+                                "last": last
+                            }
+                        }
+                    })
+                    offset += len(chunk)
+                    if last:
+                        break
+        except OSError as e:
+            logger.error(f"Error sending recording {name} ({e})")
+
     def term_data(self, _id, data):
         if _id is not None and data is not None:
             if _id not in self.shells:
@@ -164,7 +369,17 @@ class ShellManager(Module):
 
     def _run(self, _id):
 
-        shell = Shell()
+        recorder = None
+        if self.recording_enabled:
+            session = f"{time.strftime('%Y%m%d-%H%M%S')}-{_id}"
+            recorder = SessionRecorder(
+                self.recording_dir,
+                session,
+                record_input=self.core.config.get("terminal_recording_input", False)
+            )
+            recorder.start()
+
+        shell = Shell(recorder=recorder)
 
         # set up tracking for this shell
         logger.debug(f"Setting shell id {_id} to {shell}")
@@ -185,6 +400,9 @@ class ShellManager(Module):
         # run the shell
         shell.run()
 
+        if recorder:
+            recorder.close()
+
         self.queue.put({
             "type": "terminal",
             "data": {
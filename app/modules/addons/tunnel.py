@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+import collections
+import errno
+import logging
+import os
+import selectors
+import socket
+import struct
+import time
+from threading import Thread
+from modules.util import register_module, Module
+
+
+logger = logging.getLogger(__name__)
+
+
+"""
+Stream data is sent as binary websocket frames in both directions
+
+    \x00 t | stream id (uint32) | data
+
+Opening, closing and flow control are json events, every stream starts with a window of
+initial_window bytes in each direction and the receiver grants more with window events
+"""
+
+
+class Stream:
+
+    header = struct.Struct(">ccI")
+
+    def __init__(self, stream_id, host, port, window):
+        self.id = stream_id
+        self.host = host
+        self.port = port
+        self.sock = None
+        self.connected = False
+
+        # bytes we are allowed to send to the server before it grants more
+        self.send_window = window
+        # data from the server waiting to be written to the local socket, with the time it arrived
+        self.pending = collections.deque()
+        self.pending_bytes = 0
+        # bytes written locally that haven't been granted back to the server yet
+        self.unacked = 0
+
+        self.local_eof = False
+        self.remote_eof = False
+        self.write_shutdown = False
+
+        self.opened_at = time.monotonic()
+        self.connect_time = None
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.latency_total = 0.0
+        self.latency_count = 0
+
+    def frame(self, data):
+        return self.header.pack(b"\x00", b"t", self.id) + data
+
+    def stats(self):
+        elapsed = max(time.monotonic() - self.opened_at, 1e-6)
+        return {
+            "id": self.id,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "duration": round(elapsed, 3),
+            "throughput": round((self.bytes_in + self.bytes_out) / elapsed, 1),
+            "connect_ms": round(self.connect_time * 1000, 3) if self.connect_time is not None else None,
+            # time from receiving data from the server until it was written to the local socket
+            "write_latency_ms": round(self.latency_total / self.latency_count * 1000, 3) if self.latency_count else None,
+        }
+
+
+@register_module()
+class Tunnel(Module):
+
+    """
+    Forward TCP connections opened on the device over the websocket
+    Every stream is relayed by a single selector loop with non-blocking sockets
+    """
+
+    name = "tunnel"
+    event_keys = ["tunnel"]
+    binary_keys = ["t"]
+
+    initial_window = 256 * 1024
+    read_size = 32 * 1024
+    max_streams = 64
+
+    def __init__(self, core, queue):
+        super().__init__(core, queue)
+        self.streams = {}
+        self.selector = None
+        self._thread = None
+        self._calls = collections.deque()
+        self._wake_r = self._wake_w = None
+
+    def startup(self):
+        super().startup()
+        self.selector = selectors.DefaultSelector()
+        self._wake_r, self._wake_w = os.pipe()
+        os.set_blocking(self._wake_r, False)
+        self.selector.register(self._wake_r, selectors.EVENT_READ, None)
+        self._thread = Thread(target=self._loop)
+        self._thread.start()
+
+    def shutdown(self):
+        super().shutdown()
+        self._wake()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def send(self, _type, data):
+        self.queue.put({
+            "type": "tunnel",
+            "data": {
+                "type": _type,
+                "data": data
+            }
+        })
+
+    # called from the websocket thread, all stream state is changed in the loop thread
+
+    def _call(self, fn, *args):
+        self._calls.append((fn, args))
+        self._wake()
+
+    def _wake(self):
+        if self._wake_w is not None:
+            try:
+                os.write(self._wake_w, b"\x00")
+            except OSError:
+                pass
+
+    def event(self, ev):
+        if not isinstance(ev, dict):
+            return
+
+        _type = ev.get("type")
+        _data = ev.get("data") or {}
+
+        if _type == "stats":
+            self._call(self._send_stats)
+            return
+
+        try:
+            stream_id = int(_data.get("id"))
+        except (TypeError, ValueError):
+            logger.warning(f"Tunnel event {_type} has an invalid stream id")
+            return
+
+        if _type == "open":
+            self._call(self._open, stream_id, _data.get("host", "127.0.0.1"), int(_data.get("port", 0)))
+        elif _type == "window":
+            self._call(self._grant, stream_id, int(_data.get("bytes", 0)))
+        elif _type == "eof":
+            self._call(self._remote_eof, stream_id)
+        elif _type == "close":
+            self._call(self._close, stream_id)
+
+    def binary_event(self, data):
+        if len(data) < Stream.header.size:
+            return
+        _, _, stream_id = Stream.header.unpack_from(data)
+        self._call(self._remote_data, stream_id, data[Stream.header.size:], time.monotonic())
+
+    # loop thread
+
+    def _loop(self):
+        logger.debug("Running tunnel loop")
+        while self.running:
+            for key, mask in self.selector.select(timeout=1):
+                if key.data is None:
+                    try:
+                        os.read(self._wake_r, 4096)
+                    except OSError:
+                        pass
+                    continue
+                stream = key.data
+                try:
+                    if mask & selectors.EVENT_WRITE:
+                        self._writable(stream)
+                    if mask & selectors.EVENT_READ and stream.id in self.streams:
+                        self._readable(stream)
+                except OSError as e:
+                    logger.debug(f"Tunnel stream {stream.id} error ({e})")
+                    self._close(stream.id, str(e))
+
+            while self._calls:
+                fn, args = self._calls.popleft()
+                try:
+                    fn(*args)
+                except Exception:
+                    logger.exception("Error handling tunnel event")
+
+        for stream_id in list(self.streams):
+            self._close(stream_id, "shutdown")
+        self.selector.close()
+        for fd in (self._wake_r, self._wake_w):
+            os.close(fd)
+        self._wake_r = self._wake_w = None
+        logger.debug("Exit tunnel loop")
+
+    def _update_interest(self, stream):
+        events = 0
+        if not stream.connected or stream.pending:
+            events |= selectors.EVENT_WRITE
+        if stream.connected and not stream.local_eof and stream.send_window > 0:
+            events |= selectors.EVENT_READ
+        key = self.selector.get_key(stream.sock) if stream.sock.fileno() in self.selector.get_map() else None
+        if events and key is None:
+            self.selector.register(stream.sock, events, stream)
+        elif events and key.events != events:
+            self.selector.modify(stream.sock, events, stream)
+        elif not events and key is not None:
+            self.selector.unregister(stream.sock)
+
+    def _open(self, stream_id, host, port):
+        if stream_id in self.streams:
+            self.send("openerror", {"id": stream_id, "error": "Stream id is already in use"})
+            return
+        if len(self.streams) >= self.max_streams:
+            self.send("openerror", {"id": stream_id, "error": "Too many open streams"})
+            return
+
+        stream = Stream(stream_id, host, port, self.initial_window)
+        try:
+            # resolving blocks, but only for host names, the common case is an ip on the device or its lan
+            family, socktype, proto, _, address = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)[0]
+            stream.sock = socket.socket(family, socktype, proto)
+            stream.sock.setblocking(False)
+            stream.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            result = stream.sock.connect_ex(address)
+            if result not in (0, errno.EINPROGRESS):
+                raise OSError(result, os.strerror(result))
+        except OSError as e:
+            if stream.sock:
+                stream.sock.close()
+            self.send("openerror", {"id": stream_id, "error": str(e)})
+            return
+
+        logger.info(f"Opening tunnel stream {stream_id} to {host}:{port}")
+        self.streams[stream_id] = stream
+        self._update_interest(stream)
+
+    def _writable(self, stream):
+        if not stream.connected:
+            error = stream.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error:
+                self.send("openerror", {"id": stream.id, "error": os.strerror(error)})
+                self._close(stream.id)
+                return
+            stream.connected = True
+            stream.connect_time = time.monotonic() - stream.opened_at
+            self.send("opened", {"id": stream.id, "window": self.initial_window})
+
+        while stream.pending:
+            data, received_at = stream.pending[0]
+            try:
+                sent = stream.sock.send(data)
+            except InterruptedError:
+                continue
+            except BlockingIOError:
+                # the local socket buffer is full, the rest is sent when the selector says it's writable
+                break
+            stream.bytes_in += sent
+            stream.pending_bytes -= sent
+            stream.unacked += sent
+            if sent < len(data):
+                stream.pending[0] = (data[sent:], received_at)
+                break
+            stream.pending.popleft()
+            stream.latency_total += time.monotonic() - received_at
+            stream.latency_count += 1
+
+        # give the server more room once half of the window has been written out
+        if stream.unacked >= self.initial_window // 2:
+            self.send("window", {"id": stream.id, "bytes": stream.unacked})
+            stream.unacked = 0
+
+        if not stream.pending and stream.remote_eof and not stream.write_shutdown:
+            stream.sock.shutdown(socket.SHUT_WR)
+            stream.write_shutdown = True
+        self._update_interest(stream)
+        self._check_closed(stream)
+
+    def _readable(self, stream):
+        data = stream.sock.recv(min(self.read_size, stream.send_window))
+        if not data:
+            stream.local_eof = True
+            self.send("eof", {"id": stream.id})
+        else:
+            stream.send_window -= len(data)
+            stream.bytes_out += len(data)
+            self.queue.put(stream.frame(data))
+        self._update_interest(stream)
+        self._check_closed(stream)
+
+    def _remote_data(self, stream_id, data, received_at):
+        stream = self.streams.get(stream_id)
+        if stream is None or stream.remote_eof:
+            return
+        if stream.pending_bytes + len(data) > self.initial_window:
+            logger.warning(f"Tunnel stream {stream_id} exceeded its window, closing")
+            self._close(stream_id, "window exceeded")
+            return
+        stream.pending.append((data, received_at))
+        stream.pending_bytes += len(data)
+        if stream.connected:
+            self._flush(stream)
+        if stream_id in self.streams:
+            self._update_interest(stream)
+
+    def _grant(self, stream_id, amount):
+        stream = self.streams.get(stream_id)
+        if stream:
+            stream.send_window += max(0, amount)
+            self._update_interest(stream)
+
+    def _remote_eof(self, stream_id):
+        stream = self.streams.get(stream_id)
+        if stream:
+            stream.remote_eof = True
+            if stream.connected:
+                self._flush(stream)
+
+    def _flush(self, stream):
+        # write out pending data right away instead of waiting for the next select
+        try:
+            self._writable(stream)
+        except OSError as e:
+            logger.debug(f"Tunnel stream {stream.id} error ({e})")
+            self._close(stream.id, str(e))
+
+    def _check_closed(self, stream):
+        if stream.local_eof and stream.write_shutdown:
+            self._close(stream.id)
+
+    def _close(self, stream_id, error=None):
+        stream = self.streams.pop(stream_id, None)
+        if stream is None:
+            return
+        if stream.sock.fileno() in self.selector.get_map():
+            self.selector.unregister(stream.sock)
+        stream.sock.close()
+        logger.info(f"Closed tunnel stream {stream_id}")
+        self.send("closed", {**stream.stats(), "error": error})
+
+    def _send_stats(self):
+        self.send("stats", {"streams": [s.stats() for s in self.streams.values()]})
+
+
+if __name__ == "__main__":
+    pass
@@ -1,7 +1,21 @@
+import hashlib
+import importlib
+import atexit
+import json
 import logging
+import logging.handlers
+import os
+import queue
 import shlex
 import subprocess
 import re
+import signal
+import sys
+import tempfile
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+from threading import Lock, BoundedSemaphore, Event, Timer
 
 
 logger = logging.getLogger(__name__)
@@ -10,6 +24,76 @@ logger = logging.getLogger(__name__)
 # registered modules are imported and used in the core
 registered_modules = {}
 
+# addon modules the core can load, lazy modules are only imported
+# when the first event for one of their event keys arrives (--lazy-modules)
+module_manifest = {
+    "sync": {"path": "modules.addons.sync", "event_keys": ["sync"], "lazy": False},
+    "telemetry": {"path": "modules.addons.telemetry", "event_keys": ["telemetry"], "lazy": False},
+    "terminal": {"path": "modules.addons.terminal", "event_keys": ["td", "terminal"], "lazy": True},
+    "script": {"path": "modules.addons.script", "event_keys": ["script"], "lazy": True},
+    "processes": {"path": "modules.addons.processes", "event_keys": ["processes"], "lazy": True},
+    "diag": {"path": "modules.addons.diag", "event_keys": ["diag"], "lazy": True},
+    "files": {"path": "modules.addons.files", "event_keys": ["files"], "binary_keys": ["f"], "lazy": True},
+    "tunnel": {"path": "modules.addons.tunnel", "event_keys": ["tunnel"], "binary_keys": ["t"], "lazy": True},
+    "logs": {"path": "modules.addons.logs", "event_keys": ["logs"], "lazy": True},
+    "diskusage": {"path": "modules.addons.diskusage", "event_keys": ["diskusage"], "lazy": True},
+}
+
+
+def load_module(name):
+    """
+    Import an addon from the manifest and return its registered module class
+    """
+    importlib.import_module(module_manifest[name]["path"])
+    return registered_modules[name]
+
+
+class StartupProfile:
+
+    """
+    Collect timings of the startup phases, printed with --profile-startup
+    """
+
+    def __init__(self):
+        self.timings = []
+
+    def record(self, label, seconds):
+        self.timings.append((label, seconds))
+
+    @contextmanager
+    def measure(self, label):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(label, time.perf_counter() - started)
+
+    @staticmethod
+    def process_age():
+        """
+        Seconds since the process started, for a PyInstaller onefile build
+        this is the bootloader parent that unpacks the archive before starting python
+        """
+        pid = os.getpid()
+        if getattr(sys, "frozen", False) and os.path.basename(getattr(sys, "_MEIPASS", "")).startswith("_MEI"):
+            pid = os.getppid()
+        try:
+            start_ticks = int(read_text(f"/proc/{pid}/stat").rsplit(")", 1)[1].split()[19])
+            uptime = float(read_text("/proc/uptime").split()[0])
+        except (AttributeError, IndexError, ValueError):
+            return None
+        return uptime - start_ticks / os.sysconf("SC_CLK_TCK")
+
+    def report(self):
+        lines = [f"{label:<30} {seconds * 1000:10.1f} ms" for label, seconds in self.timings]
+        age = self.process_age()
+        if age is not None:
+            lines.append(f"{'process start to now':<30} {age * 1000:10.1f} ms")
+        return "\n".join(lines)
+
+
+startup_profile = StartupProfile()
+
 
 def dict_getter(d, *args, **kwargs):
     if not d:
@@ -22,14 +106,303 @@ def dict_getter(d, *args, **kwargs):
     return out
 
 
-def run_shell(command_string, raise_exception=False):
-    # convenience function for running arguments with shell=True
-    # these arguments can be formatted as a single string as long as the syntax is exactly the same as on the cli
-    # the system shell will default to /bin/sh for these commands
+log_format = "[%(asctime)s] (%(levelname)s) <%(name)s.%(funcName)s:%(lineno)d> —-> %(message)s"
+
+
+class Truncated:
+
+    """
+    Log argument for large payloads, only converted to a (truncated) string if the record is emitted
+    """
+
+    # maximum characters of a payload to log, None logs everything
+    limit = 512
+
+    __slots__ = ("payload",)
+
+    def __init__(self, payload):
+        self.payload = payload
+
+    def __str__(self):
+        text = self.payload if isinstance(self.payload, str) else str(self.payload)
+        if self.limit is not None and len(text) > self.limit:
+            return f"{text[:self.limit]}... ({len(text)} chars)"
+        return text
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+
+    """
+    Hand records to the logging thread without formatting them first
+    Records are dropped and counted when the queue is full instead of blocking the caller
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # formatting happens in the listener thread
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def configure_logging(level="info", module_levels=None, payload_limit=512, queue_size=10_000):
+    """
+    Log through a queue to a background thread so callers never wait on the journal
+    module_levels is a dict of logger name -> level name to override the level per module
+    """
+    Truncated.limit = payload_limit
+
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter(log_format))
+
+    log_queue = queue.Queue(maxsize=queue_size)
+    listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(DeferredQueueHandler(log_queue))
+    root.setLevel(getattr(logging, level.upper()))
+
+    for name, module_level in (module_levels or {}).items():
+        logging.getLogger(name).setLevel(getattr(logging, module_level.upper()))
+
+    return listener
+
+
+def json_hash(obj):
+    """
+    Stable hash of a json serializable object
+    """
+    return hashlib.sha1(json.dumps(obj, sort_keys=True, separators=(",", ":")).encode()).hexdigest()
+
+
+def json_diff(old, new, path=""):
+    """
+    Return a list of JSON patch (RFC 6902) operations that turn old into new
+    Dicts are compared key by key, lists of the same length item by item,
+    anything else that differs is replaced
+    """
+    if old == new:
+        return []
+
+    if isinstance(old, dict) and isinstance(new, dict):
+        ops = []
+        for key in old:
+            if key not in new:
+                ops.append({"op": "remove", "path": f"{path}/{_escape_pointer(key)}"})
+        for key, value in new.items():
+            key_path = f"{path}/{_escape_pointer(key)}"
+            if key not in old:
+                ops.append({"op": "add", "path": key_path, "value": value})
+            else:
+                ops.extend(json_diff(old[key], value, key_path))
+        return ops
+
+    if isinstance(old, list) and isinstance(new, list) and len(old) == len(new):
+        ops = []
+        for index, (old_item, new_item) in enumerate(zip(old, new)):
+            ops.extend(json_diff(old_item, new_item, f"{path}/{index}"))
+        return ops
+
+    return [{"op": "replace", "path": path, "value": new}]
+
+
+def _escape_pointer(key):
+    return str(key).replace("~", "~0").replace("/", "~1")
+
+
+def read_text(path, default=None):
+    """
+    Read a small text file such as a /proc or /sys entry, returning the stripped content
+    Returns the default when the file is missing or can't be read
+    """
+    try:
+        with open(path, "r") as infile:
+            return infile.read().strip()
+    except (OSError, UnicodeDecodeError):
+        return default
+
+
+def parse_key_values(text, separator=":"):
+    """
+    Parse lines of "key<separator>value" into a dict, first occurrence of a key wins
+    """
+    out = {}
+    for line in (text or "").splitlines():
+        key, sep, value = line.partition(separator)
+        if sep:
+            out.setdefault(key.strip(), value.strip().strip('"'))
+    return out
+
+
+class CommandExecutor:
+
+    """
+    Run commands with a timeout and a limit on how many run at the same time
+    Identical commands that are requested while one is already running wait for its result
+    instead of starting another process, results can also be cached for a ttl
+    """
+
+    def __init__(self, max_concurrent=4, default_timeout=60):
+        self.default_timeout = default_timeout
+        self._slots = BoundedSemaphore(max_concurrent)
+        self._lock = Lock()
+        self._inflight = {}
+        self._cache = {}
+        self.stats = {}
+
+    def run(self, argv, timeout=None, ttl=None):
+        """
+        Run argv and return (returncode, stdout bytes)
+        Raises subprocess.TimeoutExpired if the command runs longer than the timeout
+        """
+        key = tuple(argv)
+
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None and cached[0] > time.monotonic():
+                return cached[1]
+
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self._inflight[key] = Future()
+
+        if not owner:
+            return future.result()
+
+        try:
+            result = self._execute(argv, timeout or self.default_timeout)
+            if ttl:
+                with self._lock:
+                    self._cache[key] = (time.monotonic() + ttl, result)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def _execute(self, argv, timeout):
+        with self._slots:
+            started = time.monotonic()
+            timed_out = False
+            # run in a new session so the whole process group can be killed on timeout
+            proc = subprocess.Popen(
+                argv,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                start_new_session=True
+            )
+            try:
+                stdout, _stderr = proc.communicate(timeout=timeout)
+                return proc.returncode, stdout
+            except subprocess.TimeoutExpired:
+                timed_out = True
+                self._kill(proc)
+                proc.communicate()
+                raise
+            finally:
+                self._record(argv[0], time.monotonic() - started, timed_out)
+
+    def stream(self, argv, timeout=None):
+        """
+        Run argv and yield its stdout line by line while it runs, instead of buffering all of it
+        Streamed commands share the concurrency limit, timeout and stats but are never cached
+        The command is killed when the caller stops reading early, a timeout raises
+        subprocess.TimeoutExpired after the lines read so far
+        """
+        timeout = timeout or self.default_timeout
+        with self._slots:
+            started = time.monotonic()
+            proc = subprocess.Popen(
+                argv,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                start_new_session=True,
+                universal_newlines=True,
+                errors="replace"
+            )
+            # reading blocks, so the timeout is enforced from a timer
+            expired = Event()
+
+            def expire():
+                expired.set()
+                self._kill(proc)
+
+            timer = Timer(timeout, expire)
+            timer.daemon = True
+            timer.start()
+            try:
+                yield from proc.stdout
+            finally:
+                timer.cancel()
+                proc.stdout.close()
+                if proc.poll() is None:
+                    self._kill(proc)
+                proc.wait()
+                self._record(argv[0], time.monotonic() - started, expired.is_set())
+
+        if expired.is_set():
+            raise subprocess.TimeoutExpired(argv, timeout)
+
+    @staticmethod
+    def _kill(proc):
+        # the command runs in its own session, kill everything it started
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    def _record(self, command, duration, timed_out):
+        name = os.path.basename(command)
+        with self._lock:
+            stats = self.stats.get(name)
+            if stats is None:
+                stats = self.stats[name] = {"count": 0, "total_seconds": 0.0, "max_seconds": 0.0, "timeouts": 0}
+            stats["count"] += 1
+            stats["total_seconds"] += duration
+            stats["max_seconds"] = max(stats["max_seconds"], duration)
+            stats["timeouts"] += 1 if timed_out else 0
+
+    def clear_cache(self):
+        with self._lock:
+            self._cache = {}
+
+    def report(self):
+        with self._lock:
+            return {
+                name: {**stats, "avg_seconds": stats["total_seconds"] / stats["count"]}
+                for name, stats in self.stats.items()
+            }
+
+
+# shared executor for every command the client runs to collect information
+command_executor = CommandExecutor()
+
+
+def run_shell(command_string, raise_exception=False, timeout=None, ttl=None):
+    # convenience function for running a command written as a single string
+    # the string is split with shlex so the syntax is the same as on the cli, but it isn't run by a shell
+    # commands go through the shared executor which applies the timeout, concurrency limit and ttl cache
     try:
         command = shlex.split(command_string)
-        cmd = subprocess.run(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        return cmd.returncode, cmd.stdout.decode().strip("\n")
+        returncode, stdout = command_executor.run(command, timeout=timeout, ttl=ttl)
+        return returncode, stdout.decode().strip("\n")
     except Exception as e:
         logger.error(f"Error running command ({command_string}) ({e})")
         if raise_exception is False:
@@ -37,6 +410,88 @@ def run_shell(command_string, raise_exception=False):
         raise
 
 
+class InventoryCache:
+
+    """
+    Persistent cache for hardware inventory that doesn't change while the system is running
+    Entries are scoped to the current boot id and are dropped when the system reboots
+    A ttl of None keeps the entry for the whole boot
+    """
+
+    boot_id_file = "/proc/sys/kernel/random/boot_id"
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.boot_id = read_text(self.boot_id_file)
+        self._lock = Lock()
+        self._dirty = False
+        self._entries = self._load()
+
+    def _load(self):
+        try:
+            with open(self.filename, "r") as infile:
+                data = json.load(infile)
+        except (OSError, ValueError):
+            return {}
+
+        if not self.boot_id or data.get("boot_id") != self.boot_id:
+            logger.info("Boot id changed, discarding the inventory cache")
+            self._dirty = True
+            return {}
+        return data.get("entries", {})
+
+    def get(self, key, collect, ttl=None):
+        """
+        Return the cached value for key or call collect() and cache the result
+        None results are not cached so they are retried on the next call
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None:
+            expires = entry.get("expires")
+            if expires is None or expires > time.time():
+                return entry.get("value")
+
+        value = collect()
+        if value is not None:
+            with self._lock:
+                self._entries[key] = {
+                    "value": value,
+                    "expires": time.time() + ttl if ttl is not None else None
+                }
+                self._dirty = True
+        return value
+
+    def invalidate(self, *keys):
+        """
+        Drop the specified keys or every entry if no keys are given
+        """
+        with self._lock:
+            if keys:
+                for key in keys:
+                    self._entries.pop(key, None)
+            else:
+                self._entries = {}
+            self._dirty = True
+
+    def flush(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            data = json.dumps({"boot_id": self.boot_id, "entries": self._entries})
+            self._dirty = False
+
+        try:
+            folder = os.path.dirname(self.filename)
+            os.makedirs(folder, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=folder, prefix=".inventory")
+            with os.fdopen(fd, "w") as outfile:
+                outfile.write(data)
+            os.replace(temp_path, self.filename)
+        except OSError as e:
+            logger.error(f"Error saving inventory cache {self.filename} ({e})")
+
+
 def register_module(*args, **kwargs):
 
     """
@@ -53,20 +508,38 @@ def register_module(*args, **kwargs):
 
 class CommandParser:
 
+    # compiled patterns shared by every parser, keyed by (regex, flags)
+    _patterns = {}
+
     def __init__(self, data):
         self._data = data or ""
         self.data = []
 
+    @classmethod
+    def _compile(cls, regex, flags=re.MULTILINE):
+        key = (regex, flags)
+        pattern = cls._patterns.get(key)
+        if pattern is None:
+            pattern = cls._patterns[key] = re.compile(regex, flags)
+        return pattern
+
     @staticmethod
-    def execute(command):
-        _, data = run_shell(command)
+    def execute(command, timeout=None, ttl=None):
+        _, data = run_shell(command, timeout=timeout, ttl=ttl)
         return CommandParser(data)
 
+    @staticmethod
+    def stream(command, timeout=None):
+        """
+        Parse the output of a command line by line as it is produced instead of buffering all of it
+        """
+        return StreamingCommandParser(command, timeout=timeout)
+
     def split(self, string_split):
         return [CommandParser(data) for data in self._data.split(string_split)]
 
     def contains(self, regex):
-        return re.search(regex, self._data, re.MULTILINE) is not None
+        return self._compile(regex).search(self._data) is not None
 
     @staticmethod
     def _listify(item):
@@ -86,12 +559,12 @@ class CommandParser:
         return self
 
     def list(self, regex, *keys):
-        lst = re.findall(regex, self._data or "", re.MULTILINE)
+        lst = self._compile(regex).findall(self._data or "")
         self.data = [dict(zip(keys, self._listify(listitem))) for listitem in lst]
         return self
 
     def dict(self, regex, *keys):
-        match = re.match(regex, self._data or "", re.MULTILINE)
+        match = self._compile(regex).match(self._data or "")
         if match:
             d = match.groupdict()
             self.data = [{
@@ -100,7 +573,7 @@ class CommandParser:
         return self
 
     def get(self, regex, key=0, default=None):
-        match = re.search(regex, self._data, re.MULTILINE)
+        match = self._compile(regex).search(self._data)
         return match.group(key).strip() if match else default
 
     def all(self):
@@ -113,6 +586,68 @@ class CommandParser:
         return [[item.get(key) for key in keys] for item in self.data]
 
 
+class StreamingCommandParser(CommandParser):
+
+    """
+    CommandParser that reads the output of a running command line by line
+    Only matching records (or the current block for split) are kept, so large outputs parse in bounded memory
+    Patterns passed to list, get and contains are matched against one line at a time,
+    get and contains stop the command as soon as they find a match
+    split yields the blocks one at a time instead of returning a list
+    The output can only be read once
+    """
+
+    def __init__(self, command, timeout=None):
+        super().__init__(None)
+        self.command = command
+        self.timeout = timeout
+        self._consumed = False
+
+    def _lines(self):
+        if self._consumed:
+            raise RuntimeError(f"Output of ({self.command}) has already been read")
+        self._consumed = True
+
+        try:
+            yield from command_executor.stream(shlex.split(self.command), timeout=self.timeout)
+        except Exception as e:
+            logger.error(f"Error running command ({self.command}) ({e})")
+
+    def split(self, string_split):
+        buffer = ""
+        for line in self._lines():
+            buffer += line
+            while string_split in buffer:
+                block, buffer = buffer.split(string_split, 1)
+                yield CommandParser(block)
+        yield CommandParser(buffer)
+
+    def contains(self, regex):
+        pattern = self._compile(regex)
+        return any(pattern.search(line) for line in self._lines())
+
+    def list(self, regex, *keys):
+        pattern = self._compile(regex)
+        self.data = []
+        for line in self._lines():
+            for listitem in pattern.findall(line):
+                self.data.append(dict(zip(keys, self._listify(listitem))))
+        return self
+
+    def dict(self, regex, *keys):
+        # matching from the start of the output needs all of it
+        self._data = "".join(self._lines())
+        return super().dict(regex, *keys)
+
+    def get(self, regex, key=0, default=None):
+        pattern = self._compile(regex)
+        for line in self._lines():
+            match = pattern.search(line)
+            if match:
+                return match.group(key).strip()
+        return default
+
+
 class Module:
 
     # the name of the module for referencing
@@ -122,6 +657,9 @@ class Module:
     # set to None to ignore events
     event_keys = []
 
+    # single character keys of incoming binary frames (\x00<key><payload>) to send to binary_event
+    binary_keys = []
+
     def __init__(self, core, queue):
         # reference to the core application
         self.core = core
@@ -129,6 +667,14 @@ class Module:
         # the queue is where data that will be sent over the websocket is queued up
         # modules should put any data that needs to be sent into this queue
         self.queue = queue
+
+        # large messages that aren't interactive go in the bulk queue, they may be sent over
+        # a separate connection so they don't delay terminal traffic
+        self.bulk_queue = getattr(core, "bulk_queue", None) or queue
+
+        # messages that must not be lost (like script results) go in the durable queue, they are
+        # spooled to disk and sent again until the server acknowledges them
+        self.durable_queue = getattr(core, "durable_queue", None) or self.bulk_queue
         self.running = False
 
     def startup(self):
@@ -152,3 +698,11 @@ class Module:
         :return: None
         """
         pass
+
+    def binary_event(self, data):
+        """
+        Process an incoming binary frame
+        :param data: bytes of the whole frame including the \x00<key> prefix
+        :return: None
+        """
+        pass
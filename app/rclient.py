@@ -1,26 +1,32 @@
 #!/usr/bin/env python3
 import argparse
+import atexit
 import base64
+import hashlib
 import json
 import logging
 import os
 import re
+import socket
 import ssl
+import stat
+import struct
 import sys
 import tempfile
+import time
+import weakref
+import zlib
 from multiprocessing import Queue
 from queue import Empty
-from threading import Thread
+from threading import Thread, Lock, Timer, Condition, Event
 
-import requests
-import websocket
-from Crypto.Hash import SHA256
-from Crypto.PublicKey import RSA
-from Crypto.Signature import PKCS1_v1_5
-from websocket import create_connection
+_imports_started = time.perf_counter()
 
-from modules import registered_modules
-from modules.util import run_shell
+from modules import module_manifest, load_module
+from modules.util import run_shell, read_text, parse_key_values, InventoryCache, command_executor, startup_profile, \
+    configure_logging, Truncated
+
+startup_profile.record("imports", time.perf_counter() - _imports_started)
 
 """
 Linux dependencies
@@ -34,12 +40,6 @@ TODO: implement machine-id checking when provisioning, useful for
 """
 
 
-
-logging.basicConfig(
-    format="[%(asctime)s] (%(levelname)s) <%(name)s.%(funcName)s:%(lineno)d> —-> %(message)s",
-    level=logging.DEBUG
-)
-
 logger = logging.getLogger(__name__)
 
 
@@ -52,35 +52,98 @@ class Config:
     base_dir = os.environ.get("REMOTE_SUPPORT_HOME", "/usr/local/remotesupport")
     config_dir = os.path.join(base_dir, "config")
     config_file = os.path.join(config_dir, "config.json")
+    inventory_cache_file = os.path.join(config_dir, "inventory_cache.json")
+    spool_dir = os.path.join(base_dir, "spool")
     private_key_file = os.path.join(config_dir, "private.key")
     base_url = os.environ.get("REMOTE_SUPPORT_BASE_URL", "https://ssh.danbuntu.com")
     ws_endpoint = base_url.replace("http", "ws")
 
+    # seconds to wait for more changes before writing the config file
+    flush_delay = 0.5
+
+    # seconds to wait before trying again when writing the config file failed
+    retry_delay = 5.0
+
+    # configs with changes that may still need writing when the process exits
+    _instances = weakref.WeakSet()
+    _atexit_registered = False
+
     def __init__(self):
-        self._loaded = False
         self._data = {}
+        self._mtime = None
+        self._dirty = False
+        self._timer = None
+        self._lock = Lock()
+        Config._instances.add(self)
+        if not Config._atexit_registered:
+            atexit.register(Config.flush_all)
+            Config._atexit_registered = True
+
+    @classmethod
+    def flush_all(cls):
+        for config in list(cls._instances):
+            config.flush()
+
+    def _file_mtime(self):
+        try:
+            return os.stat(self.config_file).st_mtime_ns
+        except OSError:
+            return None
 
     def get(self, key, default=None):
-        if not self._loaded:
-            self.load()
-        return self._data.get(key, default)
+        with self._lock:
+            # pick up changes made to the file by something else, unless we have unsaved changes
+            if not self._dirty and (self._mtime is None or self._file_mtime() != self._mtime):
+                self._load()
+            return self._data.get(key, default)
 
     def clear(self, *keys):
-        for key in keys:
-            if key in self._data:
-                del self._data[key]
-        self.save()
+        with self._lock:
+            for key in keys:
+                if key in self._data:
+                    del self._data[key]
+            self._schedule()
 
     def set(self, **kwargs):
-        self._data.update(kwargs)
-        self.save()
+        with self._lock:
+            self._data.update(kwargs)
+            self._schedule()
+
+    def _schedule(self, delay=None):
+        # coalesce bursts of changes into a single write
+        self._dirty = True
+        if self._timer is None:
+            self._timer = Timer(self.flush_delay if delay is None else delay, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def flush(self):
+        """
+        Write pending changes to disk now
+        """
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self._dirty:
+                return
+            if Utils.save_file_atomic(self.config_file, json.dumps(self._data, indent=True)):
+                self._dirty = False
+                self._mtime = self._file_mtime()
+            else:
+                logger.warning(f"Could not write {self.config_file}, trying again in {self.retry_delay}s")
+                self._schedule(self.retry_delay)
 
     def save(self):
-        Utils.save_file(self.config_file, json.dumps(self._data, indent=True))
+        self.flush()
 
     def load(self):
+        with self._lock:
+            self._load()
+
+    def _load(self):
+        self._mtime = self._file_mtime()
         self._data = Utils.load_json_file(self.config_file)
-        self._loaded = True
 
 
 class Info:
@@ -90,6 +153,22 @@ class Info:
         "operating_system_version", "operating_system_codename", "serial_number"
     ]
 
+    # seconds to cache each field for, None caches until the next reboot
+    # fields that aren't listed are collected every time
+    cache_ttl = {
+        "manufacturer": None,
+        "model": None,
+        "serial_number": None,
+        "cpu": None,
+        "ram": None,
+        "operating_system": 86400,
+        "operating_system_version": 86400,
+        "operating_system_codename": 86400,
+    }
+
+    def __init__(self, cache=None):
+        self.cache = cache
+
     def _dictify(self, item):
 
         if isinstance(item, dict):
@@ -103,10 +182,21 @@ class Info:
 
         return item
 
+    def _collect(self, field):
+        if self.cache is not None and field in self.cache_ttl:
+            return self.cache.get(f"info:{field}", lambda: getattr(self, field, None), ttl=self.cache_ttl[field])
+        return getattr(self, field, None)
+
+    def get(self, field):
+        return self._dictify(self._collect(field))
+
     def to_dict(self):
         output = {}
         for field in self.fields:
-            output.update({field: self._dictify(getattr(self, field, None))})
+            output.update({field: self.get(field)})
+
+        if self.cache is not None:
+            self.cache.flush()
 
         return output
 
@@ -121,33 +211,43 @@ class Info:
 
     @property
     def hostname(self):
-        _retval, hostname = run_shell("hostname", raise_exception=False)
-        return hostname
+        return socket.gethostname() or None
 
     @property
     def manufacturer(self):
-        _retval, mfg = run_shell("dmidecode -s system-manufacturer", raise_exception=False)
+        mfg = Collector.dmi("sys_vendor")
+        if mfg is None:
+            _retval, mfg = run_shell("dmidecode -s system-manufacturer", raise_exception=False, timeout=15)
         return mfg
 
     @property
     def model(self):
-        _retval, model = run_shell("dmidecode -s system-product-name", raise_exception=False)
+        model = Collector.dmi("product_name")
         if model is None:
-            _retval, model = run_shell("cat /proc/cpuinfo 2> /dev/null | grep Model | cut -f2 -d':' | xargs", raise_exception=False)
-        # TODO: check the output of /proc/cpuinfo if this is None
-        return model
+            _retval, model = run_shell("dmidecode -s system-product-name", raise_exception=False, timeout=15)
+        if not model:
+            # single board computers (raspberry pi) report the model in cpuinfo
+            model = Collector.cpuinfo().get("Model") or Collector.device_tree("model")
+        return model or None
 
     @property
     def ram(self):
-        _retval, output = run_shell("free -h", raise_exception=False)
+        mem_total = Collector.meminfo().get("MemTotal")
+        if mem_total is not None:
+            return mem_total
+        _retval, output = run_shell("free -b", raise_exception=False)
         if output:
-            match = re.search(r'Mem:\s+(?P<ram>[^\s]+)', output)
+            match = re.search(r'Mem:\s+(?P<ram>\d+)', output)
             if match:
-                return match.group("ram")
+                return int(match.group("ram"))
         return None
 
     @property
     def cpu(self):
+        cpuinfo = Collector.cpuinfo()
+        cpu = cpuinfo.get("model name") or cpuinfo.get("Processor") or cpuinfo.get("cpu model")
+        if cpu:
+            return cpu
         _retval, output = run_shell("lscpu", raise_exception=False)
         if output:
             match = re.search(r'Model name:\s+(?P<cpu>.*)', output)
@@ -157,25 +257,112 @@ class Info:
 
     @property
     def operating_system(self):
+        # keep reporting the distributor id lsb_release -si prints (e.g. "Debian", not "Debian GNU/Linux")
+        distributor_id = Collector.lsb_release().get("DISTRIB_ID") or Collector.distributor_id()
+        if distributor_id:
+            return distributor_id
         _retval, os_name = run_shell("lsb_release -si", raise_exception=False)
         return os_name
 
     @property
     def operating_system_version(self):
+        # rolling and testing releases leave VERSION_ID out of os-release
+        os_version = Collector.os_release().get("VERSION_ID") or Collector.lsb_release().get("DISTRIB_RELEASE")
+        if os_version:
+            return os_version
         _retval, os_version = run_shell("lsb_release -sr", raise_exception=False)
         return os_version
 
     @property
     def operating_system_codename(self):
+        os_release = Collector.os_release()
+        codename = (os_release.get("VERSION_CODENAME") or os_release.get("UBUNTU_CODENAME")
+                    or Collector.lsb_release().get("DISTRIB_CODENAME"))
+        if codename:
+            return codename
         _retval, codename = run_shell("lsb_release -sc", raise_exception=False)
         return codename
 
     @property
     def serial_number(self):
-        _retval, pc_serial = run_shell("dmidecode -s system-serial-number", raise_exception=False)
+        # product_serial is only readable by root
+        pc_serial = Collector.dmi("product_serial")
         if pc_serial is None:
-            _retval, pc_serial = run_shell("cat /proc/cpuinfo 2> /dev/null | grep Serial | cut -f2 -d':' | xargs")
-        return pc_serial
+            _retval, pc_serial = run_shell("dmidecode -s system-serial-number", raise_exception=False, timeout=15)
+        if not pc_serial:
+            pc_serial = Collector.cpuinfo().get("Serial") or Collector.device_tree("serial-number")
+        return pc_serial or None
+
+
+class Collector:
+
+    """
+    Read system facts directly from /proc, /sys and /etc instead of spawning commands
+    Each method returns None or an empty dict when the source isn't available
+    so callers can fall back to the equivalent command
+    """
+
+    dmi_dir = "/sys/class/dmi/id"
+    device_tree_dir = "/proc/device-tree"
+    os_release_files = ["/etc/os-release", "/usr/lib/os-release"]
+    lsb_release_file = "/etc/lsb-release"
+
+    # os-release ID to the distributor id lsb_release reports, where that isn't just the capitalized ID
+    distributor_ids = {
+        "centos": "CentOS",
+        "rhel": "RedHatEnterprise",
+        "opensuse-leap": "openSUSE",
+        "opensuse-tumbleweed": "openSUSE",
+        "almalinux": "AlmaLinux",
+        "linuxmint": "Linuxmint",
+    }
+
+    @classmethod
+    def dmi(cls, field):
+        value = read_text(os.path.join(cls.dmi_dir, field))
+        return value or None
+
+    @classmethod
+    def device_tree(cls, field):
+        value = read_text(os.path.join(cls.device_tree_dir, field)) or ""
+        return value.strip("\x00") or None
+
+    @classmethod
+    def os_release(cls):
+        for filename in cls.os_release_files:
+            content = read_text(filename)
+            if content:
+                return parse_key_values(content, separator="=")
+        return {}
+
+    @classmethod
+    def lsb_release(cls):
+        return parse_key_values(read_text(cls.lsb_release_file), separator="=")
+
+    @classmethod
+    def distributor_id(cls):
+        os_id = cls.os_release().get("ID")
+        if not os_id:
+            return None
+        return cls.distributor_ids.get(os_id, os_id.capitalize())
+
+    @classmethod
+    def cpuinfo(cls):
+        return parse_key_values(read_text("/proc/cpuinfo"))
+
+    @classmethod
+    def meminfo(cls):
+        """
+        Return /proc/meminfo with values converted to bytes
+        """
+        out = {}
+        for key, value in parse_key_values(read_text("/proc/meminfo")).items():
+            amount, _, unit = value.partition(" ")
+            try:
+                out[key] = int(amount) * (1024 if unit == "kB" else 1)
+            except ValueError:
+                pass
+        return out
 
 
 class Utils:
@@ -214,8 +401,48 @@ class Utils:
         except Exception as e:
             logger.exception(f"Error saving to file {filename}")
 
+    @classmethod
+    def save_file_atomic(cls, filename, data):
+        """
+        Write to a temp file in the same folder, fsync it and rename it over the file
+        so a crash leaves either the old or the new content, never a partial file
+        """
+        folder = os.path.dirname(filename)
+        temp_path = None
+        try:
+            logger.debug(f"Saving file {filename}")
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+            fd, temp_path = tempfile.mkstemp(dir=folder, prefix=f".{os.path.basename(filename)}.")
+            try:
+                # mkstemp creates the file as 0600, keep the mode of the file being replaced
+                os.fchmod(fd, stat.S_IMODE(os.stat(filename).st_mode))
+            except FileNotFoundError:
+                pass
+            with os.fdopen(fd, "w") as outfile:
+                outfile.write(data)
+                outfile.flush()
+                os.fsync(outfile.fileno())
+            os.replace(temp_path, filename)
+
+            # persist the rename itself
+            dir_fd = os.open(folder, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+            return True
+        except Exception as e:
+            logger.exception(f"Error saving to file {filename}")
+            if temp_path and os.path.exists(temp_path):
+                os.remove(temp_path)
+        return False
+
     @classmethod
     def load_private_key(cls, filename):
+        # pycryptodome is imported when a key is first used, not when the client starts
+        from Crypto.PublicKey import RSA
+
         try:
             data = cls.read_file(filename)
             if data:
@@ -226,6 +453,8 @@ class Utils:
 
     @classmethod
     def generate_key(cls):
+        from Crypto.PublicKey import RSA
+
         logger.info("Generating private key")
         key = RSA.generate(1024)
         Utils.save_file(Config.private_key_file, key.exportKey("PEM"), mode="wb")
@@ -234,12 +463,18 @@ class Utils:
 
     @classmethod
     def get_signature(cls, data, private_key):
+        from Crypto.Hash import SHA256
+        from Crypto.Signature import PKCS1_v1_5
+
         digest = SHA256.new(data.encode("utf-8"))
         signer = PKCS1_v1_5.new(private_key)
         return base64.b64encode(signer.sign(digest)).decode("utf-8")
 
     @classmethod
     def verify_signature(cls, data, signature, public_key):
+        from Crypto.Hash import SHA256
+        from Crypto.Signature import PKCS1_v1_5
+
         digest = SHA256.new(data.encode("utf-8"))
         verifier = PKCS1_v1_5.new(public_key)
         return verifier.verify(digest, signature)
@@ -259,6 +494,7 @@ class API:
             self.script_language = API._dict_path(self.data, "script", "language")
             self.script_arguments = API._dict_path(self.data, "script", "arguments")
             self.script_name = API._dict_path(self.data, "script", "name")
+            # only the full script query has the description, it's None with the lean one
             self.script_description = API._dict_path(self.data, "script", "description")
 
         @property
@@ -270,10 +506,94 @@ class API:
                 logger.error("Failed to decode base64 from script queue result")
             return None
 
+    class PersistedQuery:
+
+        """
+        A query that is sent by its sha256 hash (automatic persisted queries)
+        The full text is only sent when the server doesn't know the hash yet
+        """
+
+        def __init__(self, text):
+            # whitespace is collapsed so the text and hash are the same however the query is indented
+            self.text = " ".join(text.split())
+            self.hash = hashlib.sha256(self.text.encode("utf-8")).hexdigest()
+
+    new_device_mutation = PersistedQuery("""
+        mutation NewDevice(
+          $publicKey: String!,
+          $workgroupUuid: String!,
+          $model: String,
+          $hostname: String,
+          $manufacturer: String
+        ) {
+          support {
+            newDevice(input: {
+              publicKey: $publicKey,
+              workgroup: $workgroupUuid,
+              model: $model,
+              hostname: $hostname,
+              manufacturer: $manufacturer,
+            }) {
+              uuid
+              errors {
+                messages
+              }
+            }
+          }
+        }
+    """)
+
+    script_query = PersistedQuery("""
+        query Script($uuid: String!) {
+          support {
+            scriptQueue(uuid: $uuid) {
+              uuid
+              script {
+                dateCreated
+                lastUpdated
+                name
+                description
+                language
+                codeBase64
+              }
+              __typename
+            }
+          }
+        }
+    """)
+
+    # only what running a script needs
+    script_query_lean = PersistedQuery("""
+        query ScriptLean($uuid: String!) {
+          support {
+            scriptQueue(uuid: $uuid) {
+              uuid
+              script {
+                name
+                language
+                codeBase64
+              }
+            }
+          }
+        }
+    """)
+
+    # device info fields the new device mutation takes
+    new_device_fields = ["model", "hostname", "manufacturer"]
+
     url = f"{Config.base_url}/graphql"
 
-    def __init__(self):
+    # error codes and messages servers use for persisted queries
+    persisted_query_not_found = {"PERSISTED_QUERY_NOT_FOUND", "PersistedQueryNotFound"}
+    # a server without persisted query support only sees a request without a query
+    persisted_query_not_supported = {
+        "PERSISTED_QUERY_NOT_SUPPORTED", "PersistedQueryNotSupported", "Must provide query string.",
+    }
+
+    def __init__(self, persisted_queries=True):
         self.headers = None
+        # turned off for the rest of the process if the server doesn't support them
+        self.persisted_queries = persisted_queries
 
     def authenticate(self, device_id, signature):
         if device_id and signature:
@@ -294,12 +614,57 @@ class API:
             d = d.get(p, {})
         return d or default
 
-    def _query(self, query, variables):
+    def _post(self, payload):
+        # requests is slow to import and only needed for provisioning and scripts
+        import requests
+
         logger.debug(f"Query {self.url}")
-        response = requests.post(self.url, json={'query': query, 'variables': variables}, headers=self.headers)
+        response = requests.post(self.url, json=payload, headers=self.headers)
 
         logger.debug(f"Response code [{response.status_code}] from {self.url}")
+        return response
+
+    @staticmethod
+    def _error_codes(data):
+        codes = set()
+        errors = data.get("errors") if isinstance(data, dict) else None
+        for error in errors if isinstance(errors, list) else []:
+            if isinstance(error, dict):
+                codes.add(error.get("message"))
+                codes.add((error.get("extensions") or {}).get("code"))
+        codes.discard(None)
+        return codes
 
+    def _query(self, query, variables):
+        if isinstance(query, str):
+            query = API.PersistedQuery(query)
+
+        payload = {"query": query.text, "variables": variables}
+
+        if self.persisted_queries:
+            extensions = {"persistedQuery": {"version": 1, "sha256Hash": query.hash}}
+            response = self._post({"variables": variables, "extensions": extensions})
+            try:
+                data = response.json()
+            except ValueError:
+                data = None
+            codes = self._error_codes(data)
+
+            if response.status_code == 200 and not codes & (self.persisted_query_not_found | self.persisted_query_not_supported):
+                return data
+
+            if codes & self.persisted_query_not_supported:
+                logger.info("Server doesn't support persisted queries, sending full queries")
+                self.persisted_queries = False
+            elif codes & self.persisted_query_not_found or 400 <= response.status_code < 500:
+                # the request was rejected before the query ran, send the full text so the server stores it under the hash
+                logger.debug(f"Persisted query {query.hash} not found, sending the query text")
+                payload["extensions"] = extensions
+            else:
+                # a server error may have happened after the query ran, sending it again could repeat a mutation
+                raise Exception(f"Error with the request [{response.status_code}] ({response.reason})")
+
+        response = self._post(payload)
         if response.status_code == 200:
             return response.json()
 
@@ -314,35 +679,12 @@ class API:
 
     def new_device(self, public_key, workgroup_uuid, **device_info) -> DeviceContract:
 
-        query = """
-            mutation NewDevice(
-              $publicKey: String!, 
-              $workgroupUuid: String!,
-              $model: String,
-              $hostname: String,
-              $manufacturer: String
-            ) {
-              support {
-                newDevice(input: {
-                  publicKey: $publicKey,
-                  workgroup: $workgroupUuid,
-                  model: $model,
-                  hostname: $hostname,
-                  manufacturer: $manufacturer,
-                }) {
-                  uuid
-                  errors {
-                    field
-                    messages
-                  }
-                }
-              }
-            }
-        """
-
-        device_info = {to_camel_case(key): val for key, val in device_info.items()}
+        # only send the variables the mutation declares, the server can't use anything else
+        device_info = {
+            to_camel_case(key): val for key, val in device_info.items() if key in self.new_device_fields
+        }
 
-        data = self._query(query=query, variables={
+        data = self._query(query=self.new_device_mutation, variables={
             "publicKey": public_key,
             "workgroupUuid": workgroup_uuid,
             **device_info
@@ -355,29 +697,13 @@ class API:
 
         return API.DeviceContract(new_device)
 
-    def get_script(self, script_uuid) -> ScriptQueueContract:
-
-        query = """
-            query Script($uuid: String!) {
-              support {
-                scriptQueue(uuid: $uuid) {
-                  uuid
-                  script {
-                    dateCreated
-                    lastUpdated
-                    name
-                    description
-                    language
-                    codeBase64
-                  }
-                  __typename
-                }
-              }
-            }
+    def get_script(self, script_uuid, lean=True) -> ScriptQueueContract:
+        """
+        The lean query only has the fields needed to run the script
         """
 
         data = self._query(
-            query=query,
+            query=self.script_query_lean if lean else self.script_query,
             variables={
                 "uuid": script_uuid,
             }
@@ -388,11 +714,699 @@ class API:
         return API.ScriptQueueContract(script_data) if script_data else None
 
 
+class LaneCompressor:
+
+    """
+    Per-lane streaming zlib compression for outbound websocket messages
+    Each lane (a terminal session or an event type) keeps its own compression stream
+    so repeated content across frames compresses against the history of that lane
+    Frames below the threshold are sent uncompressed and don't touch the stream
+    """
+
+    header = "Support-Device-Compression"
+    method = "zlib"
+
+    # messages smaller than this (in bytes) are sent as plain text frames
+    threshold = 256
+
+    # seconds between logging the per-lane stats while messages are being sent
+    log_interval = 3600
+
+    # preset dictionary shared with the server, primed with common message content
+    dictionary = (
+        b'\x1b[0m\x1b[01;34m\x1b[01;32m\x1b[K\x1b[?2004h\x1b[?2004l\r\n'
+        b'{"type": "terminal", "data": {"type": "stopterminal", "data": {"id": '
+        b'{"type": "script", "data": {"type": "scriptend", "data": {"uuid": "result": {"exit_code": "output": '
+        b'{"type": "sync", "data": {"system": {"hostname": "manufacturer": "model": "serial_number": '
+        b'"network": {"interfaces": [{"name": "ipv4_addresses": [{"broadcast": "netmask": "addr": '
+        b'"mac_address": "default": false, "gateway": null}], "default_gateway": '
+        b'"storage": {"disks": [{"name": "/dev/sda", "form_factor": "rotation_rate": "total_size": '
+        b'"volumes": [{"type": "ext4", "used_space": "available_space": "mount_point": "/"}]}]}}}'
+    )
+
+    class LaneStats:
+        def __init__(self):
+            self.frames = 0
+            self.compressed_frames = 0
+            self.raw_bytes = 0
+            self.sent_bytes = 0
+            self.cpu_time = 0.0
+
+        def to_dict(self):
+            return {
+                "frames": self.frames,
+                "compressed_frames": self.compressed_frames,
+                "raw_bytes": self.raw_bytes,
+                "sent_bytes": self.sent_bytes,
+                "ratio": round(self.sent_bytes / self.raw_bytes, 4) if self.raw_bytes else None,
+                "cpu_ms": round(self.cpu_time * 1000, 3),
+            }
+
+    def __init__(self, enabled=False, name="Outbound"):
+        self.enabled = enabled
+        self.name = name
+        self._streams = {}
+        self.stats = {}
+        self._logged_at = time.monotonic()
+
+    @staticmethod
+    def lane(event):
+        """
+        Determine the lane for an outbound event
+        Terminal data strings get a lane per shell, dict events are laned by their type
+        """
+        if isinstance(event, str):
+            _type, _, rest = event.partition(":")
+            if _type == "td":
+                return f"td:{rest.split(':', 1)[0]}"
+            return _type
+        if isinstance(event, dict):
+            return str(event.get("type"))
+        return "default"
+
+    def _stream(self, lane):
+        stream = self._streams.get(lane)
+        if stream is None:
+            stream = zlib.compressobj(level=6, zdict=self.dictionary)
+            self._streams[lane] = stream
+        return stream
+
+    def encode(self, lane, message):
+        """
+        Return the frame to send for a message, either the str message itself
+        or a binary frame in the format <lane>\\n<compressed bytes>
+        """
+        if time.monotonic() - self._logged_at >= self.log_interval:
+            self.log_report()
+
+        stats = self.stats.get(lane)
+        if stats is None:
+            stats = self.stats[lane] = self.LaneStats()
+
+        raw = message.encode("utf-8")
+        stats.frames += 1
+        stats.raw_bytes += len(raw)
+
+        if not self.enabled or len(raw) < self.threshold:
+            stats.sent_bytes += len(raw)
+            return message
+
+        started = time.thread_time()
+        stream = self._stream(lane)
+        frame = lane.encode("utf-8") + b"\n" + stream.compress(raw) + stream.flush(zlib.Z_SYNC_FLUSH)
+        stats.cpu_time += time.thread_time() - started
+        stats.compressed_frames += 1
+        stats.sent_bytes += len(frame)
+        return frame
+
+    def reset(self):
+        # compression streams are only valid for a single connection
+        self._streams = {}
+
+    def report(self):
+        return {lane: stats.to_dict() for lane, stats in self.stats.items()}
+
+    def log_report(self):
+        self._logged_at = time.monotonic()
+        logger.info("%s compression stats %s", self.name, json.dumps(self.report()))
+
+
+class BulkLink:
+
+    """
+    Second websocket for bulk traffic (sync payloads, file chunks, script results, diagnostics)
+    so large frames don't hold up terminal echo on the main connection
+    The connection is opened on the first bulk message and closed after being idle,
+    if the server doesn't accept it everything is sent over the main connection instead
+    The server only sends control frames on this connection, a reader thread answers pings and closes
+
+    Messages are in order on each connection but not across them, a message that falls back to the
+    main connection can arrive before bulk messages sent just before it
+    After a failed send the link stays on the main connection for retry_after seconds,
+    so bulk messages only switch connections once instead of alternating between them
+    """
+
+    url = f"{Config.ws_endpoint}/ws/deviceconnect/bulk/"
+
+    # seconds without bulk messages before the connection is closed
+    idle_timeout = 60
+
+    # seconds to wait before trying again after the server refused the connection
+    retry_after = 600
+
+    # seconds to spend sending what is still queued when stopping
+    stop_timeout = 10
+
+    def __init__(self, core):
+        self.core = core
+        self.queue = Queue()
+        self.websocket = None
+        self.compressor = LaneCompressor(name="Bulk outbound")
+        self.thread = None
+        self.reader = None
+        self.running = False
+        self._unsupported_until = 0
+        self._last_sent = 0
+        self._server_closed = Event()
+
+    def start(self):
+        self.running = True
+        self.thread = Thread(target=self._run)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self._drain()
+        self.queue.close()
+        self._close()
+
+    def _drain(self):
+        """
+        Send whatever is still queued, messages are only dropped if neither connection can take them
+        """
+        deadline = time.monotonic() + self.stop_timeout
+        while time.monotonic() < deadline:
+            try:
+                event = self.queue.get(True, 0.1)
+            except Empty:
+                break
+            except (OSError, EOFError):
+                break
+            self._dispatch(event)
+
+    def _connect(self):
+        if self.websocket is not None:
+            return True
+        if time.monotonic() < self._unsupported_until or not self.core.config.get("bulk_connection", True):
+            return False
+
+        from websocket import create_connection
+
+        try:
+            logger.info(f"Connecting bulk websocket {self.url}")
+            websocket = create_connection(
+                self.url,
+                header=self.core.connection_headers(),
+                sslopt={
+                    "cert_reqs": ssl.CERT_NONE
+                },
+                timeout=30
+            )
+        except Exception as e:
+            logger.info(f"Bulk connection unavailable, using the main connection ({e})")
+            self._unsupported_until = time.monotonic() + self.retry_after
+            return False
+
+        response_headers = websocket.getheaders() or {}
+        self.compressor.reset()
+        self.compressor.enabled = response_headers.get(LaneCompressor.header.lower()) == LaneCompressor.method
+        self._server_closed.clear()
+        self.websocket = websocket
+        self.reader = Thread(target=self._read, args=(websocket,), daemon=True)
+        self.reader.start()
+        return True
+
+    def _read(self, websocket):
+        """
+        Read from the connection so pings are answered and a close from the server is noticed
+        """
+        from websocket import WebSocketTimeoutException
+
+        while True:
+            try:
+                data = websocket.recv()
+            except WebSocketTimeoutException:
+                continue
+            except Exception as e:
+                if websocket is self.websocket:
+                    logger.info(f"Bulk websocket closed ({e})")
+                break
+            if not data:
+                # the server closed the connection, recv already answered the close frame
+                logger.info("Bulk websocket closed by the server")
+                break
+            logger.debug("Ignoring message on the bulk connection %s", Truncated(data))
+        self._server_closed.set()
+
+    def _close(self):
+        websocket, self.websocket = self.websocket, None
+        if websocket is None:
+            return
+        logger.info(f"Disconnecting bulk websocket {self.url}")
+        try:
+            websocket.send_close()
+        except Exception:
+            pass
+        # wake up the reader before closing the socket under it
+        websocket.abort()
+        if self.reader is not None:
+            self.reader.join(5)
+            self.reader = None
+        websocket.shutdown()
+
+    def _send(self, event):
+        if isinstance(event, bytes):
+            self.websocket.send_binary(event)
+            return
+        event, spool_seq = SpoolSender.local_seq(event)
+        frame = self.compressor.encode(self.compressor.lane(event), json.dumps(event))
+        if isinstance(frame, bytes):
+            self.websocket.send_binary(frame)
+        else:
+            self.websocket.send(frame)
+        if spool_seq is not None:
+            self.core.spool_sender.written(spool_seq)
+
+    def _dispatch(self, event):
+        if self._server_closed.is_set():
+            self._close()
+
+        if self._connect():
+            try:
+                self._send(event)
+                self._last_sent = time.monotonic()
+                return
+            except Exception as e:
+                logger.warning(f"Error sending on the bulk connection, falling back to the main connection ({e})")
+                self._close()
+                self._unsupported_until = time.monotonic() + self.retry_after
+
+        # the main send loop is the only writer of the main connection
+        self.core.queue.put(event)
+
+    def _run(self):
+        logger.debug("Starting bulk send loop")
+        while self.running:
+            try:
+                event = self.queue.get(True, 1)
+            except Empty:
+                if self.websocket is not None and (
+                        self._server_closed.is_set() or time.monotonic() - self._last_sent > self.idle_timeout):
+                    self._close()
+                continue
+            except (OSError, EOFError) as e:
+                logger.error(f"Error reading from bulk queue ({e})")
+                break
+
+            self._dispatch(event)
+
+        logger.debug("Stopped bulk send loop")
+
+
+class Spool:
+
+    """
+    Durable, append-only log of outbound messages that must survive a dropped connection or a restart
+    Records are appended to numbered segment files and made durable with a group commit,
+    appenders wait for the fsync that covers their record, records appended while an fsync
+    is running are all covered by the next one
+    The fsync runs without the lock held so appending never waits for the disk
+    Segments are deleted once every record in them is acknowledged, if the spool grows past
+    max_bytes the oldest segments are dropped
+
+    Record format
+
+        length (uint32) | crc32 of seq and payload (uint32) | seq (uint64) | json payload
+    """
+
+    record_header = struct.Struct(">IIQ")
+    segment_suffix = ".seg"
+    acked_file = "acked"
+
+    def __init__(self, directory, max_bytes=16 * 1024 * 1024, segment_bytes=1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.dropped = 0
+        self.commits = 0
+        self._lock = Lock()
+        self._committed = Condition(self._lock)
+        # [first seq, path, size, last seq] for every segment, oldest first
+        self._segments = []
+        self._file = None
+        self._last_seq = 0
+        self._synced_seq = 0
+        self._committing = False
+        self.acked = 0
+        self._acked_saved = 0
+        self._thread = None
+        self._running = False
+        self._open()
+
+    def _segment_path(self, first_seq):
+        return os.path.join(self.directory, f"{first_seq:016d}{self.segment_suffix}")
+
+    def _open(self):
+        # the directory is created with the first segment, a client that never spools doesn't need it
+        if not os.path.isdir(self.directory):
+            return
+        try:
+            self.acked = self._acked_saved = int(Utils.read_file(os.path.join(self.directory, self.acked_file), "0"))
+        except ValueError:
+            self.acked = self._acked_saved = 0
+
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith(self.segment_suffix):
+                continue
+            path = os.path.join(self.directory, name)
+            valid_size, first_seq, last_seq = 0, None, None
+            for seq, _payload, end in self._scan(path):
+                valid_size, last_seq = end, seq
+                first_seq = seq if first_seq is None else first_seq
+            if last_seq is None or last_seq <= self.acked:
+                os.remove(path)
+                continue
+            if valid_size < os.path.getsize(path):
+                # a torn write from a crash, drop the partial record
+                logger.warning(f"Truncating damaged spool segment {path} at {valid_size} bytes")
+                os.truncate(path, valid_size)
+            self._segments.append([first_seq, path, valid_size, last_seq])
+
+        self._last_seq = self._synced_seq = max(self.acked, self._segments[-1][3] if self._segments else 0)
+        if self._segments:
+            logger.info(f"Spool has {self._last_seq - self.acked} unacknowledged messages")
+
+    def _scan(self, path):
+        """
+        Yield (seq, payload, end offset) for every valid record in a segment file
+        """
+        try:
+            with open(path, "rb") as infile:
+                data = infile.read()
+        except OSError as e:
+            logger.error(f"Error reading spool segment {path} ({e})")
+            return
+        offset = 0
+        while offset + self.record_header.size <= len(data):
+            length, crc, seq = self.record_header.unpack_from(data, offset)
+            start = offset + self.record_header.size
+            payload = data[start:start + length]
+            if len(payload) < length or zlib.crc32(payload, zlib.crc32(struct.pack(">Q", seq))) != crc:
+                return
+            offset = start + length
+            yield seq, payload, offset
+
+    def start(self):
+        self._running = True
+        self._thread = Thread(target=self._commit_loop, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        with self._lock:
+            self._running = False
+            self._committed.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self._lock:
+            self._commit()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def append(self, message, timeout=5):
+        """
+        Add a message and wait until it's on disk, returns its sequence number
+        """
+        payload = json.dumps(message).encode("utf-8")
+        with self._lock:
+            self._last_seq += 1
+            seq = self._last_seq
+            segment = self._segments[-1] if self._segments else None
+            if self._file is None or segment is None or segment[2] >= self.segment_bytes:
+                segment = self._new_segment(seq)
+
+            crc = zlib.crc32(payload, zlib.crc32(struct.pack(">Q", seq)))
+            self._file.write(self.record_header.pack(len(payload), crc, seq) + payload)
+            segment[2] += self.record_header.size + len(payload)
+            segment[3] = seq
+            self._enforce_limit()
+
+            if not self._running:
+                # no committer running, commit inline
+                self._commit()
+            else:
+                self._committed.notify_all()
+                self._committed.wait_for(lambda: self._synced_seq >= seq or not self._running, timeout)
+        return seq
+
+    def _new_segment(self, first_seq):
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._segment_path(first_seq)
+        self._file = open(path, "ab")
+        segment = [first_seq, path, 0, first_seq]
+        self._segments.append(segment)
+        return segment
+
+    def _enforce_limit(self):
+        total = sum(segment[2] for segment in self._segments)
+        while total > self.max_bytes and len(self._segments) > 1:
+            first_seq, path, size, last_seq = self._segments.pop(0)
+            dropped = last_seq - max(first_seq - 1, self.acked)
+            if dropped > 0:
+                self.dropped += dropped
+                logger.warning(f"Spool is full, dropped {dropped} unacknowledged messages")
+            self.acked = max(self.acked, last_seq)
+            total -= size
+            os.remove(path)
+
+    def _commit(self):
+        """
+        Make every record appended so far durable and save the acknowledged seq, called with the lock held
+        The lock is released while syncing, records appended meanwhile are left for the next commit
+        """
+        self._committed.wait_for(lambda: not self._committing)
+        seq, acked = self._last_seq, self.acked
+        fd = None
+        if self._file is not None and self._synced_seq < seq:
+            self._file.flush()
+            # the segment can be rotated and closed while syncing, the duplicate keeps it open
+            fd = os.dup(self._file.fileno())
+        if fd is None and acked == self._acked_saved:
+            return
+
+        self._committing = True
+        self._lock.release()
+        try:
+            if fd is not None:
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+            if acked != self._acked_saved:
+                Utils.save_file_atomic(os.path.join(self.directory, self.acked_file), str(acked))
+        finally:
+            self._lock.acquire()
+            self._committing = False
+            self._committed.notify_all()
+
+        if fd is not None:
+            self._synced_seq = max(self._synced_seq, seq)
+            self.commits += 1
+        if acked != self._acked_saved:
+            self._acked_saved = acked
+            self._compact()
+
+    def _compact(self):
+        # whole segments whose acknowledgement is saved aren't needed anymore, the active segment is kept open
+        while len(self._segments) > 1 and self._segments[0][3] <= self._acked_saved:
+            os.remove(self._segments.pop(0)[1])
+
+    def _commit_loop(self):
+        with self._lock:
+            while self._running:
+                self._committed.wait_for(
+                    lambda: not self._running or self._synced_seq < self._last_seq or self.acked != self._acked_saved
+                )
+                if not self._running:
+                    break
+                self._commit()
+
+    def acknowledge(self, seq):
+        """
+        Acknowledge every record up to and including seq
+        """
+        with self._lock:
+            seq = min(int(seq), self._last_seq)
+            if seq > self.acked:
+                self.acked = seq
+                if self._running:
+                    self._committed.notify_all()
+                else:
+                    self._commit()
+
+    @property
+    def last_seq(self):
+        return self._last_seq
+
+    def read(self, after_seq, limit=64):
+        """
+        Return up to limit (seq, message) records after after_seq, in order
+        """
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+            segments = [list(segment) for segment in self._segments if segment[3] > after_seq]
+
+        records = []
+        for first_seq, path, size, last_seq in segments:
+            for seq, payload, _end in self._scan(path):
+                if seq > after_seq:
+                    records.append((seq, json.loads(payload)))
+                    if len(records) >= limit:
+                        return records
+        return records
+
+    def report(self):
+        return {
+            "last_seq": self._last_seq,
+            "acked": self.acked,
+            "segments": len(self._segments),
+            "bytes": sum(segment[2] for segment in self._segments),
+            "commits": self.commits,
+            "dropped": self.dropped,
+        }
+
+
+class SpoolSender:
+
+    """
+    Send spooled messages in order, with a window of unacknowledged messages
+    Each message is sent with its sequence number in a top level "seq" key, the server acknowledges
+    cumulatively with {"type": "spool", "data": {"type": "ack", "data": {"seq": <seq>}}} and ignores
+    sequence numbers it has already seen, unacknowledged messages are sent again after a reconnect
+    Servers that don't acknowledge (no spool header in the handshake response) get each message once,
+    a message is acknowledged locally once a send loop has written it to the websocket, messages
+    that were queued but not written are sent again when the client restarts
+    """
+
+    header = "Support-Device-Spool"
+    method = "ack"
+
+    name = "spool"
+
+    # key carrying the sequence number of a message to the send loops when the server doesn't acknowledge,
+    # it is removed before sending
+    local_ack_key = "_spool_seq"
+
+    # messages sent but not acknowledged yet
+    window = 32
+
+    # seconds without an acknowledgement before unacknowledged messages are sent again
+    resend_after = 30
+
+    def __init__(self, spool, queue):
+        self.spool = spool
+        self.queue = queue
+        self.acks = False
+        self.running = False
+        self.thread = None
+        self._sent_seq = spool.acked
+        self._progress_at = time.monotonic()
+        self._wake = Event()
+        # sequence numbers written to the websocket ahead of an earlier message, when not using acks
+        self._written = set()
+        self._written_lock = Lock()
+
+    @classmethod
+    def local_seq(cls, event):
+        """
+        Return the event without the local acknowledgement key and its sequence number (None if it has none)
+        """
+        if isinstance(event, dict) and cls.local_ack_key in event:
+            event = dict(event)
+            return event, event.pop(cls.local_ack_key)
+        return event, None
+
+    def written(self, seq):
+        """
+        Called by the send loops once a message was written to the websocket, acknowledges it locally
+        Bulk messages that fall back to the main connection can be written out of order,
+        so only the messages up to the first one that hasn't been written are acknowledged
+        """
+        with self._written_lock:
+            acked = self.spool.acked
+            self._written = {s for s in self._written if s > acked}
+            self._written.add(seq)
+            while acked + 1 in self._written:
+                acked += 1
+                self._written.discard(acked)
+        self.spool.acknowledge(acked)
+
+    def put(self, message):
+        """
+        Spool a message durably and send it when possible, used like a queue by modules
+        """
+        self.spool.append(message)
+        self._wake.set()
+
+    def start(self):
+        self.running = True
+        self._sent_seq = self.spool.acked
+        self.thread = Thread(target=self._run)
+        self.thread.start()
+        # send anything left over from before
+        self._wake.set()
+
+    def stop(self):
+        self.running = False
+        self._wake.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def event(self, ev):
+        if isinstance(ev, dict) and ev.get("type") == "ack":
+            self.spool.acknowledge((ev.get("data") or {}).get("seq", 0))
+            self._progress_at = time.monotonic()
+            self._wake.set()
+
+    def _run(self):
+        logger.debug("Starting spool send loop")
+        while self.running:
+            self._wake.wait(1)
+            self._wake.clear()
+
+            acked = self.spool.acked
+            outstanding = self._sent_seq > acked
+            if self.acks and self._sent_seq > acked and time.monotonic() - self._progress_at > self.resend_after:
+                logger.info(f"No acknowledgement for spooled messages after {acked}, sending them again")
+                self._sent_seq = acked
+                self._progress_at = time.monotonic()
+            self._sent_seq = max(self._sent_seq, acked)
+
+            budget = self.window - (self._sent_seq - acked) if self.acks else self.window
+            if budget <= 0 or self._sent_seq >= self.spool.last_seq:
+                continue
+
+            try:
+                for seq, message in self.spool.read(self._sent_seq, budget):
+                    self.queue.put({**message, "seq": seq} if self.acks else {**message, self.local_ack_key: seq})
+                    self._sent_seq = seq
+            except (OSError, ValueError) as e:
+                logger.error(f"Error sending spooled messages ({e})")
+                break
+            if not outstanding:
+                # the resend timer starts with the first unacknowledged message
+                self._progress_at = time.monotonic()
+            # there may be more to send
+            self._wake.set()
+
+        logger.debug("Stopped spool send loop")
+
+
 class Core:
 
     websocket_url = f"{Config.ws_endpoint}/ws/deviceconnect/"
 
-    def __init__(self):
+    def __init__(self, lazy_modules=False):
         self.private_key = Utils.load_private_key(Config.private_key_file) or Utils.generate_key()
         self.config = Config()
         self.api = API()
@@ -400,31 +1414,62 @@ class Core:
         self.queue = Queue()
         self.send_thread = None
         self.running = False
-        self.info = Info()
+        self.inventory_cache = InventoryCache(Config.inventory_cache_file)
+        self.info = Info(cache=self.inventory_cache)
+        self.compressor = LaneCompressor()
+        self.bulk = BulkLink(self)
+        # modules put large, non interactive messages here
+        self.bulk_queue = self.bulk.queue
+        self.spool = Spool(Config.spool_dir, max_bytes=int(self.config.get("spool_max_bytes", 16 * 1024 * 1024)))
+        self.spool_sender = SpoolSender(self.spool, self.bulk_queue)
+        # messages that must reach the server even if the connection drops or the client restarts
+        self.durable_queue = self.spool_sender
 
         self.modules = {}
         self.event_keys = {}
-        for name, clz in registered_modules.items():
+        self.binary_keys = {}
+        for name, entry in module_manifest.items():
+            if lazy_modules and entry.get("lazy"):
+                # placeholder until the first event for this module arrives
+                for event_key in entry["event_keys"]:
+                    self.event_keys[event_key] = name
+                for binary_key in entry.get("binary_keys", []):
+                    self.binary_keys[binary_key] = name
+            else:
+                self._load_module(name)
+        self.event_keys[SpoolSender.name] = self.spool_sender
+
+    def _load_module(self, name):
+        with startup_profile.measure(f"load {name}"):
+            clz = load_module(name)
             module = clz(self, self.queue)
-            self.modules[name] = module
-            if module.event_keys:
-                for event_key in clz.event_keys:
-                    self.event_keys[event_key] = module
+        self.modules[name] = module
+        if module.event_keys:
+            for event_key in clz.event_keys:
+                self.event_keys[event_key] = module
+        for binary_key in clz.binary_keys:
+            self.binary_keys[binary_key] = module
+        return module
 
     def __enter__(self):
         self.running = True
 
         try:
-            self.connect()
+            with startup_profile.measure("connect"):
+                self.connect()
         except ConnectionError:
             sys.exit(1)
 
         self.send_thread = Thread(target=self._send_loop)
         self.send_thread.start()
+        self.bulk.start()
+        self.spool.start()
+        self.spool_sender.start()
 
         for module in self.modules.values():
             logger.debug(f"Starting module {module.name}")
-            module.startup()
+            with startup_profile.measure(f"startup {module.name}"):
+                module.startup()
 
         logger.info(f"Core startup complete")
 
@@ -436,30 +1481,77 @@ class Core:
             logger.debug(f"Stopping module {module.name}")
             module.shutdown()
 
+        self.spool_sender.stop()
+        # bulk messages that can't be sent on their own connection are handed to the main send loop
+        self.bulk.stop()
         self.running = False
 
         self.send_thread.join()
         self.queue.close()
         self.disconnect()
+        self.spool.close()
 
+        self.compressor.log_report()
+        self.bulk.compressor.log_report()
+        logger.info(f"Command execution stats {json.dumps(command_executor.report())}")
+        logger.info(f"Spool stats {json.dumps(self.spool.report())}")
         logger.info(f"Core shutdown complete")
 
     def get_handler(self, event_key):
-        return self.event_keys.get(event_key)
+        return self._resolve_handler(self.event_keys.get(event_key), event_key)
+
+    def get_binary_handler(self, binary_key):
+        return self._resolve_handler(self.binary_keys.get(binary_key), binary_key)
+
+    def _resolve_handler(self, handler, event_key):
+        if isinstance(handler, str):
+            # lazy module that hasn't been loaded yet
+            logger.info(f"Loading module {handler} for event {event_key}")
+            started = time.perf_counter()
+            handler = self._load_module(handler)
+            if self.running:
+                handler.startup()
+            logger.debug(f"Loaded module {handler.name} in {(time.perf_counter() - started) * 1000:.1f} ms")
+        return handler
+
+    def _send(self, event):
+        if isinstance(event, bytes):
+            # binary module frames are sent as they are
+            self.websocket.send_binary(event)
+            return
+
+        event, spool_seq = SpoolSender.local_seq(event)
+        _msg = json.dumps(event)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Websocket send [%s]", Truncated(_msg))
+        frame = self.compressor.encode(self.compressor.lane(event), _msg)
+        if isinstance(frame, bytes):
+            self.websocket.send_binary(frame)
+        else:
+            self.websocket.send(frame)
+        if spool_seq is not None:
+            self.spool_sender.written(spool_seq)
 
     def _send_loop(self):
         logger.debug("Starting core send loop")
         while self.running:
             try:
-                event = self.queue.get(True, 1)
-                _msg = json.dumps(event)
-                logger.debug(f"Websocket send [{_msg}]")
-                self.websocket.send(_msg)
+                self._send(self.queue.get(True, 1))
             except (OSError, EOFError) as e:
                 logger.error(f"Error reading from queue ({e})")
+                self.running = False
                 break
             except Empty:
                 pass
+        else:
+            # stopping, send what modules queued while shutting down
+            try:
+                while True:
+                    self._send(self.queue.get_nowait())
+            except Empty:
+                pass
+            except Exception as e:
+                logger.warning(f"Could not send queued messages while stopping ({e})")
 
         self.running = False
         logger.debug("Stopped core send loop")
@@ -488,6 +1580,8 @@ class Core:
                 device_id=device.uuid,
                 workgroup_uuid=workgroup_uuid
             )
+            # the device can't reconnect without these, don't leave them to the write-behind
+            self.config.flush()
             return True
 
         except Exception as e:
@@ -495,6 +1589,15 @@ class Core:
             logger.exception(error_message)
             raise ConnectionError(error_message)
 
+    def connection_headers(self):
+        device_id = self.config.get("device_id")
+        signature = Utils.get_signature(device_id, self.private_key)
+        return {
+            **API.auth_headers(device_id, signature),
+            LaneCompressor.header: LaneCompressor.method,
+            SpoolSender.header: SpoolSender.method,
+        }
+
     def connect(self):
         workgroup_uuid = self.config.get("workgroup_uuid")
         device_id = self.config.get("device_id")
@@ -503,13 +1606,14 @@ class Core:
             logger.critical(error_msg)
             raise ConnectionError(error_msg)
 
-        signature = Utils.get_signature(device_id, self.private_key)
+        # websocket-client is only imported once there is something to connect to
+        from websocket import create_connection
 
         try:
             logger.info(f"Connecting websocket {self.websocket_url}")
             self.websocket = create_connection(
                 self.websocket_url,
-                header=API.auth_headers(device_id, signature),
+                header=self.connection_headers(),
                 sslopt={
                     "cert_reqs": ssl.CERT_NONE
                 }
@@ -519,6 +1623,13 @@ class Core:
             logger.critical(error_message)
             raise ConnectionError(error_message)
 
+        # only compress if the server accepted the compression method
+        response_headers = self.websocket.getheaders() or {}
+        self.compressor.reset()
+        self.compressor.enabled = response_headers.get(LaneCompressor.header.lower()) == LaneCompressor.method
+        logger.info(f"Outbound compression {'enabled' if self.compressor.enabled else 'disabled'}")
+        self.spool_sender.acks = response_headers.get(SpoolSender.header.lower()) == SpoolSender.method
+
     def disconnect(self):
         logger.info(f"Disconnecting websocket {self.websocket_url}")
         if self.websocket:
@@ -578,13 +1689,26 @@ def main():
     parser.add_argument("--log-level", choices=[
         "debug", "info", "warning", "error", "critical"
     ], default="info")
+    parser.add_argument("--log-module-level", action="append", default=[], metavar="MODULE=LEVEL",
+                        help="Override the log level of a module, for example modules.addons.sync=debug")
+    parser.add_argument("--log-payload-limit", type=int, default=512,
+                        help="Maximum characters of a websocket payload to log, 0 logs everything")
+    parser.add_argument("--refresh-inventory", action="store_true", help="Discard the cached hardware inventory")
+    parser.add_argument("--lazy-modules", action="store_true", help="Load addon modules when their first event arrives")
+    parser.add_argument("--profile-startup", action="store_true", help="Print import and startup timings")
 
     args = parser.parse_args()
 
     # set the log level
-    logger.setLevel(getattr(logging, args.log_level.upper()))
+    module_levels = dict(item.split("=", 1) for item in args.log_module_level if "=" in item)
+    configure_logging(args.log_level, module_levels=module_levels, payload_limit=args.log_payload_limit or None)
+
+    with startup_profile.measure("core init"):
+        core = Core(lazy_modules=args.lazy_modules)
 
-    core = Core()
+    if args.refresh_inventory:
+        core.inventory_cache.invalidate()
+        core.inventory_cache.flush()
 
     provisioned = all([core.config.get("device_id"), core.private_key])
     if args.workgroup and args.workgroup != core.config.get("workgroup_uuid"):
@@ -592,24 +1716,38 @@ def main():
         provisioned = core.provision(args.workgroup, **core.info.to_dict()) is True
 
     if args.provision_only is True:
+        if args.profile_startup:
+            print(startup_profile.report(), file=sys.stderr)
         sys.exit(0 if provisioned else 1)
 
+    from websocket import WebSocketConnectionClosedException
+
     with core as ws:
 
+        if args.profile_startup:
+            print(startup_profile.report(), file=sys.stderr)
+
         while core.running:
             try:
 
                 # receive message from websocket
-                logger.debug(f"Waiting for messages")
-
                 data = ws.recv()
 
                 if data:
-                    logger.debug(f"Websocket receive [{data}]")
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug("Websocket receive [%s]", Truncated(data))
                 else:
                     logger.warning("Websocket received empty data")
                     continue
 
+                # binary module frame, \x00 followed by the binary key of the module
+                if isinstance(data, bytes) and data[:1] == b"\x00":
+                    handler = core.get_binary_handler(data[1:2].decode(errors="replace"))
+                    if handler:
+                        handler.binary_event(data)
+                    else:
+                        logger.info("Unhandled binary message with key %r", data[1:2])
+                    continue
 
                 msg = json.loads(data)
 
@@ -619,7 +1757,7 @@ def main():
 
                     handler = core.get_handler(_type)
                     if handler:
-                        logger.debug(f"Handling message with handler {handler.name}")
+                        logger.debug("Handling message with handler %s", handler.name)
                         handler.event(_data)
                         continue
 
@@ -630,14 +1768,14 @@ def main():
 
                     handler = core.get_handler(_type)
                     if handler:
-                        logger.debug(f"Handling message with handler {handler.name}")
+                        logger.debug("Handling message with handler %s", handler.name)
                         handler.event(_data)
                         continue
 
                 # unknown event
-                logger.info(f"Unhandled message from client {msg}")
+                logger.info("Unhandled message from client %s", Truncated(msg))
 
-            except websocket.WebSocketConnectionClosedException as e:
+            except WebSocketConnectionClosedException as e:
                 logger.error(f"Websocket closed unexpectedly ({e})")
                 break
 
@@ -1,14 +1,20 @@
 # -*- mode: python ; coding: utf-8 -*-
+import os
+from PyInstaller.utils.hooks import collect_submodules
 
 
 block_cipher = None
 
+# RCLIENT_ONEDIR=1 builds an unpacked bundle that doesn't extract itself on every start
+onedir = os.environ.get("RCLIENT_ONEDIR") == "1"
+
 
 a = Analysis(['rclient.py'],
              pathex=['./', './modules', './app/venv/lib/python3.8/site-packages/'],
              binaries=[],
              datas=[],
-             hiddenimports=[],
+             # addons are imported by name from the module manifest
+             hiddenimports=collect_submodules('modules'),
              hookspath=[],
              hooksconfig={},
              runtime_hooks=[],
@@ -20,21 +26,45 @@ a = Analysis(['rclient.py'],
 pyz = PYZ(a.pure, a.zipped_data,
              cipher=block_cipher)
 
-exe = EXE(pyz,
-          a.scripts,
-          a.binaries,
-          a.zipfiles,
-          a.datas,  
-          [],
-          name='rclient',
-          debug=False,
-          bootloader_ignore_signals=False,
-          strip=False,
-          upx=True,
-          upx_exclude=[],
-          runtime_tmpdir=None,
-          console=True,
-          disable_windowed_traceback=False,
-          target_arch=None,
-          codesign_identity=None,
-          entitlements_file=None )
+if onedir:
+    exe = EXE(pyz,
+              a.scripts,
+              [],
+              exclude_binaries=True,
+              name='rclient',
+              debug=False,
+              bootloader_ignore_signals=False,
+              strip=False,
+              upx=True,
+              console=True,
+              disable_windowed_traceback=False,
+              target_arch=None,
+              codesign_identity=None,
+              entitlements_file=None )
+    coll = COLLECT(exe,
+                   a.binaries,
+                   a.zipfiles,
+                   a.datas,
+                   strip=False,
+                   upx=True,
+                   upx_exclude=[],
+                   name='rclient')
+else:
+    exe = EXE(pyz,
+              a.scripts,
+              a.binaries,
+              a.zipfiles,
+              a.datas,  
+              [],
+              name='rclient',
+              debug=False,
+              bootloader_ignore_signals=False,
+              strip=False,
+              upx=True,
+              upx_exclude=[],
+              runtime_tmpdir=None,
+              console=True,
+              disable_windowed_traceback=False,
+              target_arch=None,
+              codesign_identity=None,
+              entitlements_file=None )
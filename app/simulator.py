@@ -0,0 +1,683 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import logging
+import os
+import random
+import ssl
+import struct
+import sys
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urlsplit
+
+from Crypto.PublicKey import RSA
+
+from rclient import Core, Utils, API
+from modules.util import read_text, parse_key_values, configure_logging
+
+"""
+Fleet simulator for capacity planning
+
+Runs many virtual devices in one process on a single asyncio loop, each with its own key, config,
+synthetic inventory and websocket connection, and reports connection setup and message rates
+
+    # against a local stand-in server
+    python simulator.py --agents 1000 --serve
+
+    # against a real server, every device still has to be provisioned there first
+    python simulator.py --agents 100 --url wss://example.com/ws/deviceconnect/
+
+The websocket client and server are a small RFC 6455 implementation on asyncio streams, they only
+support what the client uses: text and binary frames, ping / pong and close
+Virtual devices don't compress outbound frames
+"""
+
+
+logger = logging.getLogger(__name__)
+
+
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+
+class WebSocket:
+
+    """
+    Minimal websocket over an asyncio stream, clients mask their frames and servers don't
+    """
+
+    OP_CONTINUATION = 0x0
+    OP_TEXT = 0x1
+    OP_BINARY = 0x2
+    OP_CLOSE = 0x8
+    OP_PING = 0x9
+    OP_PONG = 0xA
+
+    def __init__(self, reader, writer, client=True):
+        self.reader = reader
+        self.writer = writer
+        self.client = client
+        self.closed = False
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    @staticmethod
+    def accept_key(key):
+        return base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode()).digest()).decode()
+
+    @staticmethod
+    def _mask(key, data):
+        size = len(data)
+        if not size:
+            return data
+        repeated = (key * (size // 4 + 1))[:size]
+        return (int.from_bytes(data, "big") ^ int.from_bytes(repeated, "big")).to_bytes(size, "big")
+
+    def _frame(self, opcode, payload):
+        size = len(payload)
+        mask_bit = 0x80 if self.client else 0
+        if size < 126:
+            header = struct.pack(">BB", 0x80 | opcode, mask_bit | size)
+        elif size < 65536:
+            header = struct.pack(">BBH", 0x80 | opcode, mask_bit | 126, size)
+        else:
+            header = struct.pack(">BBQ", 0x80 | opcode, mask_bit | 127, size)
+        if self.client:
+            key = os.urandom(4)
+            return header + key + self._mask(key, payload)
+        return header + payload
+
+    async def _write(self, opcode, payload):
+        frame = self._frame(opcode, payload)
+        self.writer.write(frame)
+        self.bytes_sent += len(frame)
+        await self.writer.drain()
+
+    async def send(self, message):
+        if isinstance(message, str):
+            await self._write(self.OP_TEXT, message.encode("utf-8"))
+        else:
+            await self._write(self.OP_BINARY, bytes(message))
+
+    async def _read_frame(self):
+        first, second = await self.reader.readexactly(2)
+        size = second & 0x7F
+        if size == 126:
+            size, = struct.unpack(">H", await self.reader.readexactly(2))
+        elif size == 127:
+            size, = struct.unpack(">Q", await self.reader.readexactly(8))
+        key = await self.reader.readexactly(4) if second & 0x80 else None
+        payload = await self.reader.readexactly(size)
+        self.bytes_received += size + 2
+        if key:
+            payload = self._mask(key, payload)
+        return bool(first & 0x80), first & 0x0F, payload
+
+    async def recv(self):
+        """
+        Return the next text (str) or binary (bytes) message, or None once the connection is closed
+        """
+        opcode = None
+        parts = []
+        while not self.closed:
+            try:
+                final, frame_opcode, payload = await self._read_frame()
+            except (asyncio.IncompleteReadError, ConnectionError):
+                self.closed = True
+                break
+
+            if frame_opcode == self.OP_PING:
+                await self._write(self.OP_PONG, payload)
+                continue
+            if frame_opcode == self.OP_PONG:
+                continue
+            if frame_opcode == self.OP_CLOSE:
+                await self.close()
+                break
+
+            if frame_opcode != self.OP_CONTINUATION:
+                opcode = frame_opcode
+            parts.append(payload)
+            if final:
+                data = b"".join(parts)
+                return data.decode("utf-8") if opcode == self.OP_TEXT else data
+        return None
+
+    async def close(self):
+        if not self.closed:
+            self.closed = True
+            try:
+                await self._write(self.OP_CLOSE, struct.pack(">H", 1000))
+            except ConnectionError:
+                pass
+        self.writer.close()
+
+
+async def read_http_head(reader):
+    head = (await reader.readuntil(b"\r\n\r\n")).decode("latin-1")
+    first_line, *lines = head.split("\r\n")
+    headers = {}
+    for line in lines:
+        key, _, value = line.partition(":")
+        if key:
+            headers[key.strip().lower()] = value.strip()
+    return first_line, headers
+
+
+async def ws_connect(url, headers):
+    parts = urlsplit(url)
+    secure = parts.scheme == "wss"
+    port = parts.port or (443 if secure else 80)
+    ssl_context = None
+    if secure:
+        # same as the client, the server certificate isn't verified
+        ssl_context = ssl.create_default_context()
+        ssl_context.check_hostname = False
+        ssl_context.verify_mode = ssl.CERT_NONE
+
+    reader, writer = await asyncio.open_connection(parts.hostname, port, ssl=ssl_context)
+    key = base64.b64encode(os.urandom(16)).decode()
+    request = [
+        f"GET {parts.path or '/'}{'?' + parts.query if parts.query else ''} HTTP/1.1",
+        f"Host: {parts.netloc}",
+        "Upgrade: websocket",
+        "Connection: Upgrade",
+        f"Sec-WebSocket-Key: {key}",
+        "Sec-WebSocket-Version: 13",
+        *[f"{k}: {v}" for k, v in headers.items()],
+    ]
+    writer.write(("\r\n".join(request) + "\r\n\r\n").encode("latin-1"))
+    await writer.drain()
+
+    status, response_headers = await read_http_head(reader)
+    if " 101 " not in f"{status} " or response_headers.get("sec-websocket-accept") != WebSocket.accept_key(key):
+        writer.close()
+        raise ConnectionError(f"Websocket handshake failed ({status})")
+    return WebSocket(reader, writer, client=True)
+
+
+class FleetStats:
+
+    """
+    Counters shared by every virtual device, rates are reported against the previous report
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.connected = 0
+        self.connect_failures = 0
+        self.connect_times = []
+        self.first_connect = None
+        self.last_connect = None
+        self.sent = Counter()
+        self.received = Counter()
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self._last_report = (self.started, 0, 0)
+
+    def connection(self, duration):
+        now = time.monotonic()
+        self.connected += 1
+        self.connect_times.append(duration)
+        self.first_connect = self.first_connect or now
+        self.last_connect = now
+
+    def record_sent(self, kind, size):
+        self.sent[kind] += 1
+        self.bytes_sent += size
+
+    def record_received(self, kind, size):
+        self.received[kind] += 1
+        self.bytes_received += size
+
+    def report(self, agents, base_rss):
+        now = time.monotonic()
+        last_time, last_sent, last_received = self._last_report
+        sent, received = sum(self.sent.values()), sum(self.received.values())
+        elapsed = max(now - last_time, 1e-6)
+        self._last_report = (now, sent, received)
+
+        connect_times = sorted(self.connect_times)
+        setup_window = (self.last_connect - self.first_connect) if self.connected > 1 else None
+        rss = parse_key_values(read_text("/proc/self/status")).get("VmRSS")
+        rss_bytes = int(rss.split()[0]) * 1024 if rss else None
+
+        return {
+            "elapsed": round(now - self.started, 1),
+            "agents": agents,
+            "connected": self.connected,
+            "connect_failures": self.connect_failures,
+            "connect_rate": round((self.connected - 1) / setup_window, 1) if setup_window else None,
+            "connect_ms": {
+                "p50": round(connect_times[len(connect_times) // 2] * 1000, 1),
+                "p99": round(connect_times[int(len(connect_times) * 0.99)] * 1000, 1),
+            } if connect_times else None,
+            "sent_per_second": round((sent - last_sent) / elapsed, 1),
+            "received_per_second": round((received - last_received) / elapsed, 1),
+            "sent": dict(self.sent),
+            "received": dict(self.received),
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+            # with --serve the stand-in server's connections are included
+            "rss": rss_bytes,
+            "rss_per_agent": round((rss_bytes - base_rss) / agents) if rss_bytes and base_rss and agents else None,
+        }
+
+
+class SyntheticDevice:
+
+    """
+    Plausible, stable inventory for a virtual device, seeded by its index
+    Every device shares one package list so the per-agent footprint stays close to the real client's
+    """
+
+    manufacturers = {
+        "Dell Inc.": ["OptiPlex 7070", "PowerEdge R640", "Latitude 5400"],
+        "LENOVO": ["ThinkCentre M720q", "ThinkPad T480"],
+        "Raspberry Pi Foundation": ["Raspberry Pi 4 Model B Rev 1.4"],
+        "QEMU": ["Standard PC (Q35 + ICH9, 2009)"],
+    }
+    operating_systems = [("Ubuntu", "22.04", "jammy"), ("Debian GNU/Linux", "12", "bookworm"), ("Fedora Linux", "39", None)]
+    cpus = ["Intel(R) Core(TM) i5-8500T CPU @ 2.10GHz", "AMD EPYC 7302P 16-Core Processor", "Cortex-A72"]
+
+    _packages = None
+
+    def __init__(self, index, package_count=500):
+        self.rng = random.Random(index)
+        self.index = index
+        if SyntheticDevice._packages is None or len(SyntheticDevice._packages) != package_count:
+            SyntheticDevice._packages = {f"package-{i}:amd64": f"1.{i % 17}.{i % 5}" for i in range(package_count)}
+
+        manufacturer = self.rng.choice(list(self.manufacturers))
+        os_name, os_version, os_codename = self.rng.choice(self.operating_systems)
+        self.info = {
+            "hostname": f"sim-{index:05d}",
+            "manufacturer": manufacturer,
+            "model": self.rng.choice(self.manufacturers[manufacturer]),
+            "ram": self.rng.choice([2, 4, 8, 16, 32]) * 1024 ** 3,
+            "cpu": self.rng.choice(self.cpus),
+            "operating_system": os_name,
+            "operating_system_version": os_version,
+            "operating_system_codename": os_codename,
+            "serial_number": f"SIM{self.rng.getrandbits(40):010X}",
+        }
+        self.disk_size = self.rng.choice([128, 256, 512, 1024]) * 1000 ** 3
+        self.used_space = int(self.disk_size * self.rng.uniform(0.1, 0.8))
+        self.address = f"10.{index // 65536 % 256}.{index // 256 % 256}.{index % 256}"
+        self.mac = ":".join(f"{b:02x}" for b in [0x02] + [self.rng.getrandbits(8) for _ in range(5)])
+
+    def snapshot(self):
+        return {
+            "system": self.info,
+            "network": {
+                "interfaces": [
+                    {"name": "lo", "ipv4_addresses": [{"address": "127.0.0.1", "netmask": "255.0.0.0", "broadcast": None}],
+                     "ipv6_addresses": [{"address": "::1", "prefixlen": 128}], "mac_address": "00:00:00:00:00:00",
+                     "default": False, "gateway": None},
+                    {"name": "eth0", "ipv4_addresses": [{"address": self.address, "netmask": "255.0.0.0", "broadcast": "10.255.255.255"}],
+                     "ipv6_addresses": [], "mac_address": self.mac, "default": True, "gateway": "10.0.0.1"},
+                ],
+                "default_gateway": "10.0.0.1",
+            },
+            "storage": {
+                "disks": [{
+                    "name": "/dev/sda", "model": "SIM DISK", "serial_number": self.info["serial_number"],
+                    "form_factor": None, "rotation_rate": None, "rotational": False, "total_size": self.disk_size,
+                    "volumes": [{
+                        "name": "/dev/sda1", "type": "ext4", "total_size": self.disk_size, "used_space": self.used_space,
+                        "available_space": self.disk_size - self.used_space, "mount_point": "/",
+                    }],
+                }],
+            },
+            "packages": {"dpkg": self._packages},
+        }
+
+    def churn(self):
+        """
+        Change the inventory a little and return the patch the real client would send for it
+        """
+        self.used_space = min(self.disk_size, max(0, self.used_space + self.rng.randint(-50, 50) * 1024 ** 2))
+        base = "/storage/disks/0/volumes/0"
+        return [
+            {"op": "replace", "path": f"{base}/used_space", "value": self.used_space},
+            {"op": "replace", "path": f"{base}/available_space", "value": self.disk_size - self.used_space},
+        ]
+
+
+def generate_key_pem(bits):
+    return RSA.generate(bits).exportKey("PEM")
+
+
+class VirtualAgent:
+
+    """
+    One simulated device, it behaves like Core with the sync, terminal and script modules loaded
+    Terminal output and scripts are generated at the configured rates, inbound events are answered
+    the way the real modules answer them
+    """
+
+    def __init__(self, index, private_key, options, stats):
+        self.index = index
+        self.private_key = private_key
+        self.options = options
+        self.stats = stats
+        self.device = SyntheticDevice(index, options.packages)
+        self.config = {
+            "device_id": str(uuid.UUID(int=random.Random(f"device-{index}").getrandbits(128))),
+            "workgroup_uuid": options.workgroup,
+        }
+        self.websocket = None
+        self.sync_version = 0
+        self.acked_version = None
+        self.terminals = set()
+        self.rng = random.Random(f"agent-{index}")
+
+    def connection_headers(self):
+        device_id = self.config["device_id"]
+        return API.auth_headers(device_id, Utils.get_signature(device_id, self.private_key))
+
+    async def send(self, event):
+        message = event if isinstance(event, bytes) else json.dumps(event)
+        await self.websocket.send(message)
+        kind = event.get("type") if isinstance(event, dict) else "td" if isinstance(event, str) else "binary"
+        self.stats.record_sent(kind, len(message))
+
+    async def run(self, url, duration):
+        started = time.monotonic()
+        try:
+            self.websocket = await ws_connect(url, self.connection_headers())
+        except (OSError, ConnectionError, asyncio.IncompleteReadError) as e:
+            self.stats.connect_failures += 1
+            logger.debug(f"Agent {self.index} could not connect ({e})")
+            return
+        self.stats.connection(time.monotonic() - started)
+
+        tasks = [
+            asyncio.ensure_future(self._sync_loop()),
+            asyncio.ensure_future(self._terminal_loop()),
+            asyncio.ensure_future(self._script_loop()),
+        ]
+        try:
+            await asyncio.wait_for(self._recv_loop(), timeout=duration)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await self.websocket.close()
+
+    async def _recv_loop(self):
+        while True:
+            data = await self.websocket.recv()
+            if data is None:
+                logger.debug(f"Agent {self.index} disconnected")
+                return
+            msg = data if isinstance(data, bytes) else json.loads(data)
+            if isinstance(msg, str):
+                self.stats.record_received("td", len(data))
+                _id, _, keys = msg.partition(":")[2].partition(":")
+                # echo keystrokes back like a shell would
+                await self.send(f"td:{_id}:{keys}")
+            elif isinstance(msg, dict):
+                self.stats.record_received(str(msg.get("type")), len(data))
+                await self._event(msg.get("type"), msg.get("data") or {})
+            else:
+                self.stats.record_received("binary", len(data))
+
+    async def _event(self, _type, data):
+        if _type == "sync":
+            if data.get("type") == "syncack":
+                self.acked_version = (data.get("data") or {}).get("version")
+            elif data.get("type") == "resync":
+                self.acked_version = None
+                await self._sync()
+
+        elif _type == "terminal":
+            if data.get("type") == "newterminal":
+                await self._open_terminal()
+            elif data.get("type") == "closeterminal":
+                await self._close_terminal((data.get("data") or {}).get("id"))
+
+        elif _type == "script" and data.get("type") == "queuescript":
+            asyncio.ensure_future(self._run_script(data.get("data")))
+
+    async def _sync(self):
+        self.sync_version += 1
+        if self.acked_version is None:
+            await self.send({"type": "sync", "data": {**self.device.snapshot(), "version": self.sync_version}})
+        else:
+            await self.send({
+                "type": "sync",
+                "data": {
+                    "type": "syncdelta",
+                    "data": {"base": self.acked_version, "version": self.sync_version, "patch": self.device.churn()}
+                }
+            })
+
+    async def _sync_loop(self):
+        # spread the first syncs out so a fleet doesn't sync in lockstep
+        await asyncio.sleep(self.rng.uniform(0, min(5.0, self.options.sync_interval)))
+        while True:
+            await self._sync()
+            await asyncio.sleep(self.options.sync_interval)
+
+    async def _open_terminal(self):
+        _id = len(self.terminals) + 1
+        while _id in self.terminals:
+            _id += 1
+        self.terminals.add(_id)
+        await self.send({"type": "terminal", "data": {"type": "startterminal", "data": {"id": _id}}})
+        return _id
+
+    async def _close_terminal(self, _id):
+        if _id in self.terminals:
+            self.terminals.discard(_id)
+            await self.send({"type": "terminal", "data": {"type": "stopterminal", "data": {"id": _id}}})
+
+    async def _terminal_loop(self):
+        if self.options.terminal_rate <= 0:
+            return
+        _id = await self._open_terminal()
+        while True:
+            await asyncio.sleep(self.rng.expovariate(self.options.terminal_rate))
+            line = f"{self.device.info['hostname']}:~$ {' '.join('x' * self.rng.randint(1, 12) for _ in range(self.rng.randint(1, 8)))}\r\n"
+            await self.send(f"td:{_id}:{line}")
+
+    async def _run_script(self, script_uuid):
+        await self.send({"type": "script", "data": {"type": "scriptstart", "data": {"uuid": script_uuid}}})
+        await asyncio.sleep(self.rng.uniform(0.5, 5.0))
+        output = "\n".join(f"line {i}" for i in range(self.rng.randint(1, 200)))
+        await self.send({
+            "type": "script",
+            "data": {
+                "type": "scriptend",
+                "data": {"uuid": script_uuid, "result": {"exit_code": 0, "output": output}}
+            }
+        })
+
+    async def _script_loop(self):
+        if self.options.script_rate <= 0:
+            return
+        while True:
+            # script_rate is per minute
+            await asyncio.sleep(self.rng.expovariate(self.options.script_rate / 60))
+            await self._run_script(str(uuid.uuid4()))
+
+
+class StandInServer:
+
+    """
+    Local stand-in for the server's device websocket so the fleet can run offline
+    Devices are authenticated against the public keys they were registered with, syncs are acknowledged
+    """
+
+    def __init__(self, stats):
+        self.stats = stats
+        self.public_keys = {}
+        self.connections = 0
+        self.server = None
+
+    def register(self, device_id, public_key):
+        self.public_keys[device_id] = public_key
+
+    async def start(self, host, port):
+        self.server = await asyncio.start_server(self._handle, host, port, backlog=4096)
+        port = self.server.sockets[0].getsockname()[1]
+        logger.info(f"Stand-in server listening on {host}:{port}")
+        return port
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def _reject(self, writer, status):
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Length: 0\r\n\r\n".encode("latin-1"))
+        await writer.drain()
+        writer.close()
+
+    async def _handle(self, reader, writer):
+        try:
+            _request, headers = await read_http_head(reader)
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            writer.close()
+            return
+
+        device_id = headers.get("support-device-id")
+        signature = headers.get("support-device-sig")
+        public_key = self.public_keys.get(device_id)
+        if not public_key or not signature or \
+                not Utils.verify_signature(device_id, base64.b64decode(signature), public_key):
+            await self._reject(writer, "403 Forbidden")
+            return
+
+        writer.write((
+            "HTTP/1.1 101 Switching Protocols\r\n"
+            "Upgrade: websocket\r\n"
+            "Connection: Upgrade\r\n"
+            f"Sec-WebSocket-Accept: {WebSocket.accept_key(headers.get('sec-websocket-key', ''))}\r\n\r\n"
+        ).encode("latin-1"))
+        await writer.drain()
+
+        websocket = WebSocket(reader, writer, client=False)
+        self.connections += 1
+        try:
+            while True:
+                data = await websocket.recv()
+                if data is None:
+                    break
+                if not isinstance(data, str):
+                    continue
+                msg = json.loads(data)
+                if isinstance(msg, dict) and msg.get("type") == "sync":
+                    sync = msg.get("data") or {}
+                    version = sync.get("version", (sync.get("data") or {}).get("version"))
+                    await websocket.send(json.dumps({"type": "sync", "data": {"type": "syncack", "data": {"version": version}}}))
+        except ConnectionError:
+            pass
+        finally:
+            self.connections -= 1
+            await websocket.close()
+
+
+async def load_keys(count, bits, key_file=None):
+    """
+    Return count private keys, generating them in a process pool
+    Keys are slow to generate, with a key file they are reused between runs
+    """
+    pems = []
+    if key_file:
+        data = Utils.load_json_file(key_file)
+        pems = [pem.encode() for pem in data] if isinstance(data, list) else []
+
+    missing = count - len(pems)
+    if missing > 0:
+        logger.info(f"Generating {missing} {bits} bit keys")
+        loop = asyncio.get_running_loop()
+        with ProcessPoolExecutor() as pool:
+            pems += await asyncio.gather(*[
+                loop.run_in_executor(pool, generate_key_pem, bits) for _ in range(missing)
+            ])
+        if key_file:
+            Utils.save_file_atomic(key_file, json.dumps([pem.decode() for pem in pems]))
+
+    return [RSA.importKey(pem) for pem in pems[:count]]
+
+
+async def simulate(options):
+    base_rss = parse_key_values(read_text("/proc/self/status")).get("VmRSS")
+    base_rss = int(base_rss.split()[0]) * 1024 if base_rss else None
+
+    keys = await load_keys(options.agents, options.key_bits, options.key_file)
+    stats = FleetStats()
+    agents = [VirtualAgent(i, key, options, stats) for i, key in enumerate(keys)]
+
+    server = None
+    url = options.url
+    if options.serve:
+        server = StandInServer(stats)
+        for agent in agents:
+            server.register(agent.config["device_id"], agent.private_key.publickey())
+        port = await server.start(options.listen, options.port)
+        url = url or f"ws://{options.listen}:{port}/ws/deviceconnect/"
+    url = url or Core.websocket_url
+
+    async def report():
+        while True:
+            await asyncio.sleep(options.report_interval)
+            logger.info(f"Fleet stats {json.dumps(stats.report(len(agents), base_rss))}")
+
+    reporter = asyncio.ensure_future(report())
+
+    logger.info(f"Connecting {len(agents)} agents to {url}")
+    runs = []
+    for agent in agents:
+        runs.append(asyncio.ensure_future(agent.run(url, options.duration)))
+        if options.connect_rate:
+            await asyncio.sleep(1 / options.connect_rate)
+    await asyncio.gather(*runs)
+
+    reporter.cancel()
+    if server is not None:
+        await server.stop()
+    return stats.report(len(agents), base_rss)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate a fleet of Remote Support devices in one process")
+    parser.add_argument("--agents", "-n", type=int, default=100, help="Number of virtual devices")
+    parser.add_argument("--url", type=str, help="Websocket url to connect to, defaults to the stand-in server with --serve")
+    parser.add_argument("--serve", action="store_true", help="Run a local stand-in server and connect to it")
+    parser.add_argument("--listen", type=str, default="127.0.0.1", help="Stand-in server address")
+    parser.add_argument("--port", type=int, default=0, help="Stand-in server port, 0 picks a free port")
+    parser.add_argument("--workgroup", "-w", type=str, default=None, help="Workgroup ID stored in every device config")
+    parser.add_argument("--duration", type=float, default=60.0, help="Seconds each device stays connected")
+    parser.add_argument("--connect-rate", type=float, default=0, help="New connections per second, 0 connects all at once")
+    parser.add_argument("--terminal-rate", type=float, default=0.5, help="Terminal output lines per second per device")
+    parser.add_argument("--script-rate", type=float, default=0.5, help="Scripts per minute per device")
+    parser.add_argument("--sync-interval", type=float, default=300.0, help="Seconds between inventory syncs")
+    parser.add_argument("--packages", type=int, default=500, help="Installed packages reported by every device")
+    parser.add_argument("--key-bits", type=int, default=1024, help="RSA key size of every device")
+    parser.add_argument("--key-file", type=str, help="Json file to load device keys from and save generated keys to")
+    parser.add_argument("--report-interval", type=float, default=10.0, help="Seconds between stats reports")
+    parser.add_argument("--log-level", choices=["debug", "info", "warning", "error", "critical"], default="info")
+
+    args = parser.parse_args()
+    configure_logging(args.log_level)
+
+    try:
+        result = asyncio.run(simulate(args))
+    except KeyboardInterrupt:
+        logger.info("Interrupt received")
+        sys.exit(1)
+    print(json.dumps(result, indent=True))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the client is run from the app directory, modules are imported relative to it
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,89 @@
+import unittest
+from unittest import mock
+from rclient import API
+
+
+class Response:
+
+    def __init__(self, status_code, data=None, reason="OK"):
+        self.status_code = status_code
+        self.data = data
+        self.reason = reason
+
+    def json(self):
+        if self.data is None:
+            raise ValueError("No JSON")
+        return self.data
+
+
+class PersistedQueryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.api = API()
+        self.ok = Response(200, {"data": {"support": {"newDevice": {"uuid": "device"}}}})
+
+    def query(self, *responses):
+        with mock.patch.object(self.api, "_post", side_effect=list(responses)) as post:
+            try:
+                return self.api.new_device("key", "workgroup"), post.call_args_list
+            except Exception as e:
+                return e, post.call_args_list
+
+    def test_known_hash_sends_no_text(self):
+        device, calls = self.query(self.ok)
+        self.assertEqual(device.uuid, "device")
+        self.assertNotIn("query", calls[0].args[0])
+
+    def test_unknown_hash_resends_with_text(self):
+        not_found = Response(200, {"errors": [{"message": "PersistedQueryNotFound",
+                                               "extensions": {"code": "PERSISTED_QUERY_NOT_FOUND"}}]})
+        device, calls = self.query(not_found, self.ok)
+        self.assertEqual(device.uuid, "device")
+        self.assertEqual(calls[1].args[0]["query"], API.new_device_mutation.text)
+        self.assertIn("extensions", calls[1].args[0])
+
+    def test_client_errors_resend_with_text(self):
+        for response in [
+            Response(400, reason="Bad Request"),
+            Response(400, {"errors": [{"message": "Variable $publicKey is required"}]}, "Bad Request"),
+            Response(401, reason="Unauthorized"),
+        ]:
+            with self.subTest(status=response.status_code):
+                device, calls = self.query(response, self.ok)
+                self.assertEqual(device.uuid, "device")
+                self.assertEqual(calls[1].args[0]["query"], API.new_device_mutation.text)
+                self.assertTrue(self.api.persisted_queries)
+
+    def test_server_without_persisted_queries(self):
+        missing_query = Response(400, {"errors": [{"message": "Must provide query string."}]}, "Bad Request")
+        device, calls = self.query(missing_query, self.ok)
+        self.assertEqual(device.uuid, "device")
+        self.assertEqual(calls[1].args[0], {"query": API.new_device_mutation.text, "variables": calls[1].args[0]["variables"]})
+        self.assertFalse(self.api.persisted_queries)
+
+        # the following queries are sent in full right away
+        device, calls = self.query(self.ok)
+        self.assertEqual(calls[0].args[0]["query"], API.new_device_mutation.text)
+
+    def test_unsupported_turns_persisted_queries_off(self):
+        unsupported = Response(200, {"errors": [{"message": "PersistedQueryNotSupported"}]})
+        device, calls = self.query(unsupported, self.ok)
+        self.assertEqual(device.uuid, "device")
+        self.assertFalse(self.api.persisted_queries)
+        self.assertNotIn("extensions", calls[1].args[0])
+
+    def test_server_errors_are_not_resent(self):
+        for response in [
+            Response(500, {"errors": [{"message": "Internal error"}]}, "Internal Server Error"),
+            Response(502, reason="Bad Gateway"),
+            Response(504, reason="Gateway Timeout"),
+        ]:
+            with self.subTest(status=response.status_code):
+                error, calls = self.query(response, self.ok)
+                self.assertIsInstance(error, Exception)
+                self.assertIn(str(response.status_code), str(error))
+                self.assertEqual(len(calls), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
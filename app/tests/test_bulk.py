@@ -0,0 +1,159 @@
+import base64
+import hashlib
+import json
+import queue
+import socket
+import struct
+import time
+import unittest
+from threading import Thread
+from types import SimpleNamespace
+from rclient import BulkLink
+
+
+class WebSocketServer:
+
+    """
+    Just enough of a websocket server to talk to one client at a time
+    """
+
+    def __init__(self):
+        self.listener = socket.socket()
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(4)
+        self.listener.settimeout(10)
+        self.port = self.listener.getsockname()[1]
+
+    def close(self):
+        self.listener.close()
+
+    def accept(self):
+        conn, _ = self.listener.accept()
+        conn.settimeout(10)
+        request = b""
+        while b"\r\n\r\n" not in request:
+            request += conn.recv(4096)
+        key = [line.split(b":", 1)[1].strip() for line in request.split(b"\r\n")
+               if line.lower().startswith(b"sec-websocket-key:")][0]
+        accept = base64.b64encode(hashlib.sha1(key + b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11").digest())
+        conn.sendall(b"HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                     b"Sec-WebSocket-Accept: " + accept + b"\r\n\r\n")
+        return conn
+
+    @staticmethod
+    def _read_exact(conn, size):
+        data = b""
+        while len(data) < size:
+            chunk = conn.recv(size - len(data))
+            if not chunk:
+                raise EOFError()
+            data += chunk
+        return data
+
+    @classmethod
+    def read_frame(cls, conn):
+        first, second = cls._read_exact(conn, 2)
+        length = second & 0x7f
+        if length == 126:
+            length, = struct.unpack(">H", cls._read_exact(conn, 2))
+        elif length == 127:
+            length, = struct.unpack(">Q", cls._read_exact(conn, 8))
+        mask = cls._read_exact(conn, 4)
+        payload = cls._read_exact(conn, length)
+        return first & 0x0f, bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+
+    @staticmethod
+    def send_frame(conn, opcode, payload=b""):
+        conn.sendall(bytes([0x80 | opcode, len(payload)]) + payload)
+
+
+class BrokenWebSocket:
+
+    def send(self, frame):
+        raise OSError("Broken pipe")
+
+    def send_close(self):
+        pass
+
+    def abort(self):
+        pass
+
+    def shutdown(self):
+        pass
+
+
+class BulkLinkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.config = {}
+        self.core = SimpleNamespace(
+            config=SimpleNamespace(get=lambda key, default=None: self.config.get(key, default)),
+            connection_headers=lambda: {},
+            queue=queue.Queue()
+        )
+        self.link = BulkLink(self.core)
+
+    def wait_for(self, condition, timeout=5):
+        deadline = time.monotonic() + timeout
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        return condition()
+
+    def test_pings_are_answered_and_a_server_close_is_noticed(self):
+        server = WebSocketServer()
+        self.addCleanup(server.close)
+        self.link.url = f"ws://127.0.0.1:{server.port}/"
+        results = {}
+
+        def serve():
+            conn = server.accept()
+            results["message"] = server.read_frame(conn)
+            server.send_frame(conn, 0x9, b"ping")
+            results["pong"] = server.read_frame(conn)
+            server.send_frame(conn, 0x8, struct.pack(">H", 1000))
+            results["close"] = server.read_frame(conn)
+            conn.close()
+
+            conn = server.accept()
+            results["reconnected"] = server.read_frame(conn)
+            conn.close()
+
+        thread = Thread(target=serve, daemon=True)
+        thread.start()
+        self.link.start()
+        try:
+            self.link.queue.put({"type": "sync", "data": {"version": 1}})
+            self.assertTrue(self.wait_for(lambda: "close" in results))
+            self.assertEqual(results["message"], (0x1, json.dumps({"type": "sync", "data": {"version": 1}}).encode()))
+            self.assertEqual(results["pong"], (0xa, b"ping"))
+            self.assertEqual(results["close"][0], 0x8)
+            self.assertTrue(self.wait_for(lambda: self.link.websocket is None))
+
+            self.link.queue.put({"type": "sync", "data": {"version": 2}})
+            thread.join(10)
+            self.assertEqual(json.loads(results["reconnected"][1])["data"]["version"], 2)
+        finally:
+            self.link.stop()
+        self.assertTrue(self.core.queue.empty())
+
+    def test_queued_messages_are_handed_to_the_main_queue_when_stopping(self):
+        self.config["bulk_connection"] = False
+        for i in range(50):
+            self.link.queue.put({"type": "sync", "data": {"version": i}})
+        self.link.start()
+        self.link.stop()
+
+        sent = [self.core.queue.get_nowait()["data"]["version"] for _ in range(self.core.queue.qsize())]
+        self.assertEqual(sent, list(range(50)))
+
+    def test_fallback_stays_on_the_main_connection_after_a_failed_send(self):
+        self.link.websocket = BrokenWebSocket()
+        self.link._dispatch({"type": "sync", "data": {"version": 1}})
+        self.link._dispatch({"type": "sync", "data": {"version": 2}})
+        self.assertIsNone(self.link.websocket)
+        self.assertGreater(self.link._unsupported_until, time.monotonic())
+        self.assertEqual(self.core.queue.qsize(), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+import json
+import unittest
+import zlib
+from rclient import LaneCompressor
+
+
+def decoder():
+    return zlib.decompressobj(zdict=LaneCompressor.dictionary)
+
+
+class LaneCompressorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.compressor = LaneCompressor(enabled=True)
+
+    def frame(self, event):
+        return self.compressor.encode(self.compressor.lane(event), json.dumps(event))
+
+    @staticmethod
+    def split(frame):
+        lane, _, data = frame.partition(b"\n")
+        return lane.decode(), data
+
+    def test_small_messages_are_sent_as_text(self):
+        event = {"type": "ping"}
+        self.assertEqual(self.frame(event), json.dumps(event))
+        self.assertEqual(self.compressor.report()["ping"]["compressed_frames"], 0)
+
+    def test_frames_round_trip_per_lane(self):
+        decoders = {}
+        for n in range(5):
+            for event in [
+                {"type": "sync", "data": {"system": {"hostname": f"host-{n}", "padding": "x" * 300}}},
+                f"td:{n % 2}:" + "\x1b[01;34mls -la\x1b[0m\r\n" * 30,
+            ]:
+                lane, data = self.split(self.frame(event))
+                self.assertEqual(lane, self.compressor.lane(event))
+                decoded = decoders.setdefault(lane, decoder()).decompress(data)
+                self.assertEqual(json.loads(decoded), event)
+
+        self.assertEqual(set(decoders), {"sync", "td:0", "td:1"})
+        report = self.compressor.report()
+        self.assertEqual(report["sync"]["frames"], 5)
+        self.assertLess(report["sync"]["ratio"], 1)
+
+    def test_reset_starts_new_streams(self):
+        event = {"type": "sync", "data": "y" * 500}
+        before = decoder()
+        before.decompress(self.split(self.frame(event))[1])
+
+        self.compressor.reset()
+        # the next connection decodes from a fresh stream, not the old history
+        _, data = self.split(self.frame(event))
+        self.assertEqual(json.loads(decoder().decompress(data)), event)
+        self.assertEqual(self.compressor.report()["sync"]["frames"], 2)
+
+    def test_stats_are_logged_periodically(self):
+        self.compressor.log_interval = 0
+        with self.assertLogs("rclient", level="INFO") as logs:
+            self.frame({"type": "ping"})
+        self.assertIn("Outbound compression stats", logs.output[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
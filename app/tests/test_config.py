@@ -0,0 +1,63 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+from rclient import Config, Utils
+
+
+class ConfigTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.config_file = os.path.join(self.directory.name, "config.json")
+
+    def config(self):
+        config = Config()
+        config.config_file = self.config_file
+        config.flush_delay = 0.01
+        config.retry_delay = 0.05
+        return config
+
+    def read(self):
+        with open(self.config_file) as infile:
+            return json.load(infile)
+
+    def test_changes_are_written_behind(self):
+        config = self.config()
+        config.set(device_id="abc")
+        config.set(workgroup_uuid="xyz")
+        config._timer.join()
+        self.assertEqual(self.read(), {"device_id": "abc", "workgroup_uuid": "xyz"})
+
+    def test_failed_write_is_retried(self):
+        config = self.config()
+        with mock.patch.object(Utils, "save_file_atomic", side_effect=[False, True]) as patched:
+            config.set(device_id="abc")
+            config.flush()
+            self.assertTrue(config._dirty)
+            self.assertIsNotNone(config._timer)
+            config._timer.join()
+            self.assertEqual(patched.call_count, 2)
+            self.assertFalse(config._dirty)
+
+    def test_file_mode_is_kept(self):
+        with open(self.config_file, "w") as outfile:
+            outfile.write("{}")
+        os.chmod(self.config_file, 0o644)
+        config = self.config()
+        config.set(device_id="abc")
+        config.flush()
+        self.assertEqual(os.stat(self.config_file).st_mode & 0o777, 0o644)
+        self.assertEqual(self.read(), {"device_id": "abc"})
+
+    def test_exit_handler_is_registered_once(self):
+        with mock.patch.object(Config, "_atexit_registered", False), mock.patch("atexit.register") as register:
+            self.config()
+            self.config()
+        self.assertEqual(register.call_count, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
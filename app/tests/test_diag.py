@@ -0,0 +1,63 @@
+import queue
+import threading
+import time
+import unittest
+from unittest import mock
+from modules.addons.diag import SamplingProfiler, Diagnostics
+
+
+def busy_wait(stop):
+    while not stop.is_set():
+        time.sleep(0.001)
+
+
+class SamplingProfilerTest(unittest.TestCase):
+
+    def test_stacks_of_other_threads_are_sampled(self):
+        stop = threading.Event()
+        thread = threading.Thread(target=busy_wait, args=(stop,), name="worker-under-test")
+        thread.start()
+        try:
+            profiler = SamplingProfiler(duration=0.2, interval=0.01).run()
+        finally:
+            stop.set()
+            thread.join()
+
+        self.assertGreater(profiler.samples, 5)
+        stacks = [stack for stack in profiler.stacks if stack.startswith("worker-under-test;")]
+        self.assertTrue(stacks)
+        self.assertTrue(all("busy_wait (test_diag.py:" in stack for stack in stacks))
+        # the profiler doesn't sample its own thread
+        self.assertFalse(any("SamplingProfiler" in stack or "run (diag.py" in stack for stack in profiler.stacks))
+
+    def test_duration_and_interval_are_bounded(self):
+        profiler = SamplingProfiler(duration=3600, interval=0)
+        self.assertEqual(profiler.duration, SamplingProfiler.max_duration)
+        self.assertEqual(profiler.interval, SamplingProfiler.min_interval)
+
+    def test_to_dict_keeps_the_most_common_stacks(self):
+        profiler = SamplingProfiler()
+        profiler.stacks.update({"a": 5, "b": 1, "c": 3})
+        self.assertEqual(profiler.to_dict(limit=2)["stacks"], {"a": 5, "c": 3})
+
+
+class DiagnosticsTest(unittest.TestCase):
+
+    def test_snapshots_are_taken_off_the_receive_thread(self):
+        diagnostics = Diagnostics(None, queue.Queue())
+        release = threading.Event()
+
+        def tracemalloc(action, limit):
+            release.wait(5)
+            return {"tracing": False}
+
+        with mock.patch.object(diagnostics, "tracemalloc", side_effect=tracemalloc):
+            diagnostics.event({"type": "tracemalloc", "data": {"id": 7}})
+            self.assertTrue(diagnostics.bulk_queue.empty())
+            release.set()
+            result = diagnostics.bulk_queue.get(timeout=5)["data"]["data"]
+        self.assertEqual((result["id"], result["kind"]), (7, "tracemalloc"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,125 @@
+import os
+import queue
+import tempfile
+import threading
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+from modules.addons.diskusage import DiskScanner, DiskUsage, ScanIndex
+
+
+class DiskScannerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.root = os.path.join(self.directory.name, "root")
+        os.makedirs(os.path.join(self.root, "a", "b"))
+        self.small = os.path.join(self.root, "a", "b", "small")
+        self.write(self.small, 10)
+        self.write(os.path.join(self.root, "big"), 2 * 1024 * 1024)
+        self.index = ScanIndex(os.path.join(self.directory.name, "index"), self.root)
+
+    @staticmethod
+    def write(path, size, mode="wb"):
+        with open(path, mode) as outfile:
+            outfile.write(os.urandom(size))
+
+    def scan(self):
+        scanner = DiskScanner(self.root, workers=2, index=ScanIndex(os.path.dirname(self.index.path), self.root).load().entries).run()
+        self.index.save(scanner.entries)
+        return scanner
+
+    def test_hard_links_are_counted_once(self):
+        os.link(os.path.join(self.root, "big"), os.path.join(self.root, "a", "link"))
+        scanner = self.scan()
+        self.assertEqual(scanner.totals[self.root], sum(
+            os.lstat(os.path.join(path, name)).st_blocks * 512
+            for path, _, names in os.walk(self.root) for name in names + ["."] if name != "link"
+        ))
+
+    def test_rescan_picks_up_grown_small_file(self):
+        first = self.scan()
+        self.assertEqual(first.reused, 0)
+        self.assertNotIn(self.small, first.files)
+        mtime = os.lstat(os.path.dirname(self.small)).st_mtime_ns
+
+        self.write(self.small, 3 * 1024 * 1024, "ab")
+        self.assertEqual(os.lstat(os.path.dirname(self.small)).st_mtime_ns, mtime)
+
+        second = self.scan()
+        self.assertEqual(second.reused, 3)
+        grown = os.lstat(self.small).st_blocks * 512
+        self.assertEqual(second.files[self.small], grown)
+        self.assertEqual(second.totals[os.path.dirname(self.small)] - first.totals[os.path.dirname(self.small)],
+                         grown - first.entries[os.path.dirname(self.small)].files["small"])
+        self.assertEqual(second.totals[self.root] - first.totals[self.root],
+                         second.totals[os.path.dirname(self.small)] - first.totals[os.path.dirname(self.small)])
+
+    def test_rescan_lists_changed_directories(self):
+        self.scan()
+        self.write(os.path.join(self.root, "a", "new"), 1024 * 1024)
+        os.remove(self.small)
+
+        scanner = self.scan()
+        self.assertEqual(scanner.reused, 1)
+        self.assertIn("new", scanner.entries[os.path.join(self.root, "a")].files)
+        self.assertEqual(scanner.entries[os.path.join(self.root, "a", "b")].files, {})
+        self.assertIn(os.path.join(self.root, "a", "new"), scanner.files)
+
+    def test_index_round_trip(self):
+        scanner = self.scan()
+        entries = ScanIndex(os.path.dirname(self.index.path), self.root).load().entries
+        self.assertEqual({p: e.to_list() for p, e in entries.items()},
+                         {p: e.to_list() for p, e in scanner.entries.items()})
+        self.assertEqual(ScanIndex(os.path.dirname(self.index.path), self.directory.name).load().entries, {})
+
+
+class DiskUsageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        core = SimpleNamespace(config=SimpleNamespace(base_dir=self.directory.name))
+        self.module = DiskUsage(core, queue.Queue())
+        self.release = threading.Event()
+        self.workers = []
+        run = DiskScanner.run
+
+        def blocking_run(scanner, *args, **kwargs):
+            self.workers.append(scanner.workers)
+            self.release.wait(5)
+            return run(scanner, *args, **kwargs)
+
+        for patcher in (mock.patch.object(DiskScanner, "run", blocking_run),
+                        mock.patch.object(DiskUsage, "volume", return_value=None)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def messages(self):
+        return [self.module.bulk_queue.get_nowait()["data"] for _ in range(self.module.bulk_queue.qsize())]
+
+    def finish(self):
+        self.release.set()
+        for thread in list(self.module._threads.values()):
+            thread.join()
+
+    def test_workers_are_clamped(self):
+        self.module.scan("a", {"path": self.directory.name, "workers": 5000})
+        self.finish()
+        self.assertEqual(self.workers, [DiskUsage.max_workers])
+
+    def test_duplicate_id_is_rejected(self):
+        self.module.scan("a", {"path": self.directory.name})
+        scanner = self.module.scans["a"]
+        self.module.scan("a", {"path": self.directory.name})
+        self.assertIs(self.module.scans["a"], scanner)
+        self.finish()
+
+        messages = self.messages()
+        self.assertEqual([m["type"] for m in messages if m["type"] != "progress"], ["scanerror", "result"])
+        self.assertEqual(self.module.scans, {})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,105 @@
+import hashlib
+import json
+import os
+import queue
+import tempfile
+import threading
+import unittest
+import uuid
+from unittest import mock
+from modules.addons.files import Chunk, FileTransfer, Upload
+
+
+class UploadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.path = os.path.join(self.directory.name, "upload.bin")
+        self.manager = FileTransfer(None, queue.Queue())
+        self.addCleanup(self.manager._io.shutdown)
+
+    def messages(self):
+        out = []
+        while not self.manager.queue.empty():
+            out.append(self.manager.queue.get_nowait()["data"])
+        return out
+
+    def test_upload_is_flushed_off_the_receive_thread(self):
+        content = os.urandom(40 * 1024)
+        transfer_id = uuid.uuid4()
+        self.manager.upload(transfer_id, {"path": self.path, "size": len(content), "sha256": hashlib.sha256(content).hexdigest()})
+
+        fsync_threads = []
+        fsync = os.fsync
+
+        def record_fsync(fd):
+            fsync_threads.append(threading.current_thread())
+            fsync(fd)
+
+        with mock.patch("os.fsync", side_effect=record_fsync):
+            for offset in range(0, len(content), 1024):
+                self.manager.binary_event(Chunk.pack(transfer_id, offset, content[offset:offset + 1024]))
+            self.manager._io.shutdown(wait=True)
+
+        self.assertTrue(fsync_threads)
+        self.assertNotIn(threading.current_thread(), fsync_threads)
+        self.assertEqual(self.messages()[-1]["type"], "uploadend")
+        with open(self.path, "rb") as infile:
+            self.assertEqual(infile.read(), content)
+
+    def test_checkpoint_saves_progress_for_resuming(self):
+        transfer_id = uuid.uuid4()
+        upload = Upload(transfer_id, self.path, 4096, None)
+        upload.open()
+        upload.write(0, b"x" * 1024)
+        upload.checkpoint(upload.offset)
+        upload.close()
+
+        with open(f"{self.path}.part.json") as infile:
+            self.assertEqual(json.load(infile)["offset"], 1024)
+        resumed = Upload(transfer_id, self.path, 4096, None)
+        self.assertEqual(resumed.open(), 1024)
+        resumed.close()
+
+    def test_cancelled_upload_is_removed(self):
+        transfer_id = uuid.uuid4()
+        self.manager.upload(transfer_id, {"path": self.path, "size": 64 * 1024, "sha256": None})
+        for offset in range(0, 32 * 1024, 1024):
+            self.manager.binary_event(Chunk.pack(transfer_id, offset, b"x" * 1024))
+        self.assertTrue(os.path.exists(f"{self.path}.part"))
+
+        self.manager.event({"type": "cancel", "data": {"id": str(transfer_id)}})
+        self.manager._io.shutdown(wait=True)
+        self.assertNotIn(transfer_id, self.manager.uploads)
+        self.assertEqual(os.listdir(self.directory.name), [])
+
+    def test_out_of_order_chunk_is_rejected(self):
+        upload = Upload(uuid.uuid4(), self.path, 4096, None)
+        upload.open()
+        self.assertFalse(upload.write(1024, b"x" * 1024))
+        self.assertTrue(upload.write(0, b"x" * 1024))
+        upload.close()
+
+
+class DownloadTest(unittest.TestCase):
+
+    def test_resuming_after_the_sender_finished(self):
+        manager = FileTransfer(None, queue.Queue())
+        self.addCleanup(manager._io.shutdown)
+        transfer_id = uuid.uuid4()
+        with tempfile.NamedTemporaryFile() as source:
+            source.write(b"data")
+            source.flush()
+            existing = mock.Mock()
+            manager.downloads[transfer_id] = existing
+            manager.download(transfer_id, {"path": source.name})
+            existing.cancel.assert_called_once()
+            thread = manager.threads.get(transfer_id)
+            if thread is not None:
+                thread.join()
+        self.assertEqual(manager.bulk_queue.get_nowait()["data"]["type"], "downloadstart")
+
+
+if __name__ == "__main__":
+    unittest.main()
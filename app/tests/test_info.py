@@ -0,0 +1,52 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+from rclient import Info, Collector
+
+
+class OperatingSystemTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.os_release = os.path.join(self.directory.name, "os-release")
+        self.lsb_release = os.path.join(self.directory.name, "lsb-release")
+        patcher = mock.patch.multiple(Collector, os_release_files=[self.os_release], lsb_release_file=self.lsb_release)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.directory.cleanup)
+
+    def write(self, path, content):
+        with open(path, "w") as outfile:
+            outfile.write(content)
+
+    def test_os_release_is_parsed(self):
+        self.write(self.os_release, 'PRETTY_NAME="Debian GNU/Linux 12 (bookworm)"\nNAME="Debian GNU/Linux"\n'
+                                    'VERSION_ID="12"\nVERSION_CODENAME=bookworm\nID=debian\n')
+        info = Info()
+        self.assertEqual(info.operating_system, "Debian")
+        self.assertEqual(info.operating_system_version, "12")
+        self.assertEqual(info.operating_system_codename, "bookworm")
+
+    def test_distributor_id_matches_lsb_release(self):
+        for os_id, expected in [("ubuntu", "Ubuntu"), ("fedora", "Fedora"), ("rhel", "RedHatEnterprise"), ("centos", "CentOS")]:
+            self.write(self.os_release, f'NAME="Some Long Name"\nID={os_id}\n')
+            self.assertEqual(Info().operating_system, expected)
+
+    def test_lsb_release_file_wins(self):
+        self.write(self.os_release, 'NAME="Linux Mint"\nID=linuxmint\n')
+        self.write(self.lsb_release, 'DISTRIB_ID=LinuxMint\nDISTRIB_RELEASE=21\n')
+        self.assertEqual(Info().operating_system, "LinuxMint")
+
+    def test_missing_fields_fall_back_to_lsb_release(self):
+        self.write(self.os_release, 'NAME="Arch Linux"\nID=arch\nBUILD_ID=rolling\n')
+        self.write(self.lsb_release, 'DISTRIB_ID=Arch\nDISTRIB_RELEASE=rolling\n')
+        with mock.patch("rclient.run_shell", return_value=(0, "n/a")) as run_shell:
+            info = Info()
+            self.assertEqual(info.operating_system_version, "rolling")
+            self.assertEqual(info.operating_system_codename, "n/a")
+        run_shell.assert_called_once_with("lsb_release -sc", raise_exception=False)
+
+
+if __name__ == "__main__":
+    unittest.main()
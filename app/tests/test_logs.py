@@ -0,0 +1,65 @@
+import os
+import queue
+import tempfile
+import unittest
+from modules.addons.logs import Follower, LogFilter, LogSearch, Logs
+
+
+class LogFilterTest(unittest.TestCase):
+
+    def test_severity_is_read_from_the_line(self):
+        log_filter = LogFilter(severity="warning")
+        self.assertTrue(log_filter.match(b"kernel: ERROR disk failed"))
+        self.assertTrue(log_filter.match(b"app: warn low memory"))
+        self.assertFalse(log_filter.match(b"app: started"))
+
+    def test_time_range_carries_over_to_lines_without_a_timestamp(self):
+        log_filter = LogFilter(since=LogFilter.line_time(b"2024-05-01T12:00:00+00:00"))
+        self.assertFalse(log_filter.match(b"2024-05-01T11:59:59+00:00 old"))
+        self.assertFalse(log_filter.match(b"  continuation of the old line"))
+        self.assertTrue(log_filter.match(b"2024-05-01T12:00:01+00:00 new"))
+        self.assertTrue(log_filter.match(b"  continuation of the new line"))
+
+
+class LogSearchTest(unittest.TestCase):
+
+    def test_most_recent_matches_first(self):
+        with tempfile.NamedTemporaryFile() as log:
+            log.write(b"".join(f"line {i} {'match' if i % 10 == 0 else 'other'}\n".encode() for i in range(1000)))
+            log.flush()
+            search = LogSearch(log.name, LogFilter(regex="^line \\d+ match$"), limit=3)
+            search.block_size = 256
+            lines, truncated = search.run()
+        self.assertEqual(lines, ["line 990 match", "line 980 match", "line 970 match"])
+
+
+class EndedFollower(Follower):
+
+    def follow(self):
+        raise OSError("journalctl is not installed")
+
+
+class LogsTest(unittest.TestCase):
+
+    def test_follower_base_is_abstract(self):
+        with self.assertRaises(TypeError):
+            Follower(None, "id", LogFilter())
+
+    def test_ended_followers_do_not_count_against_the_limit(self):
+        logs = Logs(None, queue.Queue())
+        for i in range(logs.max_follows):
+            follower = EndedFollower(logs, f"ended-{i}", LogFilter())
+            logs.followers[follower.id] = follower
+            follower.start()
+            follower.thread.join()
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "app.log")
+            open(path, "w").close()
+            logs.follow("new", {"path": path})
+            self.assertEqual(list(logs.followers), ["new"])
+            logs.shutdown()
+
+
+if __name__ == "__main__":
+    unittest.main()
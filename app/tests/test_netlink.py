@@ -0,0 +1,65 @@
+import socket
+import struct
+import unittest
+from modules.addons.sync import NetlinkMonitor
+
+
+def attribute(attr_type, value):
+    data = NetlinkMonitor.rtattr.pack(NetlinkMonitor.rtattr.size + len(value), attr_type) + value
+    return data + b"\x00" * (-len(data) % 4)
+
+
+def message(msg_type, body):
+    return NetlinkMonitor.nlmsghdr.pack(NetlinkMonitor.nlmsghdr.size + len(body), msg_type, 0, 0, 0) + body
+
+
+def route(msg_type, gateway, oif, metric=None, dst=None, dst_len=0):
+    body = NetlinkMonitor.rtmsg.pack(socket.AF_INET, dst_len, 0, 0, NetlinkMonitor.RT_TABLE_MAIN, 3, 0, 1, 0)
+    body += attribute(NetlinkMonitor.RTA_GATEWAY, socket.inet_aton(gateway))
+    body += attribute(NetlinkMonitor.RTA_OIF, struct.pack("=i", oif))
+    if metric is not None:
+        body += attribute(NetlinkMonitor.RTA_PRIORITY, struct.pack("=I", metric))
+    if dst is not None:
+        body += attribute(NetlinkMonitor.RTA_DST, socket.inet_aton(dst))
+    return message(msg_type, body)
+
+
+class NetlinkRouteTest(unittest.TestCase):
+
+    def setUp(self):
+        self.monitor = NetlinkMonitor(on_change=lambda: None)
+        for index, name in [(2, "eth0"), (3, "wlan0")]:
+            self.monitor.links[index] = {"name": name, "mac": None, "ipv4": {}, "ipv6": {}}
+
+    def interfaces(self):
+        return {i["name"]: i for i in self.monitor.to_dict()["interfaces"]}
+
+    def test_default_route_with_lowest_metric_wins(self):
+        # wlan0's gateway sorts first as a string but has the higher metric
+        self.monitor._handle(
+            route(NetlinkMonitor.RTM_NEWROUTE, "10.0.0.1", 3, metric=600)
+            + route(NetlinkMonitor.RTM_NEWROUTE, "192.168.1.1", 2, metric=100)
+            + route(NetlinkMonitor.RTM_NEWROUTE, "172.16.0.1", 2, metric=100, dst="172.16.0.0", dst_len=12)
+        )
+        data = self.monitor.to_dict()
+        self.assertEqual(data["default_gateway"], "192.168.1.1")
+        interfaces = self.interfaces()
+        self.assertTrue(interfaces["eth0"]["default"])
+        self.assertEqual(interfaces["eth0"]["gateway"], "192.168.1.1")
+        self.assertFalse(interfaces["wlan0"]["default"])
+        self.assertEqual(interfaces["wlan0"]["gateway"], "10.0.0.1")
+
+    def test_routes_differing_by_metric_are_kept_apart(self):
+        self.monitor._handle(
+            route(NetlinkMonitor.RTM_NEWROUTE, "192.168.1.1", 2, metric=100)
+            + route(NetlinkMonitor.RTM_NEWROUTE, "192.168.1.254", 2, metric=200)
+        )
+        self.assertEqual(len(self.monitor.routes), 2)
+        self.assertEqual(self.monitor.to_dict()["default_gateway"], "192.168.1.1")
+
+        self.monitor._handle(route(NetlinkMonitor.RTM_DELROUTE, "192.168.1.1", 2, metric=100))
+        self.assertEqual(self.monitor.to_dict()["default_gateway"], "192.168.1.254")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+from modules.addons.sync import Packages
+
+
+DPKG_STATUS = """\
+Package: bash
+Status: install ok installed
+Architecture: amd64
+Version: 5.2.15-2
+Description: GNU Bourne Again SHell
+ with a continuation line: Version: not this
+
+Package: removed
+Status: deinstall ok config-files
+Architecture: amd64
+Version: 1.0
+
+Package: tzdata
+Status: install ok installed
+Architecture: all
+Version: 2024a-0
+"""
+
+
+class PackagesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.packages = Packages()
+        self.packages.dpkg_status_file = os.path.join(self.directory.name, "status")
+        self.packages.rpm_db_dir = os.path.join(self.directory.name, "rpm")
+        os.makedirs(self.packages.rpm_db_dir)
+
+    def write(self, path, content, mtime=None):
+        with open(path, "w") as outfile:
+            outfile.write(content)
+        if mtime is not None:
+            os.utime(path, ns=(mtime, mtime))
+
+    def test_dpkg_status_is_parsed(self):
+        self.write(self.packages.dpkg_status_file, DPKG_STATUS)
+        self.assertEqual(self.packages.to_dict(), {"dpkg": {"bash:amd64": "5.2.15-2", "tzdata:all": "2024a-0"}})
+
+    def test_rpm_database_rewritten_in_place_is_queried_again(self):
+        database = os.path.join(self.packages.rpm_db_dir, "rpmdb.sqlite")
+        self.write(database, "one", mtime=1_000_000_000)
+        directory_mtime = os.stat(self.packages.rpm_db_dir).st_mtime_ns
+
+        with mock.patch.object(self.packages, "_query_rpm", side_effect=[{"a": "1"}, {"a": "1", "b": "2"}]) as query:
+            self.assertEqual(self.packages.to_dict()["rpm"], {"a": "1"})
+            self.assertEqual(self.packages.to_dict()["rpm"], {"a": "1"})
+            self.assertEqual(query.call_count, 1)
+
+            self.write(database, "two", mtime=2_000_000_000)
+            self.assertEqual(os.stat(self.packages.rpm_db_dir).st_mtime_ns, directory_mtime)
+            self.assertEqual(self.packages.to_dict()["rpm"], {"a": "1", "b": "2"})
+            self.assertEqual(query.call_count, 2)
+
+    def test_rpm_write_ahead_log_changes_are_noticed(self):
+        self.write(os.path.join(self.packages.rpm_db_dir, "rpmdb.sqlite"), "db")
+        with mock.patch.object(self.packages, "_query_rpm", return_value={}) as query:
+            self.packages.to_dict()
+            self.write(os.path.join(self.packages.rpm_db_dir, "rpmdb.sqlite-wal"), "wal")
+            self.packages.to_dict()
+            self.assertEqual(query.call_count, 2)
+
+    def test_berkeley_db_is_used_without_sqlite(self):
+        self.write(os.path.join(self.packages.rpm_db_dir, "Packages"), "bdb")
+        self.assertEqual(self.packages._rpm_db_paths(), [os.path.join(self.packages.rpm_db_dir, "Packages")])
+        with mock.patch.object(self.packages, "_query_rpm", return_value={"c": "3"}):
+            self.assertEqual(self.packages.to_dict(), {"rpm": {"c": "3"}})
+
+    def test_no_package_database(self):
+        self.assertEqual(self.packages.to_dict(), {})
+
+
+if __name__ == "__main__":
+    unittest.main()
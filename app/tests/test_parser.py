@@ -0,0 +1,79 @@
+import os
+import re
+import subprocess
+import sys
+import time
+import unittest
+from unittest import mock
+from modules.addons.sync import Packages
+from modules.util import CommandParser, CommandExecutor, StreamingCommandParser
+
+
+def python(code):
+    return f"{sys.executable} -c '{code}'"
+
+
+class CommandParserTest(unittest.TestCase):
+
+    def test_patterns_are_compiled_once(self):
+        regex = r"^(\w+)=(\d+)$"
+        first = CommandParser("a=1\nb=2").list(regex, "key", "value").all()
+        pattern = CommandParser._patterns[(regex, re.MULTILINE)]
+        self.assertIs(CommandParser._compile(regex), pattern)
+        self.assertEqual(first, [{"key": "a", "value": "1"}, {"key": "b", "value": "2"}])
+
+
+class StreamingCommandParserTest(unittest.TestCase):
+
+    def test_list_matches_line_by_line(self):
+        parser = CommandParser.stream(python('print("\\n".join(f"pkg{i}\\t{i}.0" for i in range(5000)))'))
+        packages = parser.list(r"^(\w+)\t(.+)$", "name", "version").all()
+        self.assertEqual(len(packages), 5000)
+        self.assertEqual(packages[-1], {"name": "pkg4999", "version": "4999.0"})
+
+    def test_get_stops_the_command_early(self):
+        started = time.monotonic()
+        parser = CommandParser.stream(python('import time; print("found: yes", flush=True); time.sleep(30)'))
+        self.assertEqual(parser.get(r"found: (\w+)", 1), "yes")
+        self.assertLess(time.monotonic() - started, 10)
+
+    def test_split_yields_blocks(self):
+        parser = CommandParser.stream(python('print("a=1\\nb=2\\n\\na=3\\nb=4")'))
+        blocks = [block.get(r"^b=(\d+)", 1) for block in parser.split("\n\n")]
+        self.assertEqual(blocks, ["2", "4"])
+
+    def test_output_is_read_once(self):
+        parser = CommandParser.stream(python('print(1)'))
+        self.assertTrue(parser.contains(r"1"))
+        with self.assertRaises(RuntimeError):
+            parser.contains(r"1")
+
+    def test_missing_command_has_no_output(self):
+        self.assertEqual(CommandParser.stream("/nonexistent/command").list(r"(.+)").all(), [])
+
+
+class CommandExecutorStreamTest(unittest.TestCase):
+
+    def test_timeout_kills_the_command(self):
+        executor = CommandExecutor()
+        lines = []
+        with self.assertRaises(subprocess.TimeoutExpired):
+            for line in executor.stream([sys.executable, "-c", 'import time; print(1, flush=True); time.sleep(30)'], timeout=0.5):
+                lines.append(line)
+        self.assertEqual(lines, ["1\n"])
+        self.assertEqual(executor.report()[os.path.basename(sys.executable)]["timeouts"], 1)
+
+
+class RpmQueryTest(unittest.TestCase):
+
+    def test_rpm_output_is_streamed(self):
+        output = 'print("bash:x86_64\\t0:5.2.15-3.fc39\\nkernel:x86_64\\t0:6.5.6-300.fc39")'
+        with mock.patch("modules.addons.sync.CommandParser.stream",
+                        side_effect=lambda command, timeout: StreamingCommandParser(python(output))) as stream:
+            packages = Packages()._query_rpm()
+        self.assertTrue(stream.call_args.args[0].startswith("rpm -qa"))
+        self.assertEqual(packages, {"bash:x86_64": "0:5.2.15-3.fc39", "kernel:x86_64": "0:6.5.6-300.fc39"})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+import os
+import queue
+import tempfile
+import time
+import unittest
+from threading import Event
+from unittest import mock
+from modules.addons.processes import ProcessScanner, ProcessManager
+
+
+def stat_line(pid, name, state="S", ppid=1, utime=0, stime=0, starttime=100, rss_pages=10):
+    fields = [state, ppid] + [0] * 9 + [utime, stime] + [0] * 6 + [starttime, 0, rss_pages] + [0] * 30
+    return f"{pid} ({name}) " + " ".join(str(f) for f in fields)
+
+
+class ProcessScannerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.scanner = ProcessScanner()
+        self.scanner.proc_dir = self.directory.name
+        os.makedirs(os.path.join(self.directory.name, "self"))
+
+    def process(self, pid, name, cmdline=b"", io=None, **stat):
+        path = os.path.join(self.directory.name, str(pid))
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, "stat"), "w") as outfile:
+            outfile.write(stat_line(pid, name, **stat))
+        with open(os.path.join(path, "cmdline"), "wb") as outfile:
+            outfile.write(cmdline)
+        if io is not None:
+            with open(os.path.join(path, "io"), "w") as outfile:
+                outfile.write(f"rchar: 1\nread_bytes: {io}\nwrite_bytes: 0\n")
+
+    def test_stat_is_parsed(self):
+        self.process(42, "tricky) (name", cmdline=b"/bin/tricky\x00--flag\x00", ppid=7, utime=5, stime=3, rss_pages=4)
+        (sample, cpu_percent, io_rate), = self.scanner.scan()
+        self.assertEqual(sample.name, "tricky) (name")
+        self.assertEqual((sample.pid, sample.ppid, sample.ticks), (42, 7, 8))
+        self.assertEqual(sample.rss, 4 * self.scanner.page_size)
+        self.assertIsNone(cpu_percent)
+        self.assertEqual(self.scanner.cmdline(42), "/bin/tricky --flag")
+
+    def test_top_by_cpu_against_the_previous_scan(self):
+        self.process(1, "idle", utime=100)
+        self.process(2, "busy", utime=100)
+        self.scanner.scan()
+        self.process(1, "idle", utime=101)
+        self.process(2, "busy", utime=100 + self.scanner.clock_ticks)
+        top = self.scanner.top(count=1, sort="cpu")
+        self.assertEqual([p["name"] for p in top], ["busy"])
+        self.assertGreater(top[0]["cpu_percent"], 0)
+
+    def test_old_baseline_is_scanned_again(self):
+        self.process(1, "busy", utime=100)
+        self.scanner.scan()
+        # minutes later the process was idle for a long time and only just got busy
+        self.scanner._previous_time -= 600
+        self.process(1, "busy", utime=100 + 600 * self.scanner.clock_ticks)
+        with mock.patch("modules.addons.processes.time.sleep") as sleep:
+            top = self.scanner.top(count=1, sort="cpu")
+        sleep.assert_called_once_with(0.5)
+        # the fresh baseline saw no ticks since, not the average over ten minutes
+        self.assertEqual(top[0]["cpu_percent"], 0)
+
+    def test_recent_baseline_is_used(self):
+        self.process(1, "busy", utime=100)
+        self.scanner.scan()
+        with mock.patch("modules.addons.processes.time.sleep") as sleep:
+            self.scanner.top(count=1, sort="cpu")
+        sleep.assert_not_called()
+
+    def test_reused_pid_has_no_rate(self):
+        self.process(5, "old", utime=100, starttime=1)
+        self.scanner.scan()
+        self.process(5, "new", utime=500, starttime=2)
+        (sample, cpu_percent, _), = self.scanner.scan()
+        self.assertIsNone(cpu_percent)
+
+    def test_unknown_sort_key(self):
+        with self.assertRaises(ValueError):
+            self.scanner.top(sort="name")
+
+
+class ProcessManagerTest(unittest.TestCase):
+
+    def test_top_runs_off_the_receive_thread(self):
+        manager = ProcessManager(None, queue.Queue())
+        release = Event()
+
+        def slow_top(count, sort):
+            release.wait(5)
+            return [{"pid": 1}]
+
+        with mock.patch.object(manager.scanner, "top", side_effect=slow_top):
+            started = time.monotonic()
+            manager.event({"type": "top", "data": {"count": 1}})
+            self.assertLess(time.monotonic() - started, 0.5)
+            self.assertTrue(manager.queue.empty())
+            release.set()
+            message = manager.queue.get(timeout=5)
+        self.assertEqual(message["data"]["data"]["processes"], [{"pid": 1}])
+
+
+if __name__ == "__main__":
+    unittest.main()
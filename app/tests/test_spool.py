@@ -0,0 +1,158 @@
+import os
+import queue
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+from rclient import Spool, SpoolSender
+
+
+class SpoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.path = os.path.join(self.directory.name, "spool")
+
+    def spool(self, **kwargs):
+        spool = Spool(self.path, **kwargs)
+        self.addCleanup(spool.close)
+        return spool
+
+    def test_directory_is_created_with_the_first_message(self):
+        spool = self.spool()
+        self.assertFalse(os.path.exists(self.path))
+        spool.append({"type": "script"})
+        self.assertTrue(os.path.isdir(self.path))
+
+    def test_messages_survive_a_restart_until_acknowledged(self):
+        spool = self.spool()
+        for i in range(5):
+            spool.append({"n": i})
+        spool.acknowledge(2)
+        spool.close()
+
+        reopened = self.spool()
+        self.assertEqual(reopened.acked, 2)
+        self.assertEqual(reopened.read(reopened.acked), [(3, {"n": 2}), (4, {"n": 3}), (5, {"n": 4})])
+
+    def test_torn_write_is_truncated(self):
+        spool = self.spool()
+        spool.append({"n": 1})
+        spool.append({"n": 2})
+        spool.close()
+        segment = os.path.join(self.path, sorted(n for n in os.listdir(self.path) if n.endswith(".seg"))[0])
+        size = os.path.getsize(segment)
+        os.truncate(segment, size - 3)
+
+        reopened = self.spool()
+        self.assertEqual(reopened.read(0), [(1, {"n": 1})])
+        self.assertEqual(reopened.append({"n": 3}), 2)
+        self.assertEqual(reopened.read(0), [(1, {"n": 1}), (2, {"n": 3})])
+
+    def test_corrupt_record_ends_the_segment(self):
+        spool = self.spool()
+        spool.append({"n": 1})
+        spool.append({"n": 2})
+        spool.close()
+        segment = os.path.join(self.path, sorted(n for n in os.listdir(self.path) if n.endswith(".seg"))[0])
+        with open(segment, "r+b") as outfile:
+            outfile.seek(-2, os.SEEK_END)
+            outfile.write(b"!!")
+
+        self.assertEqual(self.spool().read(0), [(1, {"n": 1})])
+
+    def test_appending_does_not_wait_for_a_running_fsync(self):
+        spool = self.spool()
+        spool.start()
+        syncing, release = threading.Event(), threading.Event()
+        fsync = os.fsync
+
+        def slow_fsync(fd):
+            syncing.set()
+            release.wait(5)
+            fsync(fd)
+
+        with mock.patch("os.fsync", side_effect=slow_fsync):
+            first = threading.Thread(target=spool.append, args=({"n": 1},))
+            first.start()
+            self.assertTrue(syncing.wait(5))
+
+            # the record is written while the first fsync is still running
+            started = time.monotonic()
+            self.assertEqual(spool.append({"n": 2}, timeout=0.1), 2)
+            self.assertLess(time.monotonic() - started, 2)
+            self.assertEqual(spool.commits, 0)
+
+            release.set()
+            first.join()
+        spool.close()
+        self.assertEqual(self.spool().read(0), [(1, {"n": 1}), (2, {"n": 2})])
+
+    def test_acknowledged_segments_are_removed(self):
+        spool = self.spool(segment_bytes=64)
+        for i in range(10):
+            spool.append({"n": i})
+        segments = [n for n in os.listdir(self.path) if n.endswith(".seg")]
+        spool.acknowledge(9)
+        self.assertLess(len([n for n in os.listdir(self.path) if n.endswith(".seg")]), len(segments))
+        self.assertEqual(spool.read(spool.acked), [(10, {"n": 9})])
+
+
+class SpoolSenderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.spool = Spool(os.path.join(self.directory.name, "spool"))
+        self.addCleanup(self.spool.close)
+        self.queue = queue.Queue()
+        self.sender = SpoolSender(self.spool, self.queue)
+
+    def sent(self, count):
+        return [self.queue.get(timeout=5) for _ in range(count)]
+
+    def test_without_acks_messages_are_acknowledged_once_written(self):
+        self.sender.start()
+        self.addCleanup(self.sender.stop)
+        self.sender.put({"type": "script", "n": 1})
+        self.sender.put({"type": "script", "n": 2})
+        first, second = self.sent(2)
+
+        # queued, but not written to a websocket yet
+        self.assertEqual(self.spool.acked, 0)
+        self.assertEqual(SpoolSender.local_seq(first), ({"type": "script", "n": 1}, 1))
+
+        # written out of order, only acknowledged up to the gap
+        self.sender.written(SpoolSender.local_seq(second)[1])
+        self.assertEqual(self.spool.acked, 0)
+        self.sender.written(SpoolSender.local_seq(first)[1])
+        self.assertEqual(self.spool.acked, 2)
+
+    def test_with_acks_messages_carry_their_sequence_number(self):
+        self.sender.acks = True
+        self.sender.start()
+        self.addCleanup(self.sender.stop)
+        self.sender.put({"type": "script"})
+        message, = self.sent(1)
+        self.assertEqual(message, {"type": "script", "seq": 1})
+
+        self.sender.event({"type": "ack", "data": {"seq": 1}})
+        self.assertEqual(self.spool.acked, 1)
+
+    def test_unacknowledged_messages_are_sent_again(self):
+        self.sender.acks = True
+        self.sender.resend_after = 0.2
+        self.sender.start()
+        self.addCleanup(self.sender.stop)
+        self.sender.put({"type": "script"})
+        first, = self.sent(1)
+        time.sleep(0.3)
+        self.sender._wake.set()
+        again, = self.sent(1)
+        self.assertEqual(first, again)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+from modules.addons.sync import Storage
+
+
+MOUNTINFO = """\
+22 1 0:33 /root / rw,relatime shared:1 - btrfs /dev/vda3 rw,seclabel,compress=zstd:1,subvolid=257,subvol=/root
+23 22 0:33 /home /home rw,relatime shared:2 - btrfs /dev/vda3 rw,seclabel,compress=zstd:1,subvolid=256,subvol=/home
+24 22 252:1 / /boot rw,relatime shared:3 - ext4 /dev/vda2 rw
+25 22 252:1 /grub2 /mnt/grub rw,relatime shared:3 - ext4 /dev/vda2 rw
+26 22 0:21 / /tmp rw,nosuid shared:4 - tmpfs tmpfs rw
+27 22 253:1 / /mnt/my\\040data rw,relatime shared:5 - xfs /dev/mapper/vg-data rw
+"""
+
+
+class MountsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        path = os.path.join(self.directory.name, "mountinfo")
+        with open(path, "w") as outfile:
+            outfile.write(MOUNTINFO)
+        patcher = mock.patch.object(Storage, "mountinfo_file", path)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_subvolume_roots_are_kept_and_bind_mounts_skipped(self):
+        mounts = Storage.read_mounts()
+        self.assertEqual(mounts, {
+            "0:33": ("/dev/vda3", "btrfs", "/"),
+            "252:1": ("/dev/vda2", "ext4", "/boot"),
+            "253:1": ("/dev/mapper/vg-data", "xfs", "/mnt/my data"),
+        })
+
+    def test_mounts_by_source_device(self):
+        by_source = Storage.mounts_by_source(Storage.read_mounts())
+        self.assertEqual(by_source["vda3"], ("/dev/vda3", "btrfs", "/"))
+        self.assertEqual(by_source["vda2"], ("/dev/vda2", "ext4", "/boot"))
+
+
+class HoldersTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        root = self.directory.name
+        sys_block = os.path.join(root, "block")
+        class_block = os.path.join(root, "class")
+        os.makedirs(class_block)
+
+        def device(path, slaves=(), partition=False):
+            os.makedirs(os.path.join(sys_block, path))
+            if partition:
+                open(os.path.join(sys_block, path, "partition"), "w").close()
+            if slaves:
+                os.makedirs(os.path.join(sys_block, path, "slaves"))
+                for slave in slaves:
+                    open(os.path.join(sys_block, path, "slaves", slave), "w").close()
+            os.symlink(os.path.join(sys_block, path), os.path.join(class_block, os.path.basename(path)))
+
+        # lvm (dm-1) on dm-crypt (dm-0) on sda2, and an md mirror of sdb1 and sdc1
+        device("sda")
+        device("sda/sda1", partition=True)
+        device("sda/sda2", partition=True)
+        device("sdb")
+        device("sdb/sdb1", partition=True)
+        device("sdc")
+        device("sdc/sdc1", partition=True)
+        device("dm-0", slaves=["sda2"])
+        device("dm-1", slaves=["dm-0"])
+        device("md0", slaves=["sdb1", "sdc1"])
+
+        patcher = mock.patch.multiple(Storage, sys_block=sys_block, sys_class_block=class_block,
+                                      _search_disks=mock.DEFAULT, read_mounts=mock.DEFAULT)
+        patched = patcher.start()
+        patched["_search_disks"].return_value = []
+        patched["read_mounts"].return_value = {}
+        self.addCleanup(patcher.stop)
+
+    def test_nested_holders_map_to_the_physical_disk(self):
+        holders = Storage()._holders()
+        self.assertEqual(holders, {"sda": ["dm-0", "dm-1"], "sdb": ["md0"], "sdc": ["md0"]})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,153 @@
+import copy
+import itertools
+import queue
+import unittest
+from threading import Event, Thread
+from unittest import mock
+from modules.addons.sync import SystemSync
+
+
+def apply_patch(document, patch):
+    """
+    Apply the add, remove and replace operations json_diff produces
+    """
+    document = copy.deepcopy(document)
+    for op in patch:
+        keys = [key.replace("~1", "/").replace("~0", "~") for key in op["path"].split("/")[1:]]
+        parent = document
+        for key in keys[:-1]:
+            parent = parent[int(key) if isinstance(parent, list) else key]
+        last = int(keys[-1]) if isinstance(parent, list) else keys[-1]
+        if op["op"] == "remove":
+            del parent[last]
+        else:
+            parent[last] = op["value"]
+    return document
+
+
+def snapshot(n):
+    return {
+        "system": {"hostname": f"host-{n % 3}", "ram": 1024},
+        "network": {"interfaces": [{"name": "eth0", "rx": n}]},
+        "storage": {f"disk{i}": i for i in range(n % 4)},
+        "packages": None,
+    }
+
+
+class SyncDeltaTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sync = SystemSync(None, queue.Queue())
+        self.sent = {}
+
+    def messages(self):
+        out = []
+        while not self.sync.bulk_queue.empty():
+            out.append(self.sync.bulk_queue.get_nowait()["data"])
+        return out
+
+    def send(self, snap):
+        with self.sync._sync_lock:
+            self.sync._sync(snap)
+        self.sent[self.sync._version] = copy.deepcopy(snap)
+
+    def test_full_snapshot_then_delta_against_acknowledged_version(self):
+        self.send(snapshot(1))
+        full, = self.messages()
+        self.assertEqual(full["version"], 1)
+
+        self.sync.acknowledge(1)
+        self.send(snapshot(2))
+        delta, = self.messages()
+        self.assertEqual(delta["type"], "syncdelta")
+        self.assertEqual(delta["data"]["base"], 1)
+        self.assertEqual(apply_patch(snapshot(1), delta["data"]["patch"]), snapshot(2))
+
+    def test_unchanged_snapshot_is_not_sent(self):
+        self.send(snapshot(1))
+        self.send(snapshot(1))
+        self.assertEqual(len(self.messages()), 1)
+
+    def test_acknowledge_waits_for_a_sync_in_progress(self):
+        self.send(snapshot(1))
+        with self.sync._sync_lock:
+            thread = Thread(target=self.sync.acknowledge, args=(1,))
+            thread.start()
+            thread.join(0.1)
+            self.assertTrue(thread.is_alive())
+            self.assertIsNone(self.sync._acked_version)
+        thread.join()
+        self.assertEqual(self.sync._acked_version, 1)
+
+    def test_deltas_apply_to_their_base_while_acks_arrive(self):
+        self.send(snapshot(0))
+        self.messages()
+        self.sync.acknowledge(1)
+
+        def acknowledge():
+            for version in range(2, 400):
+                self.sync.acknowledge(version)
+
+        thread = Thread(target=acknowledge)
+        thread.start()
+        for n in range(1, 400):
+            self.send(snapshot(n))
+        thread.join()
+
+        for message in self.messages():
+            data = message["data"]
+            self.assertEqual(apply_patch(self.sent[data["base"]], data["patch"]), self.sent[data["version"]])
+
+
+class SyncCollectTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sync = SystemSync(None, queue.Queue())
+        self.counter = itertools.count()
+        self.storage_started = Event()
+        self.storage_release = Event()
+        self.storage_release.set()
+        self.sync._network = lambda: {"rx": next(self.counter)}
+        self.sync._storage = self.storage
+        self.sync._installed_packages = lambda: {}
+        self.sync.sync()
+        self.storage_started.clear()
+
+    def storage(self):
+        self.storage_started.set()
+        self.storage_release.wait(5)
+        return {"disks": []}
+
+    def latest(self):
+        with self.sync._sync_lock:
+            return self.sync._latest()
+
+    def test_slow_collection_does_not_overwrite_newer_section(self):
+        self.storage_release.clear()
+        slow = Thread(target=self.sync.sync, kwargs={"sections": ["network", "storage"]})
+        slow.start()
+        self.assertTrue(self.storage_started.wait(5))
+
+        self.sync.sync(sections=["network"])
+        self.assertEqual(self.latest()["network"], {"rx": 2})
+
+        self.storage_release.set()
+        slow.join()
+        self.assertEqual(self.latest()["network"], {"rx": 2})
+
+    def test_requested_sections_must_be_a_list(self):
+        with mock.patch.object(self.sync, "sync") as sync:
+            self.sync._requested_sync({"id": 1, "sections": "network"})
+            sync.assert_called_once_with(sections=["network"], max_age=self.sync.default_max_age)
+            sync.reset_mock()
+
+            self.sync._requested_sync({"id": 2, "sections": {"network": True}})
+            self.sync._requested_sync({"id": 3, "sections": ["network", 5, "nope"]})
+            sync.assert_called_once_with(sections=["network"], max_age=self.sync.default_max_age)
+
+        messages = [self.sync.bulk_queue.get_nowait()["data"] for _ in range(self.sync.bulk_queue.qsize())]
+        self.assertEqual([m["data"]["id"] for m in messages if m.get("type") == "syncdone"], [1, 3])
+
+
+if __name__ == "__main__":
+    unittest.main()
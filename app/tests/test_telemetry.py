@@ -0,0 +1,106 @@
+import os
+import queue
+import tempfile
+import unittest
+from unittest import mock
+from modules.addons.telemetry import RingBuffer, HostSampler, Telemetry
+
+
+class RingBufferTest(unittest.TestCase):
+
+    def test_empty_buffer_has_no_rollup(self):
+        self.assertIsNone(RingBuffer(3).rollup())
+
+    def test_partial_buffer(self):
+        buffer = RingBuffer(5)
+        for value in (2, 4):
+            buffer.push(value)
+        self.assertEqual(buffer.rollup(), [2, 3, 4])
+
+    def test_full_buffer_keeps_the_newest_samples(self):
+        buffer = RingBuffer(3)
+        for value in (100, 1, 2, 3):
+            buffer.push(value)
+        self.assertEqual(buffer.count, 3)
+        self.assertEqual(buffer.rollup(), [1, 2, 3])
+        buffer.clear()
+        self.assertIsNone(buffer.rollup())
+
+
+class HostSamplerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.sampler = HostSampler()
+        self.sampler.proc_dir = os.path.join(self.directory.name, "proc")
+        self.sampler.sys_block = os.path.join(self.directory.name, "block")
+        os.makedirs(os.path.join(self.sampler.proc_dir, "net"))
+        os.makedirs(os.path.join(self.sampler.sys_block, "sda", "device"))
+        os.makedirs(os.path.join(self.sampler.sys_block, "loop0"))
+
+    def write(self, name, content):
+        with open(os.path.join(self.sampler.proc_dir, name), "w") as outfile:
+            outfile.write(content)
+
+    def counters(self, busy, idle, sectors, rx, disks=("sda", "loop0")):
+        self.write("stat", f"cpu  {busy} 0 0 {idle} 0 0 0 0\n")
+        self.write("diskstats", "".join(f"   8 0 {d} 1 0 {sectors} 0 1 0 {sectors * 2} 0\n" for d in disks))
+        self.write("net/dev", "header\nheader\n"
+                              f"    lo: 999 0 0 0 0 0 0 0 999\n"
+                              f"  eth0: {rx} 0 0 0 0 0 0 0 {rx // 2}\n")
+
+    def sample(self, now):
+        with mock.patch("modules.addons.telemetry.time.monotonic", return_value=now):
+            return self.sampler.sample()
+
+    def test_counters_become_rates(self):
+        self.write("meminfo", "MemTotal: 1000 kB\nMemAvailable: 250 kB\n")
+        self.counters(busy=100, idle=100, sectors=0, rx=0)
+        first = self.sample(10.0)
+        self.assertEqual(first["mem.percent"], 75.0)
+        self.assertNotIn("cpu.percent", first)
+
+        self.counters(busy=150, idle=250, sectors=8, rx=4000)
+        second = self.sample(12.0)
+        self.assertEqual(second["cpu.percent"], 25.0)
+        self.assertEqual(second["disk.sda.read"], 8 * 512 / 2)
+        self.assertEqual(second["disk.sda.write"], 16 * 512 / 2)
+        self.assertEqual(second["net.eth0.rx"], 2000)
+        self.assertEqual(second["net.eth0.tx"], 1000)
+        self.assertNotIn("disk.loop0.read", second)
+        self.assertNotIn("net.lo.rx", second)
+
+    def test_counter_reset_is_not_negative(self):
+        self.counters(busy=100, idle=100, sectors=0, rx=5000)
+        self.sample(1.0)
+        self.counters(busy=200, idle=200, sectors=0, rx=10)
+        self.assertEqual(self.sample(2.0)["net.eth0.rx"], 0)
+
+    def test_removed_disks_are_forgotten(self):
+        self.counters(busy=1, idle=1, sectors=0, rx=0)
+        self.sample(1.0)
+        self.assertEqual(self.sampler._disks, {"sda": True, "loop0": False})
+        self.counters(busy=1, idle=1, sectors=0, rx=0, disks=("sda",))
+        self.sample(2.0)
+        self.assertEqual(self.sampler._disks, {"sda": True})
+
+
+class TelemetryRollupTest(unittest.TestCase):
+
+    def test_buffers_without_samples_are_dropped(self):
+        telemetry = Telemetry(None, queue.Queue())
+        telemetry._buffer("net.eth0.rx").push(1)
+        telemetry._buffer("net.veth1.rx").push(2)
+        telemetry._send_rollup(0, 30)
+        self.assertEqual(set(telemetry.queue.get_nowait()["data"]["data"]["metrics"]), {"net.eth0.rx", "net.veth1.rx"})
+
+        # veth1 went away
+        telemetry._buffer("net.eth0.rx").push(3)
+        telemetry._send_rollup(30, 60)
+        self.assertEqual(telemetry.queue.get_nowait()["data"]["data"]["metrics"], {"net.eth0.rx": [3, 3, 3]})
+        self.assertEqual(set(telemetry.buffers), {"net.eth0.rx"})
+
+
+if __name__ == "__main__":
+    unittest.main()
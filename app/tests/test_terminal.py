@@ -0,0 +1,96 @@
+import base64
+import gzip
+import json
+import os
+import queue
+import tempfile
+import threading
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+from modules.addons import terminal
+from modules.addons.terminal import SessionRecorder, ShellManager
+
+
+def read_recording(path):
+    with open(path, "rb") as infile:
+        data = infile.read()
+    if path.endswith(".zst"):
+        data = terminal.zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    else:
+        data = gzip.decompress(data)
+    return [json.loads(line) for line in data.splitlines()]
+
+
+class SessionRecorderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_multibyte_character_split_across_reads(self):
+        recorder = SessionRecorder(self.directory.name, "session")
+        recorder.start()
+        data = "héllo ✓".encode()
+        split = data.index("✓".encode()) + 1
+        recorder.output(data[:split])
+        recorder.output(data[split:])
+        recorder.close()
+
+        header, *events = read_recording(recorder._path(0))
+        self.assertEqual(header["version"], 2)
+        self.assertEqual("".join(event[2] for event in events), "héllo ✓")
+        self.assertNotIn("�", "".join(event[2] for event in events))
+
+    def test_input_and_output_are_decoded_separately(self):
+        recorder = SessionRecorder(self.directory.name, "session", record_input=True)
+        recorder.start()
+        recorder.output("é".encode()[:1])
+        recorder.input(b"ls\n")
+        recorder.output("é".encode()[1:])
+        recorder.close()
+
+        _, *events = read_recording(recorder._path(0))
+        self.assertEqual([(event[1], event[2]) for event in events], [("i", "ls\n"), ("o", "é")])
+
+
+class RecordingDownloadTest(unittest.TestCase):
+
+    def test_recording_is_sent_in_chunks(self):
+        with tempfile.TemporaryDirectory() as directory:
+            core = SimpleNamespace(config=SimpleNamespace(base_dir=directory, get=lambda key, default=None: default))
+            manager = ShellManager(core, queue.Queue())
+            manager.recording_chunk_size = 1000
+            os.makedirs(manager.recording_dir)
+            content = os.urandom(2500)
+            with open(os.path.join(manager.recording_dir, "session.0.cast.gz"), "wb") as outfile:
+                outfile.write(content)
+
+            manager.get_recording("session.0.cast.gz")
+
+            messages = [manager.bulk_queue.get_nowait()["data"]["data"] for _ in range(manager.bulk_queue.qsize())]
+            self.assertEqual([m["offset"] for m in messages], [0, 1000, 2000])
+            self.assertEqual([m["last"] for m in messages], [False, False, True])
+            self.assertEqual(b"".join(base64.b64decode(m["content"]) for m in messages), content)
+
+    def test_recording_is_sent_off_the_receive_thread(self):
+        core = SimpleNamespace(config=SimpleNamespace(base_dir="/nonexistent", get=lambda key, default=None: default))
+        manager = ShellManager(core, queue.Queue())
+        release = threading.Event()
+        sent = threading.Event()
+
+        def get_recording(name):
+            release.wait(5)
+            sent.set()
+
+        with mock.patch.object(manager, "get_recording", side_effect=get_recording):
+            manager.event({"type": "getrecording", "data": {"name": "session.0.cast.gz"}})
+            self.assertFalse(sent.is_set())
+            release.set()
+            self.assertTrue(sent.wait(5))
+
+
+if __name__ == "__main__":
+    unittest.main()
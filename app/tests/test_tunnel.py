@@ -0,0 +1,74 @@
+import queue
+import selectors
+import socket
+import time
+import unittest
+from modules.addons.tunnel import Stream, Tunnel
+
+
+class TunnelWriteTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tunnel = Tunnel(None, queue.Queue())
+        self.tunnel.selector = selectors.DefaultSelector()
+        self.addCleanup(self.tunnel.selector.close)
+
+        self.local, self.remote = socket.socketpair()
+        self.addCleanup(self.remote.close)
+        self.local.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        self.remote.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        self.local.setblocking(False)
+
+        self.stream = Stream(1, "127.0.0.1", 0, self.tunnel.initial_window)
+        self.stream.sock = self.local
+        self.stream.connected = True
+        self.tunnel.streams[1] = self.stream
+
+    def read_all(self, size):
+        self.remote.settimeout(1)
+        received = b""
+        deadline = time.monotonic() + 5
+        while len(received) < size and time.monotonic() < deadline:
+            try:
+                received += self.remote.recv(65536)
+            except socket.timeout:
+                pass
+            if self.stream.pending:
+                self.tunnel._writable(self.stream)
+        return received
+
+    def test_full_local_buffer_keeps_the_rest_pending(self):
+        data = bytes(range(256)) * 512
+        # the first write fills the buffer, the second finds it full
+        self.tunnel._remote_data(1, data[:65536], time.monotonic())
+        self.tunnel._remote_data(1, data[65536:], time.monotonic())
+
+        self.assertIn(1, self.tunnel.streams)
+        self.assertTrue(self.stream.pending)
+        self.assertGreater(self.stream.pending_bytes, 0)
+        self.assertTrue(self.tunnel.selector.get_key(self.local).events & selectors.EVENT_WRITE)
+
+        self.assertEqual(self.read_all(len(data)), data)
+        self.assertEqual(self.stream.pending_bytes, 0)
+
+    def test_remote_eof_waits_for_pending_data(self):
+        data = b"x" * 200000
+        self.tunnel._remote_data(1, data, time.monotonic())
+        self.tunnel._remote_eof(1)
+        self.assertFalse(self.stream.write_shutdown)
+
+        self.assertEqual(self.read_all(len(data)), data)
+        self.assertTrue(self.stream.write_shutdown)
+        self.assertEqual(self.remote.recv(1), b"")
+
+    def test_write_error_closes_the_stream(self):
+        self.remote.close()
+        self.tunnel._remote_data(1, b"x" * 1024, time.monotonic())
+        self.assertNotIn(1, self.tunnel.streams)
+        closed = self.tunnel.queue.get_nowait()["data"]
+        self.assertEqual(closed["type"], "closed")
+        self.assertTrue(closed["data"]["error"])
+
+
+if __name__ == "__main__":
+    unittest.main()
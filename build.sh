@@ -4,6 +4,8 @@
 arch=$(dpkg-architecture --query=DEB_HOST_ARCH)
 version=1.0.1
 outputdir=./
+# onefile unpacks itself to a temp dir on every start, onedir is installed unpacked
+bundle=onefile
 
 while [[ $# -gt 0 ]]; do
 	case "$1" in
@@ -25,6 +27,11 @@ while [[ $# -gt 0 ]]; do
 			shift
 			shift
 			;;
+		--onedir)
+			# package the unpacked bundle for faster startup
+			bundle=onedir
+			shift
+			;;
 	esac
 done
 
@@ -40,14 +47,24 @@ deb_file_latest="$outputdir"remotesupport_latest_$arch.deb
 echo Building executable
 echo Installing dependencies
 pip3 install -r ./app/requirements.txt
+# addons are imported by name from the module manifest so they have to be collected explicitly
 python3 -m PyInstaller ./app/rclient.py \
-	--onefile \
+	--$bundle \
 	--paths='./app/' \
 	--paths='./app/modules' \
+	--collect-submodules='modules' \
 	--distpath='./app/dist' \
 	--workpath='./app/build'
 
-mv ./app/dist/rclient ./deb/usr/bin/
+mkdir -p ./deb/usr/bin
+if [ "$bundle" = "onedir" ]; then
+	rm -rf ./deb/usr/lib/remotesupport
+	mkdir -p ./deb/usr/lib
+	mv ./app/dist/rclient ./deb/usr/lib/remotesupport
+	ln -sf /usr/lib/remotesupport/rclient ./deb/usr/bin/rclient
+else
+	mv ./app/dist/rclient ./deb/usr/bin/
+fi
 
 # build the debian package
 echo Building $deb_file